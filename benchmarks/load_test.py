@@ -0,0 +1,163 @@
+# benchmarks/load_test.py
+"""
+Load generator for server.py.
+
+Opens N concurrent MCP sessions over SSE, has each of them call the
+togtider tool back to back for a fixed time, and reports throughput and
+latency percentiles. Run it against a server whose API_ENDPOINT points at
+benchmarks.replay_server so that Bane NOR is never involved.
+
+Usage:
+    python -m benchmarks.replay_server --latency-ms 150 --jitter-ms 100 &
+    python server.py &
+    python -m benchmarks.load_test --clients 50 --duration 30
+    python -m benchmarks.load_test --clients 10 --arguments '{"limit": 3}'
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import time
+from datetime import datetime
+
+from mcp import ClientSession
+from mcp.client.sse import sse_client
+
+from benchmarks.run import RESULTS_DIR, _git_revision
+
+def percentile(ordered, percentile):
+    """
+    Args:
+        ordered (list): Sorted samples
+        percentile (float): Percentile between 0 and 100
+
+    Returns:
+        float: Nearest-rank percentile, or None without samples
+    """
+    if not ordered:
+        return None
+    return ordered[max(math.ceil(percentile / 100 * len(ordered)) - 1, 0)]
+
+def summarize(latencies, errors, elapsed, clients):
+    """
+    Args:
+        latencies (list): Seconds per successful call
+        errors (int): Failed calls
+        elapsed (float): Wall-clock seconds of the run
+        clients (int): Concurrent sessions
+
+    Returns:
+        dict: Throughput and latency percentiles in milliseconds
+    """
+    ordered = sorted(latencies)
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 2)
+
+    return {
+        "clients": clients,
+        "calls": len(ordered) + errors,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "calls_per_second": round((len(ordered) + errors) / elapsed, 2) if elapsed else None,
+        "p50_ms": ms(percentile(ordered, 50)),
+        "p95_ms": ms(percentile(ordered, 95)),
+        "p99_ms": ms(percentile(ordered, 99)),
+        "max_ms": ms(ordered[-1] if ordered else None),
+    }
+
+async def _client(url, tool, arguments, stop_at, latencies, failures):
+    """One MCP session calling the tool until stop_at."""
+    async with sse_client(url) as (read, write):
+        async with ClientSession(read, write) as session:
+            await session.initialize()
+            while time.monotonic() < stop_at:
+                start = time.perf_counter()
+                try:
+                    result = await session.call_tool(tool, arguments)
+                except Exception as e:
+                    failures.append(type(e).__name__)
+                    continue
+                if result.isError:
+                    failures.append("ToolError")
+                else:
+                    latencies.append(time.perf_counter() - start)
+
+async def run_load(url, clients, duration, tool="togtider", arguments=None, warmup=0.0):
+    """
+    Drives concurrent sessions against an MCP server.
+
+    Args:
+        url (str): SSE endpoint of the server
+        clients (int): Concurrent sessions
+        duration (float): Seconds each session keeps calling
+        tool (str): Tool to call
+        arguments (dict, optional): Tool arguments
+        warmup (float): Seconds of calls at the start left out of the results
+
+    Returns:
+        dict: See summarize()
+    """
+    latencies, failures = [], []
+    start = time.monotonic()
+    stop_at = start + warmup + duration
+    tasks = [
+        asyncio.create_task(_client(url, tool, arguments or {}, stop_at, latencies, failures))
+        for _ in range(clients)
+    ]
+    if warmup:
+        await asyncio.sleep(warmup)
+        latencies.clear()
+        failures.clear()
+    measured_from = time.monotonic()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.monotonic() - measured_from
+
+    summary = summarize(latencies, len(failures), elapsed, clients)
+    summary["failed_sessions"] = sum(1 for result in results if isinstance(result, BaseException))
+    summary["error_types"] = {kind: failures.count(kind) for kind in sorted(set(failures))}
+    return summary
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the togtider MCP server over SSE")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/sse", help="SSE endpoint of server.py")
+    parser.add_argument("--clients", type=int, nargs="+", default=[10],
+                        help="Concurrent sessions, one run per value")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds of measured calls per run")
+    parser.add_argument("--warmup", type=float, default=2, help="Seconds of unmeasured calls first")
+    parser.add_argument("--tool", default="togtider", help="Tool to call")
+    parser.add_argument("--arguments", default="{}", help="Tool arguments as JSON")
+    parser.add_argument("--output", help="Where to write the JSON results (default: benchmarks/results/)")
+    args = parser.parse_args(argv)
+
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "revision": _git_revision(),
+        "url": args.url,
+        "tool": args.tool,
+        "arguments": json.loads(args.arguments),
+        "results": [],
+    }
+    print(f"{'clients':>7} {'calls':>7} {'errors':>6} {'calls/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for clients in args.clients:
+        result = asyncio.run(run_load(
+            args.url, clients, args.duration, args.tool, report["arguments"], args.warmup
+        ))
+        report["results"].append(result)
+        print(f"{clients:>7} {result['calls']:>7} {result['errors']:>6} {result['calls_per_second'] or 0:>9.1f} "
+              f"{result['p50_ms'] or 0:>8.1f} {result['p95_ms'] or 0:>8.1f} {result['p99_ms'] or 0:>8.1f} "
+              f"{result['max_ms'] or 0:>8.1f}")
+        if result["failed_sessions"]:
+            print(f"        {result['failed_sessions']} sessions failed to connect or were dropped")
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"load-{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {output}")
+
+if __name__ == "__main__":
+    main()
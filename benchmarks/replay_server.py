@@ -0,0 +1,180 @@
+# benchmarks/replay_server.py
+"""
+Local stand-in for the Bane NOR SIRI-ET endpoint, for load tests.
+
+Answers every POST with a recorded delivery (cycling through the files
+given) or with a synthetic one from siri_fixture, after an injected delay.
+A share of the requests can be failed on purpose to exercise retries,
+hedging and stale serving.
+
+Point the service at it by setting API_ENDPOINT in
+jattavagen_departures/config.py, e.g. to http://127.0.0.1:8090/rest.
+
+Usage:
+    python -m benchmarks.replay_server
+    python -m benchmarks.replay_server --latency-ms 200 --jitter-ms 300 --error-rate 0.05
+    python -m benchmarks.replay_server --record recorded/*.xml
+"""
+import argparse
+import gzip
+import itertools
+import logging
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.siri_fixture import generate_delivery
+
+logger = logging.getLogger('togtider.replay')
+
+class Replay:
+    """
+    The responses to replay and the faults to inject into them.
+    """
+
+    def __init__(self, records=None, journeys=200, calls=20, refresh_seconds=60,
+                 latency_ms=0, jitter_ms=0, error_rate=0.0, error_status=503, seed=None):
+        """
+        Args:
+            records (list, optional): Paths of recorded deliveries, replayed in
+                turn; a synthetic delivery is generated when empty
+            journeys (int): Journeys in the synthetic delivery
+            calls (int): Recorded calls per synthetic journey
+            refresh_seconds (float): How often the synthetic delivery is
+                regenerated so that its departures stay upcoming
+            latency_ms (float): Delay before every response
+            jitter_ms (float): Extra delay, uniformly up to this much
+            error_rate (float): Share of requests answered with error_status
+            error_status (int): HTTP status of injected errors
+            seed (int, optional): Seed for the fault injection, for repeatable runs
+        """
+        self.journeys = journeys
+        self.calls = calls
+        self.refresh_seconds = refresh_seconds
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._records = None
+        self._synthetic = None
+        self._generated_at = 0.0
+        self.requests = 0
+        self.errors = 0
+        if records:
+            bodies = []
+            for path in records:
+                with open(path, "rb") as f:
+                    bodies.append(self._encode(f.read()))
+            self._records = itertools.cycle(bodies)
+
+    @staticmethod
+    def _encode(body):
+        # Compressed once up front, as the real endpoint serves gzip
+        return body, gzip.compress(body, compresslevel=6)
+
+    def next_body(self):
+        """
+        Returns:
+            tuple: (plain body, gzip-compressed body) of the next response
+        """
+        with self._lock:
+            if self._records is not None:
+                return next(self._records)
+            if self._synthetic is None or time.monotonic() - self._generated_at >= self.refresh_seconds:
+                self._synthetic = self._encode(generate_delivery(self.journeys, self.calls).encode("utf-8"))
+                self._generated_at = time.monotonic()
+            return self._synthetic
+
+    def next_fault(self):
+        """
+        Returns:
+            tuple: (seconds to wait, True if the request should fail)
+        """
+        with self._lock:
+            self.requests += 1
+            delay = (self.latency_ms + self._random.uniform(0, self.jitter_ms)) / 1000
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        return delay, failed
+
+class _ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        replay = self.server.replay
+        # Read the request body so the connection can be reused
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        delay, failed = replay.next_fault()
+        if delay:
+            time.sleep(delay)
+        if failed:
+            body = b"Injected error"
+            self.send_response(replay.error_status)
+            self.send_header("Content-Type", "text/plain")
+        else:
+            plain, compressed = replay.next_body()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/xml; charset=utf-8")
+            if "gzip" in (self.headers.get("Accept-Encoding") or ""):
+                body = compressed
+                self.send_header("Content-Encoding", "gzip")
+            else:
+                body = plain
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+class ReplayServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, replay):
+        super().__init__(address, _ReplayHandler)
+        self.replay = replay
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve recorded or synthetic SIRI-ET deliveries for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--record", nargs="+", help="Recorded delivery files to replay in turn")
+    parser.add_argument("--journeys", type=int, default=200, help="Journeys in the synthetic delivery")
+    parser.add_argument("--calls", type=int, default=20, help="Recorded calls per synthetic journey")
+    parser.add_argument("--refresh-seconds", type=float, default=60,
+                        help="How often the synthetic delivery is regenerated")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Delay before every response")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="Extra random delay, up to this much")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests to fail, 0 to 1")
+    parser.add_argument("--error-status", type=int, default=503, help="HTTP status of injected errors")
+    parser.add_argument("--seed", type=int, help="Seed for the injected faults")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    replay = Replay(
+        records=args.record,
+        journeys=args.journeys,
+        calls=args.calls,
+        refresh_seconds=args.refresh_seconds,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        seed=args.seed,
+    )
+    server = ReplayServer((args.host, args.port), replay)
+    logger.info(f"Replaying SIRI-ET on http://{args.host}:{server.server_port}/rest")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info(f"Answered {replay.requests} requests, {replay.errors} with injected errors")
+
+if __name__ == "__main__":
+    main()
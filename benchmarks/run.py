@@ -0,0 +1,212 @@
+# benchmarks/run.py
+"""
+Benchmarks for the parse, timeline, board query, next-N query and format
+stages of the service.
+
+Generates synthetic SIRI-ET deliveries at the requested scales and times
+each stage separately, then measures peak memory and retained allocations
+in a second, traced run so that tracing does not distort the timings.
+
+Usage:
+    python -m benchmarks.run
+    python -m benchmarks.run --journeys 100 1000 --calls 20 --repeat 10
+    python -m benchmarks.run --compare benchmarks/results/previous.json
+    python -m benchmarks.run --xml-backend stdlib
+    python -m benchmarks.run --journeys 20000 --parse-workers 4
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+from jattavagen_departures import parallel_parse, parse_data
+from jattavagen_departures.config import DEFAULT_STATION, XML_BACKEND
+from jattavagen_departures.parse_data import parse_stop_index
+from jattavagen_departures.xml_backend import BACKENDS, select_backend
+from jattavagen_departures.query import DepartureTimeline
+from jattavagen_departures.service import format_departures, query_departures
+from benchmarks.siri_fixture import generate_delivery
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+def _stages(xml, station, parse_workers=0):
+    """
+    Returns the stages to benchmark as (name, setup) pairs, where setup
+    returns a zero-argument callable running the stage on prepared input.
+    With parse_workers, a sharded parse on that many processes is added.
+    """
+    def parse():
+        return lambda: parse_stop_index(xml)
+    
+    def timeline():
+        departures = parse_stop_index(xml).freeze().for_station(station)
+        return lambda: DepartureTimeline(departures)
+    
+    def full_board():
+        index = parse_stop_index(xml).freeze()
+        query_departures(index, station)  # Sorts the station once
+        return lambda: query_departures(index, station)
+    
+    def next_three():
+        index = parse_stop_index(xml).freeze()
+        query_departures(index, station, limit=3)  # Sorts the station once
+        return lambda: query_departures(index, station, limit=3)
+    
+    def format_board():
+        upcoming = query_departures(parse_stop_index(xml).freeze(), station)
+        return lambda: format_departures(upcoming)
+    
+    def parse_sharded():
+        return lambda: parallel_parse.parse_stop_index_parallel(xml, workers=parse_workers, min_size=0)
+    
+    stages = [("parse", parse), ("timeline", timeline), ("full_board", full_board), ("next_three", next_three),
+              ("format", format_board)]
+    if parse_workers:
+        stages.insert(1, ("parse_sharded", parse_sharded))
+    return stages
+
+def _measure_memory(run):
+    """
+    Runs a stage once under tracemalloc.
+    
+    Returns:
+        tuple: (peak bytes allocated during the run, blocks still held by its result)
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        result = run()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    retained = sum(max(stat.count_diff, 0) for stat in after.compare_to(before, "filename"))
+    del result
+    return peak, retained
+
+def bench_scale(journeys, calls, repeat, station=DEFAULT_STATION, parse_workers=0):
+    """
+    Benchmarks every stage for one delivery size.
+    
+    Returns:
+        list: One result dictionary per stage
+    """
+    # Start half the delivery in the past so the board is never empty
+    start = datetime.now(timezone.utc).replace(microsecond=0) - timedelta(minutes=journeys * 3 // 2)
+    xml = generate_delivery(journeys=journeys, calls_per_journey=calls, start=start, headway_minutes=3)
+    index = parse_stop_index(xml)
+    departures = index.departure_count()
+    board = sum(len(group) for group in query_departures(index.freeze(), station).values())
+    
+    results = []
+    for name, setup in _stages(xml, station, parse_workers):
+        run = setup()
+        run()  # Warm up caches before timing
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - start)
+        peak, retained = _measure_memory(run)
+        
+        best = min(timings)
+        parsing = name.startswith("parse")
+        items = departures if parsing else board
+        results.append({
+            "stage": name,
+            "journeys": journeys,
+            "calls_per_journey": calls,
+            "xml_bytes": len(xml.encode("utf-8")),
+            "items": items,
+            "best_seconds": best,
+            "median_seconds": statistics.median(timings),
+            "items_per_second": items / best if best else None,
+            "mb_per_second": len(xml.encode("utf-8")) / best / 1e6 if parsing and best else None,
+            "peak_bytes": peak,
+            "retained_blocks": retained,
+        })
+    return results
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(current, previous):
+    """
+    Prints the change in best time per stage and scale against an earlier run.
+    """
+    def key(result):
+        return (result["stage"], result["journeys"], result["calls_per_journey"])
+    
+    old = {key(r): r for r in previous["results"]}
+    print(f"\nCompared with {previous.get('revision') or 'previous run'} ({previous.get('timestamp')}):")
+    for result in current["results"]:
+        before = old.get(key(result))
+        if before is None:
+            continue
+        ratio = result["best_seconds"] / before["best_seconds"] if before["best_seconds"] else float("nan")
+        print(f"  {result['stage']:<12} {result['journeys']:>6}x{result['calls_per_journey']:<4} {ratio:6.2f}x time")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the togtider parse, timeline, board query, next-N query and format stages")
+    parser.add_argument("--journeys", type=int, nargs="+", default=[10, 100, 1000],
+                        help="Journeys per delivery, one benchmark per value")
+    parser.add_argument("--calls", type=int, default=20, help="Recorded calls per journey")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per stage")
+    parser.add_argument("--station", default=DEFAULT_STATION, help="Station for the timeline, query and format stages")
+    parser.add_argument("--output", help="Where to write the JSON results (default: benchmarks/results/)")
+    parser.add_argument("--compare", help="Earlier JSON results to compare against")
+    parser.add_argument("--xml-backend", default=XML_BACKEND, choices=["auto", *BACKENDS],
+                        help="XML parser for the parse stage (default: XML_BACKEND)")
+    parser.add_argument("--parse-workers", type=int, default=0,
+                        help="Also time parsing sharded over this many processes")
+    args = parser.parse_args(argv)
+    parse_data._xml = select_backend(args.xml_backend)
+    
+    # The service logs every call, which would dominate the timings
+    logging.disable(logging.INFO)
+    
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "revision": _git_revision(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "xml_backend": parse_data._xml.name,
+        "parse_workers": args.parse_workers,
+        "results": [],
+    }
+    print(f"{'stage':<12} {'journeys':>8} {'calls':>5} {'best ms':>9} {'items/s':>11} {'peak KiB':>9} {'blocks':>7}")
+    for journeys in args.journeys:
+        for result in bench_scale(journeys, args.calls, args.repeat, args.station, args.parse_workers):
+            report["results"].append(result)
+            print(f"{result['stage']:<12} {journeys:>8} {args.calls:>5} {result['best_seconds'] * 1000:>9.2f} "
+                  f"{result['items_per_second'] or 0:>11.0f} {result['peak_bytes'] / 1024:>9.0f} {result['retained_blocks']:>7}")
+    
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"bench-{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {output}")
+    parallel_parse.shutdown_pool()
+    
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(report, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# benchmarks/siri_fixture.py
+"""
+Synthetic SIRI-ET deliveries for benchmarks and tests.
+
+The generated XML has the same structure as a Bane NOR EstimatedTimetable
+delivery as read by jattavagen_departures.parse_data: one
+EstimatedJourneyVersionFrame holding EstimatedVehicleJourney elements, each
+with a journey reference, LineRef, DirectionRef, DestinationName and a list
+of RecordedCalls.
+"""
+from datetime import datetime, timedelta, timezone
+
+# Quays the calls of each journey cycle through. Jåttåvågen's quays are
+# included so that station queries against the fixture return departures.
+DEFAULT_QUAYS = ["NSR:Quay:600", "NSR:Quay:603", "NSR:Quay:609", "NSR:Quay:607", "NSR:Quay:612", "NSR:Quay:615"]
+
+def generate_delivery(journeys=100, calls_per_journey=10, start=None, headway_minutes=3,
+                      call_interval_minutes=2, delay_every=3, quays=None, lines=1):
+    """
+    Generates a SIRI-ET delivery.
+    
+    Args:
+        journeys (int): Number of EstimatedVehicleJourney elements
+        calls_per_journey (int): Number of RecordedCall elements per journey
+        start (datetime, optional): Aimed departure of the first call of the
+            first journey, defaults to one hour ago so that roughly the
+            later half of a wide delivery is still upcoming
+        headway_minutes (int): Minutes between the starts of consecutive journeys
+        call_interval_minutes (int): Minutes between consecutive calls of a journey
+        delay_every (int): Every n-th journey is two minutes late, 0 for none
+        quays (list, optional): StopPointRefs the calls cycle through
+        lines (int): Number of distinct LineRefs the journeys are spread over
+        
+    Returns:
+        str: The XML document
+    """
+    quays = quays or DEFAULT_QUAYS
+    if start is None:
+        start = datetime.now(timezone.utc).replace(microsecond=0) - timedelta(hours=1)
+    operating_day = start.date().isoformat()
+    
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<Siri xmlns="http://www.siri.org.uk/siri" version="2.1">\n'
+        '<ServiceDelivery><EstimatedTimetableDelivery version="2.1">\n'
+        '<EstimatedJourneyVersionFrame>\n'
+    ]
+    for j in range(journeys):
+        northbound = j % 2 == 1
+        direction = "STV" if northbound else "EGS"
+        destination = "Stavanger" if northbound else "Egersund"
+        delay = timedelta(minutes=2) if delay_every and j % delay_every == 0 else timedelta(0)
+        journey_start = start + timedelta(minutes=j * headway_minutes)
+        
+        parts.append(
+            "<EstimatedVehicleJourney>"
+            f"<LineRef>GOA:Line:{59 + j % lines}</LineRef>"
+            f"<DirectionRef>{direction}</DirectionRef>"
+            "<FramedVehicleJourneyRef>"
+            f"<DataFrameRef>{operating_day}</DataFrameRef>"
+            f"<DatedVehicleJourneyRef>GOA:ServiceJourney:{j}</DatedVehicleJourneyRef>"
+            "</FramedVehicleJourneyRef>"
+            f"<DestinationName>{destination}</DestinationName>"
+            "<RecordedCalls>"
+        )
+        for c in range(calls_per_journey):
+            quay = quays[(len(quays) - 1 - c) % len(quays)] if northbound else quays[c % len(quays)]
+            aimed = journey_start + timedelta(minutes=c * call_interval_minutes)
+            parts.append(
+                "<RecordedCall>"
+                f"<StopPointRef>{quay}</StopPointRef>"
+                f"<AimedDepartureTime>{aimed.isoformat()}</AimedDepartureTime>"
+                f"<ActualDepartureTime>{(aimed + delay).isoformat()}</ActualDepartureTime>"
+                "</RecordedCall>"
+            )
+        parts.append("</RecordedCalls></EstimatedVehicleJourney>\n")
+    parts.append("</EstimatedJourneyVersionFrame>\n</EstimatedTimetableDelivery></ServiceDelivery>\n</Siri>\n")
+    return "".join(parts)
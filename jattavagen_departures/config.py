@@ -8,3 +8,167 @@ SUBSCRIPTION_KEY = "489ebc3200d24f19849bc9382d0dbe67"
 
 # (Optional) Your RequestorRef
 REQUESTOR_REF = "YOUR_UNIQUE_REF"
+
+# Number of seconds a fetched timetable is reused before asking the API again
+CACHE_TTL_SECONDS = 30
+
+# Parse the response while it is being downloaded instead of buffering it
+# first, in both the threaded and the event loop (server.py) fetch paths
+STREAMING_PARSE = False
+
+# Size in bytes of each chunk read from the response when streaming
+STREAM_CHUNK_SIZE = 16384
+
+# Quays (StopPointRefs) that make up each station, used to answer
+# departures per station from a single parsed delivery
+STATIONS = {
+    "Jåttåvågen": ["NSR:Quay:609", "NSR:Quay:607"],
+}
+
+# Station used when a caller does not ask for a specific one
+DEFAULT_STATION = "Jåttåvågen"
+
+# Time zone departure times are shown in, and assumed for timestamps
+# from the API that carry no UTC offset
+DISPLAY_TIMEZONE = "Europe/Oslo"
+
+# Maximum number of keep-alive connections kept open to the API
+HTTP_POOL_SIZE = 10
+
+# Number of times a failed request is retried before giving up
+HTTP_RETRIES = 1
+
+# Seconds allowed for establishing a connection to the API
+HTTP_CONNECT_TIMEOUT = 2
+
+# Total seconds a refresh may spend connecting and waiting for the API across
+# all attempts. Each attempt gets HTTP_TIMEOUT_SECONDS / (HTTP_RETRIES + 1),
+# of which HTTP_CONNECT_TIMEOUT is for connecting and the rest is the read
+# timeout (the longest gap allowed between received bytes). Callers waiting
+# on the cache during a refresh see the same worst case.
+HTTP_TIMEOUT_SECONDS = 10
+
+# Refresh the timetable in a background thread so tool calls only read memory
+PREFETCH_ENABLED = False
+
+# Seconds between background refreshes when a train leaves within
+# PREFETCH_BUSY_WINDOW_MINUTES, otherwise, and during PREFETCH_NIGHT_HOURS
+PREFETCH_INTERVAL_SECONDS = 15
+PREFETCH_IDLE_INTERVAL_SECONDS = 60
+PREFETCH_NIGHT_INTERVAL_SECONDS = 300
+PREFETCH_BUSY_WINDOW_MINUTES = 15
+
+# Local hours (start, end) treated as night by the background refresher
+PREFETCH_NIGHT_HOURS = (1, 5)
+
+# Keep per-journey state between polls and only ask the API for journeys that
+# changed since the previous poll, merging them into that state
+INCREMENTAL_UPDATES = False
+
+# Seconds between complete refreshes when INCREMENTAL_UPDATES is enabled
+FULL_REFRESH_INTERVAL_SECONDS = 600
+
+# Minutes after its last departure that a journey is kept in memory
+JOURNEY_RETENTION_MINUTES = 30
+
+# Operator, (LineRef, DirectionRef) pairs and StopPointRefs to request. They
+# are packed into as few requests as the per-request limits below allow, and
+# the results are combined into one index that answers every station.
+OPERATOR_REF = "GOA"
+LINE_DIRECTIONS = [
+    ("GOA:Line:59", "EGS"),
+]
+REQUEST_STOP_REFS = ["NSR:Quay:609"]
+
+# Maximum LineDirection and StopPointRef entries in a single request
+MAX_LINES_PER_REQUEST = 10
+MAX_STOPS_PER_REQUEST = 10
+
+# Path of the Prometheus metrics endpoint served next to the SSE endpoint
+METRICS_PATH = "/metrics"
+
+# File the last good snapshot is persisted to, so that a restarted process
+# can answer its first request without waiting for the API. None disables it.
+SNAPSHOT_PATH = None
+
+# Serve an expired snapshot (marked as stale) while a refresh runs in the
+# background, instead of making callers wait for or fail with the API
+STALE_WHILE_REVALIDATE = False
+
+# Send a duplicate request when the first has not answered within
+# HEDGE_PERCENTILE of the last 100 fetch latencies; the first response wins.
+# Needs HEDGE_MIN_SAMPLES fetches before it starts, and never hedges the
+# incremental polls of INCREMENTAL_UPDATES.
+HEDGE_ENABLED = False
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY_SECONDS = 0.2
+HEDGE_MAX_REQUESTS = 2
+
+# Seconds the MCP tool waits for departures before answering with a stale
+# snapshot or a timeout error. None waits for the refresh to finish.
+TOOL_DEADLINE_SECONDS = None
+
+# Unix socket of the warm daemon (python -m jattavagen_departures.daemon)
+# that mcp_tool.py hands tool calls to. None uses a per-user path in
+# $XDG_RUNTIME_DIR or the temp directory.
+DAEMON_SOCKET_PATH = None
+DAEMON_CONNECT_TIMEOUT_SECONDS = 0.5
+DAEMON_REPLY_TIMEOUT_SECONDS = 15
+
+# Directory shared by several worker processes on one host. One elected
+# worker fetches from the API and publishes the snapshot there; the others
+# read it instead of fetching. None gives every process its own cache.
+SHARED_CACHE_DIR = None
+
+# Seconds between checks for a newly published shared snapshot
+SHARED_CACHE_POLL_SECONDS = 1
+
+# XML parser: "stdlib" (xml.etree), "lxml" (needs the optional lxml
+# package), or "auto" for lxml when it is installed, with streamed responses
+# (STREAMING_PARSE) left to the stdlib parser. lxml builds trees faster but
+# the parse as a whole is about as fast, so the stdlib is the default.
+XML_BACKEND = "stdlib"
+
+# Directory for the archive of observed departures that the togtider_history
+# tool answers delay questions from. None keeps no history.
+HISTORY_DIR = None
+
+# Seconds between looking for departures archived by other processes
+# sharing HISTORY_DIR
+HISTORY_RESCAN_SECONDS = 10
+
+# Seconds between checks for changes to the boards MCP clients subscribe to
+# (togtider://departures/{station}/{direction}); a check refreshes the
+# snapshot when it is older than CACHE_TTL_SECONDS
+SUBSCRIPTION_POLL_SECONDS = 10
+
+# Worker processes that large deliveries, e.g. one covering the whole
+# operator network, are parsed on, split into shards of whole journeys.
+# 0 parses every delivery in the calling thread; None starts one process
+# per CPU.
+PARALLEL_PARSE_WORKERS = 0
+
+# Deliveries shorter than this many characters are parsed in the calling
+# thread even with PARALLEL_PARSE_WORKERS set, as handing a single line's
+# delivery to the workers costs more than it saves
+PARALLEL_PARSE_MIN_SIZE = 4_000_000
+
+# Minutes ahead each poll asks the API for departures (PreviewInterval)
+PREVIEW_INTERVAL_MINUTES = 120
+
+# Narrow the PreviewInterval to how far ahead recent callers actually
+# looked, e.g. next-N queries, to shrink responses. A query that gets fewer
+# departures than its limit widens it again at once. Only used when each
+# process fetches its own full deliveries (no SHARED_CACHE_DIR or
+# INCREMENTAL_UPDATES).
+ADAPTIVE_PREVIEW = True
+PREVIEW_MIN_MINUTES = 30
+PREVIEW_STEP_MINUTES = 15
+
+# Polls whose callers the narrowed window has to cover
+PREVIEW_DEMAND_POLLS = 10
+
+# Formatted boards kept per snapshot, one per distinct query (station, line,
+# limit, direction, destination, time); the least recently used go first
+BOARD_CACHE_SIZE = 256
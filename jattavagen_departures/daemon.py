@@ -0,0 +1,238 @@
+# jattavagen_departures/daemon.py
+"""
+Warm daemon for mcp_tool.py.
+
+One long-lived process keeps the pooled HTTP connection and the cached
+snapshot, and answers tool calls over a Unix socket. Each request and reply
+is a single line of JSON. mcp_tool.py connects with request_daemon() and
+runs the tool in its own process when no daemon is listening.
+
+This module only imports the standard library and the config at import
+time, so the client side stays cheap; the service is imported when a
+request is actually answered.
+"""
+import getpass
+import json
+import logging
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+from .config import (
+    DAEMON_SOCKET_PATH,
+    DAEMON_CONNECT_TIMEOUT_SECONDS,
+    DAEMON_REPLY_TIMEOUT_SECONDS,
+    DEFAULT_STATION,
+    PREFETCH_ENABLED,
+    TOOL_DEADLINE_SECONDS,
+)
+
+# Set up logging
+logger = logging.getLogger('togtider.daemon')
+
+# Upper bound on a request line, which only carries the tool context
+MAX_REQUEST_BYTES = 64 * 1024
+
+def socket_path():
+    """
+    Returns:
+        str: DAEMON_SOCKET_PATH, or a per-user path in the runtime directory
+    """
+    if DAEMON_SOCKET_PATH:
+        return DAEMON_SOCKET_PATH
+    directory = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    user = os.getuid() if hasattr(os, "getuid") else getpass.getuser()
+    return os.path.join(directory, f"togtider-{user}.sock")
+
+def _board(context):
+    from .service import get_departure_board
+
+    context = context or {}
+    station = context.get("station", DEFAULT_STATION)
+    board = get_departure_board(
+        station,
+        timeout=TOOL_DEADLINE_SECONDS,
+        limit=context.get("limit"),
+        direction=context.get("direction"),
+        destination=context.get("destination"),
+        after=context.get("after"),
+    )
+    return board, station, context.get("since_version")
+
+def tool_response(context=None):
+    """
+    Runs the togtider tool in this process.
+
+    Args:
+        context (dict, optional): A 'station' key selects the station (or
+            StopPointRef) to get departures for. 'limit', 'direction',
+            'destination' and 'after' narrow it to the next departures, see
+            service.query_departures(). A 'since_version' key with
+            the version of an earlier response asks for a short
+            not-modified reply if the board has not changed since
+
+    Returns:
+        dict: JSON-compatible dictionary with departure information
+
+    Raises:
+        Exception: Passes through any exceptions from the underlying service
+    """
+    from .service import board_response
+
+    return board_response(*_board(context))
+
+def tool_response_json(context=None):
+    """
+    Like tool_response(), but returns the response already serialized.
+
+    Returns:
+        str: The response as JSON
+    """
+    from .service import board_response_json
+
+    return board_response_json(*_board(context))
+
+def error_response(error):
+    """
+    Returns:
+        dict: The error object returned to MCP instead of raising
+    """
+    return {
+        "error": True,
+        "message": str(error),
+        "type": type(error).__name__
+    }
+
+def request_daemon(context=None, path=None):
+    """
+    Asks a running daemon to answer a tool call.
+
+    Args:
+        context (dict, optional): Tool context, see tool_response()
+        path (str, optional): Socket to connect to, defaults to socket_path()
+
+    Returns:
+        dict: The daemon's response, or None if no daemon is listening
+
+    Raises:
+        OSError: If the daemon accepted the request but did not answer in time
+        ValueError: If the reply is not valid JSON
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    path = path or socket_path()
+    if not os.path.exists(path):
+        return None
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(DAEMON_CONNECT_TIMEOUT_SECONDS)
+        try:
+            sock.connect(path)
+        except OSError as e:
+            # A socket file left behind by a daemon that is gone
+            logger.debug(f"No daemon listening on {path}: {str(e)}")
+            return None
+
+        sock.settimeout(DAEMON_REPLY_TIMEOUT_SECONDS)
+        sock.sendall(json.dumps({"context": context}).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as reply:
+            line = reply.readline()
+
+    if not line:
+        logger.warning("Daemon closed the connection without answering")
+        return None
+    return json.loads(line)
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """Answers one JSON request line with one JSON response line."""
+
+    def handle(self):
+        line = self.rfile.readline(MAX_REQUEST_BYTES)
+        if not line:
+            return
+        try:
+            context = json.loads(line).get("context")
+            reply = tool_response_json(context)
+        except Exception as e:
+            logger.error(f"Error answering tool call: {str(e)}", exc_info=True)
+            reply = json.dumps(error_response(e), ensure_ascii=False)
+        self.wfile.write(reply.encode("utf-8") + b"\n")
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def _remove_stale_socket(path):
+    """
+    Raises:
+        RuntimeError: If another daemon is already listening on the path
+    """
+    if not os.path.exists(path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            os.unlink(path)
+            return
+    raise RuntimeError(f"A daemon is already listening on {path}")
+
+def create_server(path=None):
+    """
+    Binds the daemon's socket, readable and writable by the current user only.
+
+    Args:
+        path (str, optional): Socket to listen on, defaults to socket_path()
+
+    Returns:
+        DaemonServer: The bound server; call serve_forever() to answer requests
+    """
+    path = path or socket_path()
+    _remove_stale_socket(path)
+    old_umask = os.umask(0o177)
+    try:
+        server = DaemonServer(path, _RequestHandler)
+    finally:
+        os.umask(old_umask)
+    logger.info(f"Listening on {path}")
+    return server
+
+def _warm_up():
+    from .service import refresh_departures
+    try:
+        refresh_departures()
+    except Exception as e:
+        logger.warning(f"Initial refresh failed, the first request will retry: {str(e)}")
+
+def serve(path=None):
+    """
+    Runs the daemon until interrupted.
+
+    The first snapshot is loaded straight away, and kept fresh by the
+    background prefetcher when PREFETCH_ENABLED is set.
+
+    Args:
+        path (str, optional): Socket to listen on, defaults to socket_path()
+    """
+    from .prefetch import start_prefetcher, stop_prefetcher
+
+    server = create_server(path)
+    if PREFETCH_ENABLED:
+        start_prefetcher()
+    else:
+        threading.Thread(target=_warm_up, name="togtider-warm-up", daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(server.server_address)
+        stop_prefetcher()
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    serve()
@@ -1,26 +1,352 @@
 # jattavagen_departures/fetch_data.py
+import asyncio
 import logging
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import httpx
 import requests
-from .config import API_ENDPOINT, SUBSCRIPTION_KEY, REQUESTOR_REF
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .config import (
+    API_ENDPOINT,
+    SUBSCRIPTION_KEY,
+    REQUESTOR_REF,
+    STREAM_CHUNK_SIZE,
+    HTTP_POOL_SIZE,
+    HTTP_RETRIES,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_TIMEOUT_SECONDS,
+    OPERATOR_REF,
+    LINE_DIRECTIONS,
+    REQUEST_STOP_REFS,
+    MAX_LINES_PER_REQUEST,
+    MAX_STOPS_PER_REQUEST,
+    HEDGE_ENABLED,
+    HEDGE_PERCENTILE,
+    HEDGE_MIN_SAMPLES,
+    HEDGE_MIN_DELAY_SECONDS,
+    HEDGE_MAX_REQUESTS,
+    PREVIEW_INTERVAL_MINUTES,
+    PREVIEW_MIN_MINUTES,
+    PREVIEW_STEP_MINUTES,
+    PREVIEW_DEMAND_POLLS,
+)
+from .metrics import (
+    FETCH_SECONDS, HEDGED_REQUESTS, RESPONSE_BYTES, RESPONSE_SAVED_BYTES, RESPONSE_WIRE_BYTES, record_upstream_error
+)
 from datetime import datetime
+from xml.sax.saxutils import escape
 
 # Set up logging
 logger = logging.getLogger('togtider.fetch')
 
-def fetch_timetable():
+HEADERS = {
+    "Content-Type": "application/xml",
+    "Ocp-Apim-Subscription-Key": SUBSCRIPTION_KEY,
+    # SIRI XML is highly repetitive and compresses very well
+    "Accept-Encoding": "gzip",
+}
+
+def request_timeout(retries=HTTP_RETRIES, total=HTTP_TIMEOUT_SECONDS, connect=HTTP_CONNECT_TIMEOUT):
     """
-    Fetches timetable data from the Bane NOR API.
+    Splits the total time budget of a refresh over the attempts made by the
+    retry adapter, so retrying never waits longer than a single try used to.
     
-    Returns:
-        str: XML response text from the API
+    Args:
+        retries (int): Number of retries configured on the session
+        total (float): Seconds allowed across all attempts
+        connect (float): Connect timeout for each attempt
         
+    Returns:
+        tuple: (connect timeout, read timeout) in seconds for each attempt
+    """
+    per_attempt = total / (retries + 1)
+    connect = min(connect, per_attempt / 2)
+    return (connect, per_attempt - connect)
+
+def remaining_budget(deadline, total=HTTP_TIMEOUT_SECONDS):
+    """
+    Args:
+        deadline (float): time.monotonic() value by which the caller needs
+            an answer, or None for no deadline
+        total (float): Budget to use when there is no deadline
+
+    Returns:
+        float: Seconds left, capped at the configured total budget
+
     Raises:
-        requests.RequestException: If the API request fails
-        ValueError: If there's an issue with the API response
+        TimeoutError: If the deadline has already passed
+    """
+    if deadline is None:
+        return total
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError("Deadline exceeded before the request was sent")
+    return min(remaining, total)
+
+def create_session(pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES, idempotent=True):
+    """
+    Creates a requests session with a keep-alive connection pool and retries.
+    
+    Reusing the session avoids paying DNS, TCP and TLS handshakes on every
+    refresh. The EstimatedTimetableRequest only reads data, so POSTs are
+    safe to retry on connection errors and transient gateway errors. Use
+    request_timeout() for the per-attempt timeouts so the retries stay within
+    HTTP_TIMEOUT_SECONDS.
+    
+    Requests with a RequestorRef are not idempotent: the upstream marks the
+    changes it answers with as delivered, so a retry after the request was
+    sent would get an empty delta. Their session only retries connection
+    errors, where nothing has been sent yet.
+    
+    Args:
+        pool_size (int): Maximum number of pooled connections per host
+        retries (int): Number of retries for failed requests
+        idempotent (bool): False to never resend a request that may have
+            reached the server
+        
+    Returns:
+        requests.Session: The configured session
+    """
+    if idempotent:
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.2,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({"POST"}),
+            raise_on_status=False,
+        )
+    else:
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=0,
+            other=0,
+            backoff_factor=0.2,
+            allowed_methods=frozenset({"POST"}),
+            raise_on_status=False,
+        )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(HEADERS)
+    return session
+
+# Shared by all fetches in this process
+_session = create_session()
+# For requests with a RequestorRef, see create_session()
+_requestor_session = create_session(idempotent=False)
+
+def _session_for(requestor_ref):
+    return _session if requestor_ref is None else _requestor_session
+
+# Sizes of the most recent response and running totals
+_transfer_lock = threading.Lock()
+_transfer_stats = {
+    "last_bytes_on_wire": 0,
+    "last_decoded_bytes": 0,
+    "last_content_encoding": None,
+    "total_bytes_on_wire": 0,
+    "total_decoded_bytes": 0,
+    "responses": 0,
+    "last_preview_minutes": None,
+    "saved_bytes_on_wire": 0,
+    "saved_decoded_bytes": 0,
+}
+
+# Sizes of the latest full-window response per batch, which responses to
+# narrower windows are compared against
+_full_window_sizes = {}
+
+def _batch_key(batch):
+    line_directions, stop_refs = batch if batch is not None else plan_batches()[0]
+    return tuple(map(tuple, line_directions)), tuple(stop_refs)
+
+def _record_savings(batch, preview_minutes, wire_bytes, decoded_bytes):
+    """
+    Must be called with _transfer_lock held.
+
+    Returns:
+        tuple: (wire, decoded) bytes saved against the latest response to
+               the same batch with the full PREVIEW_INTERVAL_MINUTES window
+    """
+    key = _batch_key(batch)
+    if preview_minutes >= PREVIEW_INTERVAL_MINUTES:
+        _full_window_sizes[key] = (wire_bytes, decoded_bytes)
+        return 0, 0
+    full = _full_window_sizes.get(key)
+    if full is None:
+        return 0, 0
+    return max(full[0] - wire_bytes, 0), max(full[1] - decoded_bytes, 0)
+
+def _record_transfer(response, decoded_bytes, wire_bytes=None, batch=None, preview_minutes=None):
+    """
+    Records how many bytes were received on the wire versus after decoding,
+    and how many a narrowed preview window saved.
+    
+    Args:
+        response (requests.Response or httpx.Response): A fully consumed response
+        decoded_bytes (int): Size of the decoded body
+        wire_bytes (int, optional): Bytes received on the wire, if already known.
+            For requests responses this is read from the underlying connection.
+        batch (tuple, optional): Lines and stops the response is for
+        preview_minutes (int, optional): PreviewInterval it was requested with
+    """
+    if wire_bytes is None:
+        try:
+            wire_bytes = int(response.raw.tell())
+        except (AttributeError, TypeError, ValueError):
+            wire_bytes = decoded_bytes
+    encoding = response.headers.get("Content-Encoding")
+    RESPONSE_BYTES.observe(decoded_bytes)
+    RESPONSE_WIRE_BYTES.observe(wire_bytes)
+    
+    preview_minutes = preview_minutes or PREVIEW_INTERVAL_MINUTES
+    
+    with _transfer_lock:
+        saved_wire, saved_decoded = _record_savings(batch, preview_minutes, wire_bytes, decoded_bytes)
+        _transfer_stats["last_preview_minutes"] = preview_minutes
+        _transfer_stats["saved_bytes_on_wire"] += saved_wire
+        _transfer_stats["saved_decoded_bytes"] += saved_decoded
+        _transfer_stats["last_bytes_on_wire"] = wire_bytes
+        _transfer_stats["last_decoded_bytes"] = decoded_bytes
+        _transfer_stats["last_content_encoding"] = encoding
+        _transfer_stats["total_bytes_on_wire"] += wire_bytes
+        _transfer_stats["total_decoded_bytes"] += decoded_bytes
+        _transfer_stats["responses"] += 1
+    
+    if saved_wire or saved_decoded:
+        RESPONSE_SAVED_BYTES.inc(saved_wire, measure="wire")
+        RESPONSE_SAVED_BYTES.inc(saved_decoded, measure="decoded")
+    logger.debug(f"Received {wire_bytes} bytes on the wire ({encoding or 'identity'}), {decoded_bytes} bytes decoded "
+                 f"for {preview_minutes} minutes, {saved_wire} fewer on the wire than the full window")
+
+def get_transfer_stats():
+    """
+    Returns:
+        dict: Bytes on the wire and decoded bytes for the last response,
+              plus totals since startup, and the bytes narrowed preview
+              windows saved against full-window responses
+    """
+    with _transfer_lock:
+        return dict(_transfer_stats)
+
+def _chunks(items, size):
+    """Splits a list into consecutive pieces of at most size items."""
+    size = max(1, size)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def plan_batches(line_directions=LINE_DIRECTIONS, stop_refs=REQUEST_STOP_REFS,
+                 max_lines=MAX_LINES_PER_REQUEST, max_stops=MAX_STOPS_PER_REQUEST):
+    """
+    Packs the requested lines and stops into as few requests as the
+    per-request limits allow.
+    
+    Args:
+        line_directions (list): (LineRef, DirectionRef) pairs
+        stop_refs (list): StopPointRefs to filter on, may be empty
+        max_lines (int): Maximum LineDirection entries per request
+        max_stops (int): Maximum StopPointRef entries per request
+        
+    Returns:
+        list: (line_directions, stop_refs) tuples, one per request
+    """
+    line_chunks = _chunks(list(line_directions), max_lines) or [[]]
+    stop_chunks = _chunks(list(stop_refs), max_stops) or [[]]
+    return [(lines, stops) for lines in line_chunks for stops in stop_chunks]
+
+class PreviewWindow:
+    """
+    How many minutes ahead polls ask for, narrowed to what callers need.
+
+    Callers report how far ahead the departures they were given reached
+    (need()). Each poll covers the furthest need of the last few polls plus
+    the time its snapshot is served for, rounded up to whole steps. Until
+    anything has been reported, polls ask for the maximum.
     """
+
+    def __init__(self, minimum=PREVIEW_MIN_MINUTES, maximum=PREVIEW_INTERVAL_MINUTES,
+                 step=PREVIEW_STEP_MINUTES, polls=PREVIEW_DEMAND_POLLS, slack=0.0):
+        """
+        Args:
+            minimum (int): Narrowest window in minutes
+            maximum (int): Widest window in minutes
+            step (int): Windows are whole multiples of this many minutes
+            polls (int): Polls whose needs the window has to cover
+            slack (float): Minutes added for the time a snapshot is served
+        """
+        self.minimum = min(minimum, maximum)
+        self.maximum = maximum
+        self.step = max(step, 1)
+        self.slack = slack
+        self._needs = deque(maxlen=max(polls, 1))
+        self._pending = None
+        self._lock = threading.Lock()
+
+    def need(self, minutes):
+        """Records that a caller needed departures this many minutes ahead."""
+        with self._lock:
+            if self._pending is None or minutes > self._pending:
+                self._pending = minutes
+
+    def next_minutes(self):
+        """
+        Closes the needs reported since the previous poll.
+
+        Returns:
+            int: Minutes ahead the next poll should ask for
+        """
+        with self._lock:
+            if self._pending is not None:
+                self._needs.append(self._pending)
+                self._pending = None
+            if not self._needs:
+                return self.maximum
+            needed = max(self._needs) + self.slack
+        minutes = math.ceil(needed / self.step) * self.step
+        return int(min(max(minutes, self.minimum), self.maximum))
+
+    def clear(self):
+        with self._lock:
+            self._needs.clear()
+            self._pending = None
+
+def build_request(requestor_ref=None, batch=None, preview_minutes=None):
+    """
+    Builds the SIRI EstimatedTimetableRequest body for the current time.
+    
+    Args:
+        requestor_ref (str, optional): RequestorRef to send, defaults to
+            REQUESTOR_REF. The API remembers what it has already sent to
+            each requestor (see journey_state.JourneyState).
+        batch (tuple, optional): (line_directions, stop_refs) from
+            plan_batches(), defaults to the first planned batch
+        preview_minutes (int, optional): Minutes ahead to ask for, defaults
+            to PREVIEW_INTERVAL_MINUTES (see PreviewWindow)
+    
+    Returns:
+        bytes: UTF-8 encoded XML request body
+    """
+    line_directions, stop_refs = batch if batch is not None else plan_batches()[0]
+    
     # Generate current time in ISO format
     current_time_iso = datetime.utcnow().isoformat() + "Z"
-    logger.info(f"Fetching timetable at {current_time_iso}")
+    preview_minutes = preview_minutes or PREVIEW_INTERVAL_MINUTES
+    logger.info(f"Fetching timetable at {current_time_iso} for {len(line_directions)} lines and {len(stop_refs)} stops, "
+                f"{preview_minutes} minutes ahead")
+    
+    lines_xml = "".join(f"""
+        <LineDirection>
+          <LineRef>{escape(line_ref)}</LineRef>
+          <DirectionRef>{escape(direction_ref)}</DirectionRef>
+        </LineDirection>""" for line_ref, direction_ref in line_directions)
+    stops_xml = "".join(f"""
+      <StopPointRef>{escape(stop_ref)}</StopPointRef>""" for stop_ref in stop_refs)
     
     # Build the XML request body dynamically
     xml_request = f"""<?xml version="1.0" encoding="UTF-8"?>
@@ -29,37 +355,51 @@ def fetch_timetable():
       xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
   <ServiceRequest>
     <RequestTimestamp>{current_time_iso}</RequestTimestamp>
-    <RequestorRef>{REQUESTOR_REF}</RequestorRef>
+    <RequestorRef>{escape(requestor_ref or REQUESTOR_REF)}</RequestorRef>
     <EstimatedTimetableRequest version="1.1">
       <RequestTimestamp>{current_time_iso}</RequestTimestamp>
-      <PreviewInterval>PT120M</PreviewInterval>
-      <OperatorRef>GOA</OperatorRef>
-      <Lines>
-        <LineDirection>
-          <LineRef>GOA:Line:59</LineRef>
-          <DirectionRef>EGS</DirectionRef>
-        </LineDirection>
-      </Lines>
-      <StopPointRef>NSR:Quay:609</StopPointRef>
+      <PreviewInterval>PT{int(preview_minutes)}M</PreviewInterval>
+      <OperatorRef>{escape(OPERATOR_REF)}</OperatorRef>
+      <Lines>{lines_xml}
+      </Lines>{stops_xml}
     </EstimatedTimetableRequest>
   </ServiceRequest>
 </Siri>
 """
+    return xml_request.encode('utf-8')
 
-    headers = {
-        "Content-Type": "application/xml",
-        "Ocp-Apim-Subscription-Key": SUBSCRIPTION_KEY,
-    }
+def fetch_timetable(requestor_ref=None, batch=None, deadline=None, preview_minutes=None):
+    """
+    Fetches timetable data from the Bane NOR API.
     
+    Args:
+        requestor_ref (str, optional): RequestorRef to send, see build_request()
+        batch (tuple, optional): Lines and stops to request, see build_request()
+        deadline (float, optional): time.monotonic() value the request must
+            finish by; the timeouts are shortened to fit
+        preview_minutes (int, optional): Minutes ahead, see build_request()
+    
+    Returns:
+        str: XML response text from the API
+        
+    Raises:
+        requests.RequestException: If the API request fails
+        ValueError: If there's an issue with the API response
+        TimeoutError: If the deadline has already passed
+    """
     try:
         logger.debug(f"Sending request to {API_ENDPOINT}")
-        response = requests.post(
+        start = time.perf_counter()
+        response = _session_for(requestor_ref).post(
             API_ENDPOINT, 
-            data=xml_request.encode('utf-8'), 
-            headers=headers,
-            timeout=10  # Set a timeout to avoid hanging requests
+            data=build_request(requestor_ref, batch, preview_minutes), 
+            # Bounded across retries to avoid hanging requests
+            timeout=request_timeout(total=remaining_budget(deadline))
         )
         response.raise_for_status()
+        _latencies.record(time.perf_counter() - start)
+        FETCH_SECONDS.observe(time.perf_counter() - start)
+        _record_transfer(response, len(response.content), batch=batch, preview_minutes=preview_minutes)
         
         # Check if response is valid XML
         if not response.text.strip().startswith('<?xml'):
@@ -71,11 +411,384 @@ def fetch_timetable():
     
     except requests.RequestException as e:
         logger.error(f"API request failed: {str(e)}")
+        record_upstream_error(e)
         raise
     except Exception as e:
         logger.error(f"Unexpected error during fetch: {str(e)}", exc_info=True)
+        record_upstream_error(e)
+        raise
+
+def _check_xml_prolog(head):
+    """
+    Raises:
+        ValueError: If the start of a streamed response is not an XML declaration
+    """
+    if not head.startswith(b'<?xml'):
+        logger.error(f"Invalid XML response: {head[:100]!r}...")
+        raise ValueError("Invalid XML response received from API")
+
+def stream_timetable(chunk_size=STREAM_CHUNK_SIZE, requestor_ref=None, batch=None, preview_minutes=None):
+    """
+    Fetches timetable data from the Bane NOR API without buffering the body.
+    
+    The response is yielded in chunks as they arrive so that parsing can start
+    before the download has finished (see parse_data.iter_departures()).
+    
+    Args:
+        chunk_size (int): Maximum number of bytes per yielded chunk
+        requestor_ref (str, optional): RequestorRef to send, see build_request()
+        batch (tuple, optional): Lines and stops to request, see build_request()
+        preview_minutes (int, optional): Minutes ahead, see build_request()
+        
+    Yields:
+        bytes: Consecutive chunks of the decoded XML response body
+        
+    Raises:
+        requests.RequestException: If the API request fails
+        ValueError: If there's an issue with the API response
+    """
+    try:
+        logger.debug(f"Sending streaming request to {API_ENDPOINT}")
+        start = time.perf_counter()
+        with _session_for(requestor_ref).post(
+            API_ENDPOINT,
+            data=build_request(requestor_ref, batch, preview_minutes),
+            timeout=request_timeout(),
+            stream=True
+        ) as response:
+            response.raise_for_status()
+            logger.debug(f"Response received, status code: {response.status_code}")
+            
+            # Hold back the start of the body until the XML declaration can
+            # be checked, since a small chunk may split it
+            head = b""
+            decoded_bytes = 0
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                decoded_bytes += len(chunk)
+                if head is not None:
+                    head = (head + chunk).lstrip()
+                    if len(head) < len(b'<?xml'):
+                        continue
+                    _check_xml_prolog(head)
+                    chunk, head = head, None
+                yield chunk
+            if head is not None:
+                _check_xml_prolog(head)
+                yield head
+            # Includes the time the consumer spent parsing between chunks
+            FETCH_SECONDS.observe(time.perf_counter() - start)
+            _record_transfer(response, decoded_bytes, batch=batch, preview_minutes=preview_minutes)
+    
+    except (requests.RequestException, ValueError) as e:
+        logger.error(f"API request failed: {str(e)}")
+        record_upstream_error(e)
+        raise
+
+# Created on first use, since an async client belongs to the running event loop
+_async_client = None
+_async_client_loop = None
+
+def get_async_client():
+    """
+    Returns the shared httpx.AsyncClient, creating it on first use.
+    
+    The client mirrors the requests session: a bounded keep-alive pool,
+    gzip negotiation and retries on connection errors, with the same
+    per-attempt timeouts. A new client is created if called from a
+    different event loop than the one the current client was made in.
+    
+    Returns:
+        httpx.AsyncClient: The shared client
+    """
+    global _async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client.is_closed or _async_client_loop is not loop:
+        connect, read = request_timeout()
+        _async_client_loop = loop
+        _async_client = httpx.AsyncClient(
+            headers=HEADERS,
+            timeout=httpx.Timeout(read, connect=connect),
+            limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE),
+            # Only failed connections are retried, so requests with a RequestorRef
+            # are never sent twice (see create_session())
+            transport=httpx.AsyncHTTPTransport(retries=HTTP_RETRIES),
+        )
+    return _async_client
+
+async def close_async_client():
+    """Closes the shared async client and its pooled connections."""
+    global _async_client, _async_client_loop
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+        _async_client_loop = None
+
+async def stream_timetable_async(chunk_size=STREAM_CHUNK_SIZE, requestor_ref=None, batch=None, preview_minutes=None):
+    """
+    Event loop counterpart of stream_timetable().
+
+    Args:
+        chunk_size (int): Maximum number of bytes per yielded chunk
+        requestor_ref (str, optional): RequestorRef to send, see build_request()
+        batch (tuple, optional): Lines and stops to request, see build_request()
+        preview_minutes (int, optional): Minutes ahead, see build_request()
+
+    Yields:
+        bytes: Consecutive chunks of the decoded XML response body
+
+    Raises:
+        httpx.HTTPError: If the API request fails
+        ValueError: If there's an issue with the API response
+    """
+    try:
+        logger.debug(f"Sending async streaming request to {API_ENDPOINT}")
+        start = time.perf_counter()
+        async with get_async_client().stream(
+            "POST", API_ENDPOINT, content=build_request(requestor_ref, batch, preview_minutes)
+        ) as response:
+            response.raise_for_status()
+            logger.debug(f"Response received, status code: {response.status_code}")
+
+            # Hold back the start of the body until the XML declaration can
+            # be checked, as in stream_timetable()
+            head = b""
+            decoded_bytes = 0
+            async for chunk in response.aiter_bytes(chunk_size):
+                decoded_bytes += len(chunk)
+                if head is not None:
+                    head = (head + chunk).lstrip()
+                    if len(head) < len(b'<?xml'):
+                        continue
+                    _check_xml_prolog(head)
+                    chunk, head = head, None
+                yield chunk
+            if head is not None:
+                _check_xml_prolog(head)
+                yield head
+            FETCH_SECONDS.observe(time.perf_counter() - start)
+            _record_transfer(response, decoded_bytes, wire_bytes=response.num_bytes_downloaded,
+                             batch=batch, preview_minutes=preview_minutes)
+
+    except (httpx.HTTPError, ValueError) as e:
+        logger.error(f"API request failed: {str(e)}")
+        record_upstream_error(e)
+        raise
+
+async def fetch_timetable_async(requestor_ref=None, batch=None, deadline=None, preview_minutes=None):
+    """
+    Non-blocking counterpart of fetch_timetable() for use inside an event loop.
+    
+    Args:
+        requestor_ref (str, optional): RequestorRef to send, see build_request()
+        batch (tuple, optional): Lines and stops to request, see build_request()
+        deadline (float, optional): time.monotonic() value the request must
+            finish by
+        preview_minutes (int, optional): Minutes ahead, see build_request()
+    
+    Returns:
+        str: XML response text from the API
+        
+    Raises:
+        httpx.HTTPError: If the API request fails
+        ValueError: If there's an issue with the API response
+        TimeoutError: If the deadline passes first
+    """
+    try:
+        logger.debug(f"Sending async request to {API_ENDPOINT}")
+        start = time.perf_counter()
+        request = get_async_client().post(API_ENDPOINT, content=build_request(requestor_ref, batch, preview_minutes))
+        if deadline is None:
+            response = await request
+        else:
+            response = await asyncio.wait_for(request, remaining_budget(deadline))
+        response.raise_for_status()
+        _latencies.record(time.perf_counter() - start)
+        FETCH_SECONDS.observe(time.perf_counter() - start)
+        _record_transfer(response, len(response.content), wire_bytes=response.num_bytes_downloaded,
+                         batch=batch, preview_minutes=preview_minutes)
+        
+        # Check if response is valid XML
+        if not response.text.lstrip().startswith('<?xml'):
+            logger.error(f"Invalid XML response: {response.text[:100]}...")
+            raise ValueError("Invalid XML response received from API")
+        
+        logger.debug(f"Response received, status code: {response.status_code}")
+        return response.text
+    
+    except (httpx.HTTPError, ValueError, TimeoutError) as e:
+        logger.error(f"API request failed: {str(e)}")
+        record_upstream_error(e)
         raise
 
+class LatencyTracker:
+    """
+    Latencies of the most recent successful fetches, used to decide how long
+    to wait for a response before sending a hedged duplicate.
+    """
+
+    def __init__(self, size=100):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, percentile, min_samples=HEDGE_MIN_SAMPLES):
+        """
+        Args:
+            percentile (float): Percentile between 0 and 100
+            min_samples (int): Fewest samples to estimate from
+
+        Returns:
+            float: The latency at the percentile, or None with too few samples
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples or len(samples) < min_samples:
+            return None
+        rank = max(math.ceil(percentile / 100 * len(samples)) - 1, 0)
+        return samples[rank]
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+
+_latencies = LatencyTracker()
+
+def hedge_delay(requestor_ref=None):
+    """
+    Returns how long to wait for a response before hedging it.
+
+    A RequestorRef makes the API send each change to that requestor only
+    once, so incremental polls are never duplicated: the change set would be
+    split between the two responses and the losing half dropped.
+
+    Args:
+        requestor_ref (str, optional): RequestorRef the request is sent with
+
+    Returns:
+        float: Seconds, or None if the request should not be hedged
+    """
+    if not HEDGE_ENABLED or requestor_ref is not None or HEDGE_MAX_REQUESTS < 2:
+        return None
+    delay = _latencies.percentile(HEDGE_PERCENTILE)
+    if delay is None:
+        return None
+    return max(delay, HEDGE_MIN_DELAY_SECONDS)
+
+# Runs the duplicate requests of hedged fetches; a losing request finishes
+# in the background, bounded by its own timeout
+_hedge_pool = ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE, thread_name_prefix="togtider-hedge")
+
+def fetch_timetable_hedged(requestor_ref=None, batch=None, deadline=None, preview_minutes=None):
+    """
+    Fetches like fetch_timetable(), sending a duplicate request whenever no
+    response has arrived within HEDGE_PERCENTILE of recent latencies.
+
+    The first successful response wins. Requests that fail are replaced by
+    a new one while HEDGE_MAX_REQUESTS allows; otherwise the last error is
+    raised once no request is left.
+
+    Args:
+        requestor_ref (str, optional): RequestorRef to send, see build_request()
+        batch (tuple, optional): Lines and stops to request, see build_request()
+        deadline (float, optional): time.monotonic() value to finish by,
+            defaults to HTTP_TIMEOUT_SECONDS from now
+        preview_minutes (int, optional): Minutes ahead, see build_request()
+
+    Returns:
+        str: XML response text from the API
+
+    Raises:
+        requests.RequestException: If every request fails
+        ValueError: If there's an issue with the API response
+        TimeoutError: If the deadline passes first
+    """
+    delay = hedge_delay(requestor_ref)
+    if delay is None:
+        return fetch_timetable(requestor_ref, batch, deadline, preview_minutes)
+    if deadline is None:
+        deadline = time.monotonic() + HTTP_TIMEOUT_SECONDS
+
+    first = _hedge_pool.submit(fetch_timetable, requestor_ref, batch, deadline, preview_minutes)
+    pending = {first}
+    sent = 1
+    error = None
+    while pending:
+        timeout = deadline - time.monotonic()
+        if sent < HEDGE_MAX_REQUESTS:
+            timeout = min(timeout, delay)
+        done, pending = wait(pending, timeout=max(timeout, 0), return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is not first:
+                    HEDGED_REQUESTS.inc(outcome="won")
+                return future.result()
+            error = future.exception()
+        if sent < HEDGE_MAX_REQUESTS and time.monotonic() < deadline:
+            logger.debug(f"No response after {delay:.2f}s, sending hedged request")
+            HEDGED_REQUESTS.inc(outcome="sent")
+            pending.add(_hedge_pool.submit(fetch_timetable, requestor_ref, batch, deadline, preview_minutes))
+            sent += 1
+        elif not done:
+            raise TimeoutError(f"No response from {sent} requests before the deadline")
+    raise error
+
+async def fetch_timetable_hedged_async(requestor_ref=None, batch=None, deadline=None, preview_minutes=None):
+    """
+    Event loop counterpart of fetch_timetable_hedged(). Losing requests are
+    cancelled as soon as one succeeds.
+
+    Args:
+        requestor_ref (str, optional): RequestorRef to send, see build_request()
+        batch (tuple, optional): Lines and stops to request, see build_request()
+        deadline (float, optional): time.monotonic() value to finish by,
+            defaults to HTTP_TIMEOUT_SECONDS from now
+        preview_minutes (int, optional): Minutes ahead, see build_request()
+
+    Returns:
+        str: XML response text from the API
+
+    Raises:
+        httpx.HTTPError: If every request fails
+        ValueError: If there's an issue with the API response
+        TimeoutError: If the deadline passes first
+    """
+    delay = hedge_delay(requestor_ref)
+    if delay is None:
+        return await fetch_timetable_async(requestor_ref, batch, deadline, preview_minutes)
+    if deadline is None:
+        deadline = time.monotonic() + HTTP_TIMEOUT_SECONDS
+
+    first = asyncio.create_task(fetch_timetable_async(requestor_ref, batch, deadline, preview_minutes))
+    pending = {first}
+    sent = 1
+    error = None
+    try:
+        while pending:
+            timeout = deadline - time.monotonic()
+            if sent < HEDGE_MAX_REQUESTS:
+                timeout = min(timeout, delay)
+            done, pending = await asyncio.wait(pending, timeout=max(timeout, 0), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not first:
+                        HEDGED_REQUESTS.inc(outcome="won")
+                    return task.result()
+                error = task.exception()
+            if sent < HEDGE_MAX_REQUESTS and time.monotonic() < deadline:
+                logger.debug(f"No response after {delay:.2f}s, sending hedged request")
+                HEDGED_REQUESTS.inc(outcome="sent")
+                pending.add(asyncio.create_task(fetch_timetable_async(requestor_ref, batch, deadline, preview_minutes)))
+                sent += 1
+            elif not done:
+                raise TimeoutError(f"No response from {sent} requests before the deadline")
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
 if __name__ == "__main__":
     # Set up console logging for standalone testing
     logging.basicConfig(level=logging.DEBUG)
@@ -0,0 +1,498 @@
+# jattavagen_departures/history.py
+import array
+import bisect
+import itertools
+import logging
+import math
+import os
+import struct
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from .config import HISTORY_RESCAN_SECONDS, STATIONS
+from .parse_data import DIRECTIONS, LOCAL_TZ, QUAY_REF_PREFIX
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Set up logging
+logger = logging.getLogger('togtider.history')
+
+# Segment files hold the departures scheduled on one local day and only ever
+# grow by whole blocks, all little-endian:
+#   header   magic, format version, flags, row count, string count,
+#            size of the string data
+#   offsets  (string count + 1) uint32 offsets into the string data
+#   strings  UTF-8 string data
+#   columns  one packed array per entry in COLUMNS, row count long each
+MAGIC = b"TGHA"
+FORMAT_VERSION = 1
+BLOCK = struct.Struct("<4sHHIII")
+OFFSET = struct.Struct("<I")
+# stop and destination index the block's strings, direction DIRECTIONS;
+# minute (of the day) and weekday are the local scheduled time
+COLUMNS = (
+    ("stop", "I"),
+    ("aimed", "q"),
+    ("delay", "i"),
+    ("minute", "H"),
+    ("weekday", "B"),
+    ("direction", "B"),
+    ("destination", "I"),
+)
+WEEKDAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+GROUPINGS = ("scheduled", "weekday", "hour")
+
+SEGMENT_PREFIX = "history-"
+SEGMENT_SUFFIX = ".seg"
+# A departure stays in the deliveries for a few hours at most, so only the
+# segments of the last few days need their keys kept for deduplication
+DEDUP_DAYS = 2
+
+def _to_le(column):
+    if sys.byteorder == "big":
+        column = array.array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+def _from_le(typecode, data):
+    column = array.array(typecode)
+    column.frombytes(data)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column
+
+def _segment_day(epoch_seconds):
+    return datetime.fromtimestamp(epoch_seconds, LOCAL_TZ).strftime("%Y%m%d")
+
+def _stop_refs(station):
+    if station in STATIONS:
+        return STATIONS[station]
+    if station.startswith(QUAY_REF_PREFIX):
+        return [station]
+    raise ValueError(f"Unknown station: {station}")
+
+def parse_clock(text):
+    """
+    Args:
+        text (str): Local time of day as HH:MM
+
+    Returns:
+        int: Minutes after midnight
+
+    Raises:
+        ValueError: If the text is not a valid time of day
+    """
+    try:
+        hours, minutes = (int(part) for part in text.split(":"))
+    except ValueError:
+        raise ValueError(f"Invalid time of day: {text}, expected HH:MM")
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError(f"Invalid time of day: {text}, expected HH:MM")
+    return hours * 60 + minutes
+
+def _percentile(ordered, percentile):
+    """Nearest-rank percentile of an already sorted list."""
+    return ordered[max(math.ceil(percentile / 100 * len(ordered)) - 1, 0)]
+
+def encode_block(rows):
+    """
+    Encodes departures as one segment block.
+
+    Args:
+        rows (list): (stop, aimed, delay, minute, weekday, direction,
+            destination) tuples, with stop and destination as strings and
+            direction as an index into DIRECTIONS
+
+    Returns:
+        bytes: The encoded block
+    """
+    strings = {}
+
+    def ref(value):
+        position = strings.get(value)
+        if position is None:
+            position = strings[value] = len(strings)
+        return position
+
+    columns = [array.array(typecode) for _, typecode in COLUMNS]
+    for stop, aimed, delay, minute, weekday, direction, destination in rows:
+        for column, value in zip(columns, (ref(stop), aimed, delay, minute, weekday, direction, ref(destination or ""))):
+            column.append(value)
+
+    encoded = [value.encode("utf-8") for value in strings]
+    offsets = [0]
+    for value in encoded:
+        offsets.append(offsets[-1] + len(value))
+    return b"".join([
+        BLOCK.pack(MAGIC, FORMAT_VERSION, 0, len(rows), len(encoded), offsets[-1]),
+        b"".join(OFFSET.pack(offset) for offset in offsets),
+        b"".join(encoded),
+        *(_to_le(column) for column in columns),
+    ])
+
+def decode_block(data, position=0):
+    """
+    Decodes the block starting at a position in segment data.
+
+    Args:
+        data (bytes-like): Segment file contents
+        position (int): Offset of the block
+
+    Returns:
+        tuple: (strings, columns keyed by name, end offset of the block), or
+               None if the data ends before the block does
+
+    Raises:
+        ValueError: If the data at the position is not a block
+    """
+    view = memoryview(data)
+    if len(view) - position < BLOCK.size:
+        return None
+    magic, version, _, rows, string_count, strings_size = BLOCK.unpack_from(view, position)
+    if magic != MAGIC:
+        raise ValueError("Not a togtider history block")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported history version {version}, expected {FORMAT_VERSION}")
+
+    offsets_start = position + BLOCK.size
+    strings_start = offsets_start + OFFSET.size * (string_count + 1)
+    end = strings_start + strings_size + rows * sum(array.array(typecode).itemsize for _, typecode in COLUMNS)
+    if len(view) < end:
+        return None
+
+    offsets = [offset for (offset,) in struct.iter_unpack("<I", view[offsets_start:strings_start])]
+    blob = view[strings_start:strings_start + strings_size]
+    strings = [str(blob[start:stop], "utf-8") for start, stop in zip(offsets, offsets[1:])]
+
+    columns = {}
+    position = strings_start + strings_size
+    for name, typecode in COLUMNS:
+        size = rows * array.array(typecode).itemsize
+        columns[name] = _from_le(typecode, view[position:position + size])
+        position += size
+    return strings, columns, end
+
+class _Series:
+    """
+    Columns for the departures sharing a stop, direction, destination and
+    scheduled local weekday and time of day, ordered by scheduled time.
+    """
+
+    def __init__(self):
+        self.aimed = array.array("q")
+        self.delay = array.array("i")
+
+    def __len__(self):
+        return len(self.aimed)
+
+    def add(self, aimed, delay):
+        # Blocks are mostly read in order, so this is nearly always an append
+        position = bisect.bisect_right(self.aimed, aimed)
+        if position == len(self.aimed):
+            self.aimed.append(aimed)
+            self.delay.append(delay)
+        else:
+            self.aimed.insert(position, aimed)
+            self.delay.insert(position, delay)
+
+    def delays_since(self, since):
+        """
+        Args:
+            since (float): Epoch seconds, or None for every departure
+
+        Returns:
+            array.array: Delays in seconds of the departures scheduled from then on
+        """
+        if since is None:
+            return self.delay
+        return self.delay[bisect.bisect_left(self.aimed, math.ceil(since)):]
+
+class HistoryArchive:
+    """
+    Append-only archive of observed departures, kept as columns.
+
+    Every poll's departures with an actual departure time are appended to
+    the segment file of the day they were scheduled, skipping those an
+    earlier poll already recorded. In memory the columns are split by stop,
+    direction, destination and scheduled weekday and time into array.array
+    buffers sorted by scheduled time (which numpy.frombuffer() can wrap
+    without copying), so a query filters and groups whole series and only
+    aggregates slices of their columns, never touching the XML again.
+
+    Segments are read on first use, and only those of the days a query
+    covers. Several processes may read the same directory; new blocks are
+    picked up by queries once the directory has been rescanned, at most
+    every rescan_interval seconds. Appends are serialized with a file lock.
+    """
+
+    def __init__(self, directory, rescan_interval=HISTORY_RESCAN_SECONDS):
+        """
+        Args:
+            directory (str): Directory holding the segment files
+            rescan_interval (float): Seconds between looking for blocks
+                appended by other processes
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.rescan_interval = rescan_interval
+        self._lock = threading.RLock()
+        # Series keyed by (direction, destination, weekday, minute) per stop
+        self._series = {}
+        self._destinations = []
+        self._destination_codes = {}
+        # Bytes of each segment read so far, always at a block boundary
+        self._read_until = {}
+        # Keys of the departures recorded per recent segment day
+        self._recent = {}
+        # Segment days found by the last directory scan, and those of them
+        # brought up to date since
+        self._days = []
+        self._checked = set()
+        self._scanned_at = None
+
+    def _segment_path(self, day):
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{day}{SEGMENT_SUFFIX}")
+
+    def _segment_days(self):
+        return sorted(
+            name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]
+            for name in os.listdir(self.directory)
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+        )
+
+    def _destination_code(self, destination):
+        code = self._destination_codes.get(destination)
+        if code is None:
+            code = self._destination_codes[destination] = len(self._destinations)
+            self._destinations.append(destination)
+        return code
+
+    def _add_block(self, day, strings, columns):
+        keys = self._recent.setdefault(day, set())
+        for stop, aimed, delay, minute, weekday, direction, destination in zip(
+            *(columns[name] for name, _ in COLUMNS)
+        ):
+            stop, destination = strings[stop], strings[destination]
+            key = (stop, aimed, direction, destination)
+            if key in keys:
+                continue
+            keys.add(key)
+            by_key = self._series.get(stop)
+            if by_key is None:
+                by_key = self._series[stop] = {}
+            series_key = (direction, self._destination_code(destination), weekday, minute)
+            series = by_key.get(series_key)
+            if series is None:
+                series = by_key[series_key] = _Series()
+            series.add(aimed, delay)
+
+    def _read_segment(self, day):
+        path = self._segment_path(day)
+        start = self._read_until.get(path, 0)
+        try:
+            if os.path.getsize(path) <= start:
+                return
+            with open(path, "rb") as f:
+                f.seek(start)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        position = 0
+        while True:
+            try:
+                block = decode_block(data, position)
+            except ValueError as e:
+                logger.warning(f"Skipping the rest of {path}: {str(e)}")
+                position = len(data)
+                break
+            if block is None:
+                # The rest is a block still being written, or was cut short
+                break
+            strings, columns, position = block
+            self._add_block(day, strings, columns)
+        self._read_until[path] = start + position
+
+    def _catch_up(self, since_day=None):
+        """
+        Loads the blocks appended since they were last read, by any process,
+        to the segments of since_day (as YYYYMMDD) and later days, or of
+        every day. The directory and the files in it are looked at no more
+        than once per rescan_interval.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._scanned_at is None or now - self._scanned_at >= self.rescan_interval:
+                self._days = self._segment_days()
+                self._checked = set()
+                self._scanned_at = now
+            for day in self._days:
+                if (since_day is None or day >= since_day) and day not in self._checked:
+                    self._read_segment(day)
+                    self._checked.add(day)
+            if not self._recent:
+                return
+            newest = datetime.strptime(max(self._recent), "%Y%m%d")
+            cutoff = (newest - timedelta(days=DEDUP_DAYS)).strftime("%Y%m%d")
+            for day in [day for day in self._recent if day < cutoff]:
+                del self._recent[day]
+
+    @contextmanager
+    def _appending(self, day):
+        """Opens a segment for appending while holding its file lock."""
+        with open(self._segment_path(day), "ab") as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield f
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def record(self, index, now=None):
+        """
+        Appends the departures of a snapshot that have actually left and
+        are not yet in the archive.
+
+        Args:
+            index (StopIndex): A parsed snapshot
+            now (float, optional): Current epoch seconds, for tests
+
+        Returns:
+            int: Number of departures added
+        """
+        now = time.time() if now is None else now
+        by_day = {}
+        added = 0
+        with self._lock:
+            # Only the last few days' keys are kept for deduplication
+            self._catch_up(_segment_day(now - DEDUP_DAYS * 86400))
+            for stop, directions in index.by_stop.items():
+                for direction, group in directions.items():
+                    code = DIRECTIONS.index(direction)
+                    for d in group:
+                        if d.actual is None or d.actual > now:
+                            continue
+                        day = _segment_day(d.aimed)
+                        key = (stop, d.aimed, code, d.destination or "")
+                        if key in self._recent.get(day, ()):
+                            continue
+                        scheduled = datetime.fromtimestamp(d.aimed, LOCAL_TZ)
+                        by_day.setdefault(day, {})[key] = (
+                            stop, d.aimed, d.actual - d.aimed,
+                            scheduled.hour * 60 + scheduled.minute, scheduled.weekday(),
+                            code, d.destination or "",
+                        )
+
+            for day, rows in by_day.items():
+                path = self._segment_path(day)
+                with self._appending(day) as f:
+                    # Read what other writers appended, then drop anything
+                    # after the last whole block, left by a crashed writer
+                    self._read_segment(day)
+                    valid = self._read_until.get(path, 0)
+                    if os.fstat(f.fileno()).st_size > valid:
+                        logger.warning(f"Truncating incomplete block at the end of {path}")
+                        f.truncate(valid)
+                    keys = self._recent.get(day, ())
+                    rows = [row for key, row in rows.items() if key not in keys]
+                    if rows:
+                        f.write(encode_block(rows))
+                        f.flush()
+                        added += len(rows)
+                    self._read_segment(day)
+        if added:
+            logger.debug(f"Archived {added} departures")
+        return added
+
+    def departure_count(self):
+        """
+        Returns:
+            int: Departures in the archive
+        """
+        with self._lock:
+            self._catch_up()
+            return sum(len(series) for by_key in self._series.values() for series in by_key.values())
+
+    def delays(self, station, direction=None, destination=None, scheduled=None, group_by="scheduled", days=None, now=None):
+        """
+        Aggregates how late departures from a station have been.
+
+        Args:
+            station (str): Station name from STATIONS, or a StopPointRef
+            direction (str, optional): 'southbound' or 'northbound'
+            destination (str, optional): Only departures to this destination
+            scheduled (str, optional): Only departures scheduled at this
+                local time of day, as HH:MM
+            group_by (str): 'scheduled' (time of day), 'weekday' or 'hour'
+            days (float, optional): Only departures from the last days
+            now (float, optional): Current epoch seconds, for tests
+
+        Returns:
+            dict: Delay statistics in minutes per group and direction
+
+        Raises:
+            ValueError: If the station, direction, time or grouping is unknown
+        """
+        stop_refs = _stop_refs(station)
+        if group_by not in GROUPINGS:
+            raise ValueError(f"Unknown grouping: {group_by}, expected one of {', '.join(GROUPINGS)}")
+        if direction is not None and direction not in DIRECTIONS:
+            raise ValueError(f"Unknown direction: {direction}")
+        wanted_direction = None if direction is None else DIRECTIONS.index(direction)
+        wanted_minute = None if scheduled is None else parse_clock(scheduled)
+        now = time.time() if now is None else now
+        since = None if days is None else now - days * 86400
+
+        groups = {}
+        with self._lock:
+            self._catch_up(None if since is None else _segment_day(since))
+            wanted_destination = None if destination is None else self._destination_codes.get(destination, -1)
+            for stop in stop_refs:
+                for (code, destination_code, weekday, minute), series in self._series.get(stop, {}).items():
+                    if wanted_direction is not None and code != wanted_direction:
+                        continue
+                    if wanted_destination is not None and destination_code != wanted_destination:
+                        continue
+                    if wanted_minute is not None and minute != wanted_minute:
+                        continue
+                    delays = series.delays_since(since)
+                    if not delays:
+                        continue
+                    if group_by == "scheduled":
+                        group = minute
+                    elif group_by == "weekday":
+                        group = weekday
+                    else:
+                        group = minute // 60
+                    groups.setdefault((group, code), []).append(delays)
+
+        results = []
+        for (group, code), series in sorted(groups.items()):
+            delays = sorted(itertools.chain.from_iterable(series))
+            if group_by == "scheduled":
+                label = f"{group // 60:02d}:{group % 60:02d}"
+            elif group_by == "weekday":
+                label = WEEKDAYS[group]
+            else:
+                label = f"{group:02d}:00"
+            results.append({
+                group_by: label,
+                "direction": DIRECTIONS[code],
+                "count": len(delays),
+                "mean_delay_minutes": round(sum(delays) / len(delays) / 60, 1),
+                "median_delay_minutes": round(_percentile(delays, 50) / 60, 1),
+                "p90_delay_minutes": round(_percentile(delays, 90) / 60, 1),
+                "max_delay_minutes": round(delays[-1] / 60, 1),
+            })
+        return {
+            "station": station,
+            "group_by": group_by,
+            "since": None if since is None else datetime.fromtimestamp(since, LOCAL_TZ).isoformat(timespec="seconds"),
+            "departures": sum(group["count"] for group in results),
+            "groups": results,
+        }
@@ -0,0 +1,150 @@
+# jattavagen_departures/journey_state.py
+import logging
+import threading
+import time
+import uuid
+from .config import REQUESTOR_REF, FULL_REFRESH_INTERVAL_SECONDS, JOURNEY_RETENTION_MINUTES
+from .parse_data import StopIndex
+
+# Set up logging
+logger = logging.getLogger('togtider.journeys')
+
+def _journey_key(journey_ref, departures):
+    """
+    Returns the key a journey is stored under.
+    
+    Journeys without a reference in the delivery fall back to their
+    direction, destination and first scheduled departure, which identify
+    a train on the line just as well within the preview window.
+    """
+    if journey_ref:
+        return journey_ref
+    if not departures:
+        return None
+    first = departures[0]
+    return (first.direction, first.destination, first.aimed)
+
+def _has_ended(departures, cutoff):
+    """Returns True if every departure of a journey is before the cutoff (epoch seconds)."""
+    return all(departure.aimed < cutoff for departure in departures)
+
+class JourneyState:
+    """
+    Per-journey departures kept between polls so that deliveries containing
+    only changed journeys can be merged instead of re-fetching everything.
+    
+    The upstream tracks what it has sent to each RequestorRef. A full
+    refresh starts a new requestor, which receives every journey in the
+    preview window; later polls with the same requestor only receive the
+    journeys that changed since the previous poll.
+    """
+    
+    def __init__(self, full_refresh_interval=FULL_REFRESH_INTERVAL_SECONDS,
+                 retention_minutes=JOURNEY_RETENTION_MINUTES):
+        """
+        Args:
+            full_refresh_interval (float): Seconds between full resyncs
+            retention_minutes (float): How long after its last departure a
+                journey is kept before being pruned
+        """
+        self.full_refresh_interval = full_refresh_interval
+        self.retention = retention_minutes * 60
+        self._lock = threading.Lock()
+        self._journeys = {}
+        self._last_full = None
+        self.requestor_ref = REQUESTOR_REF
+        self.full_refreshes = 0
+        self.delta_updates = 0
+        self.journeys_updated = 0
+    
+    def needs_full_refresh(self):
+        """
+        Returns:
+            bool: True if the next poll should fetch the complete window
+        """
+        with self._lock:
+            return (self._last_full is None
+                    or time.monotonic() - self._last_full >= self.full_refresh_interval)
+    
+    def start_full_refresh(self):
+        """
+        Starts a new upstream requestor so the next delivery is complete.
+        
+        Returns:
+            str: The RequestorRef to send with the full request
+        """
+        with self._lock:
+            self.requestor_ref = f"{REQUESTOR_REF}-{uuid.uuid4().hex[:12]}"
+            return self.requestor_ref
+    
+    def apply(self, journeys, full=False):
+        """
+        Merges a delivery into the state and builds a fresh stop index.
+        
+        Args:
+            journeys (list): (journey_ref, departures) tuples from
+                parse_data.parse_journeys()
+            full (bool): True if the delivery covers the complete window and
+                replaces the state instead of being merged into it
+                
+        Returns:
+            StopIndex: Departures for every journey currently in the state
+        """
+        cutoff = time.time() - self.retention
+        with self._lock:
+            if full:
+                self._journeys = {}
+                self._last_full = time.monotonic()
+                self.full_refreshes += 1
+            else:
+                self.delta_updates += 1
+            
+            updated = 0
+            for journey_ref, departures in journeys:
+                key = _journey_key(journey_ref, departures)
+                if key is None:
+                    continue
+                self._journeys[key] = departures
+                updated += 1
+            self.journeys_updated += updated
+            
+            # Journeys that have ended are never sent again, so drop them here
+            ended = [key for key, departures in self._journeys.items() if _has_ended(departures, cutoff)]
+            for key in ended:
+                del self._journeys[key]
+            
+            index = StopIndex()
+            for departures in self._journeys.values():
+                for departure in departures:
+                    index.add(departure)
+            journey_count = len(self._journeys)
+        
+        logger.info(f"{'Replaced' if full else 'Merged'} {updated} journeys, pruned {len(ended)}, tracking {journey_count}")
+        return index
+    
+    def require_full_refresh(self):
+        """
+        Makes the next poll a full refresh, e.g. after a failed delta poll
+        whose changes the upstream may already count as delivered.
+        """
+        with self._lock:
+            self._last_full = None
+    
+    def reset(self):
+        """Forgets all journeys so the next poll is a full refresh."""
+        with self._lock:
+            self._journeys = {}
+            self._last_full = None
+    
+    def stats(self):
+        """
+        Returns:
+            dict: Number of tracked journeys and update counters
+        """
+        with self._lock:
+            return {
+                "journeys": len(self._journeys),
+                "full_refreshes": self.full_refreshes,
+                "delta_updates": self.delta_updates,
+                "journeys_updated": self.journeys_updated,
+            }
@@ -0,0 +1,209 @@
+# jattavagen_departures/metrics.py
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# Set up logging
+logger = logging.getLogger('togtider.metrics')
+
+# Bucket upper bounds shared by the stage histograms
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7)
+COUNT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+def _format_value(value):
+    """Formats a sample value the way Prometheus expects."""
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{str(value)}"' for key, value in sorted(labels.items()))
+    return "{" + pairs + "}"
+
+class Histogram:
+    """
+    A cumulative histogram of observed values, rendered in the Prometheus
+    text format as _bucket, _sum and _count samples.
+    """
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self.reset()
+
+    def observe(self, value):
+        """Records a single observation."""
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[position] += 1
+            self._sum += value
+            self._count += 1
+
+    @contextmanager
+    def time(self):
+        """Observes the wall-clock seconds spent inside the with-block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def reset(self):
+        with self._lock:
+            # One extra slot for observations above the largest bucket
+            self._counts = [0] * (len(self.buckets) + 1)
+            self._sum = 0.0
+            self._count = 0
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: Count, sum and cumulative bucket counts keyed by upper bound
+        """
+        with self._lock:
+            counts, total, count = list(self._counts), self._sum, self._count
+        cumulative = {}
+        running = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            running += bucket_count
+            cumulative[bound] = running
+        return {"count": count, "sum": total, "buckets": cumulative}
+
+    def render(self):
+        snapshot = self.snapshot()
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for bound, count in snapshot["buckets"].items():
+            lines.append(f'{self.name}_bucket{{le="{_format_value(bound)}"}} {count}')
+        lines.append(f"{self.name}_sum {_format_value(snapshot['sum'])}")
+        lines.append(f"{self.name}_count {snapshot['count']}")
+        return lines
+
+class Counter:
+    """A monotonically increasing count, optionally split by labels."""
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._lock = threading.Lock()
+        self.reset()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(dict(key))} {_format_value(value)}")
+        return lines
+
+FETCH_SECONDS = Histogram(
+    "togtider_fetch_seconds",
+    "Time from sending a request to Bane NOR until the body has been received",
+    LATENCY_BUCKETS,
+)
+RESPONSE_BYTES = Histogram(
+    "togtider_response_bytes",
+    "Decoded size of Bane NOR responses",
+    SIZE_BUCKETS,
+)
+RESPONSE_WIRE_BYTES = Histogram(
+    "togtider_response_wire_bytes",
+    "Size of Bane NOR responses on the wire, before decompression",
+    SIZE_BUCKETS,
+)
+PARSE_SECONDS = Histogram(
+    "togtider_parse_seconds",
+    "Time spent parsing a buffered response",
+    LATENCY_BUCKETS,
+)
+PARSED_JOURNEYS = Histogram(
+    "togtider_parsed_journeys",
+    "Journeys found per parsed response",
+    COUNT_BUCKETS,
+)
+PARSED_DEPARTURES = Histogram(
+    "togtider_parsed_departures",
+    "Departures found per parsed response",
+    COUNT_BUCKETS,
+)
+FILTER_SECONDS = Histogram(
+    "togtider_filter_seconds",
+    "Time spent looking up the departures for one request",
+    LATENCY_BUCKETS,
+)
+FORMAT_SECONDS = Histogram(
+    "togtider_format_seconds",
+    "Time spent formatting departures for one request",
+    LATENCY_BUCKETS,
+)
+UPSTREAM_ERRORS = Counter(
+    "togtider_upstream_errors_total",
+    "Failed requests to Bane NOR by error type",
+)
+HEDGED_REQUESTS = Counter(
+    "togtider_hedged_requests_total",
+    "Duplicate requests sent because the first was slow, and how many of them answered first",
+)
+RESPONSE_SAVED_BYTES = Counter(
+    "togtider_response_saved_bytes_total",
+    "Bytes not received because polls asked for a narrower preview window, against the latest full-window response",
+)
+BOARD_REQUESTS = Counter(
+    "togtider_board_requests_total",
+    "Departure board requests by whether the cached board was reused, rebuilt, or not sent as unchanged",
+)
+
+_registry = [
+    FETCH_SECONDS,
+    RESPONSE_BYTES,
+    RESPONSE_WIRE_BYTES,
+    PARSE_SECONDS,
+    PARSED_JOURNEYS,
+    PARSED_DEPARTURES,
+    FILTER_SECONDS,
+    FORMAT_SECONDS,
+    UPSTREAM_ERRORS,
+    HEDGED_REQUESTS,
+    RESPONSE_SAVED_BYTES,
+    BOARD_REQUESTS,
+]
+
+def record_upstream_error(error):
+    """Counts a failed upstream request under the name of its exception type."""
+    UPSTREAM_ERRORS.inc(kind=type(error).__name__)
+
+def render_prometheus():
+    """
+    Returns:
+        str: Every metric in the Prometheus text exposition format
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+def reset_metrics():
+    """Clears every metric, e.g. between tests."""
+    for metric in _registry:
+        metric.reset()
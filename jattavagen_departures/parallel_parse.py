@@ -0,0 +1,207 @@
+# jattavagen_departures/parallel_parse.py
+import logging
+import multiprocessing
+import os
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from .config import PARALLEL_PARSE_WORKERS, PARALLEL_PARSE_MIN_SIZE
+from .metrics import PARSE_SECONDS, PARSED_DEPARTURES, PARSED_JOURNEYS
+from . import parse_data
+from .parse_data import Departure, StopIndex, parse_journeys, parse_stop_index
+
+# Set up logging
+logger = logging.getLogger('togtider.parse')
+
+# Journeys are located in the raw text so that a delivery can be cut into
+# shards without parsing it first. Deliveries that use a namespace prefix
+# for these elements, or self-closing journeys, are not matched and are
+# parsed in one piece instead.
+JOURNEY_START = re.compile(r"<EstimatedVehicleJourney[\s>]")
+JOURNEY_END = "</EstimatedVehicleJourney>"
+
+# Shards per worker, so that a worker finishing early picks up another
+SHARDS_PER_WORKER = 2
+
+_pool = None
+_pool_workers = None
+_pool_lock = threading.Lock()
+
+def _workers(workers):
+    if workers is None:
+        workers = PARALLEL_PARSE_WORKERS
+    if workers is None:
+        workers = os.cpu_count() or 1
+    return workers
+
+def _get_pool(workers):
+    """
+    Returns the process pool, started on first use and kept for later polls.
+
+    Workers are started from a fork server rather than forked from the
+    service, which has event loop and fetch threads running.
+    """
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+            _pool_workers = workers
+            logger.info(f"Started {workers} parse worker processes")
+        return _pool
+
+def shutdown_pool():
+    """Stops the worker processes, if any were started."""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+        _pool = _pool_workers = None
+
+def split_journeys(xml_response, shards):
+    """
+    Cuts a delivery into documents holding consecutive runs of its journeys.
+
+    Each shard keeps the text before the first journey and after the last
+    one, so it has the delivery's root element and namespace declarations,
+    and whatever frames the journeys were spread over are closed as in the
+    original.
+
+    Args:
+        xml_response (str): XML response from the Bane NOR API
+        shards (int): Number of documents to cut it into at most
+
+    Returns:
+        list: Shard documents in document order, or None if the journeys
+              could not be located in the text
+    """
+    starts = [match.start() for match in JOURNEY_START.finditer(xml_response)]
+    if not starts:
+        return None
+    ends = []
+    for start in starts:
+        end = xml_response.find(JOURNEY_END, start)
+        if end < 0:
+            return None
+        ends.append(end + len(JOURNEY_END))
+    # Every journey has to close before the next one opens
+    if any(end > start for end, start in zip(ends, starts[1:])):
+        return None
+
+    head = xml_response[:starts[0]]
+    tail = xml_response[ends[-1]:]
+    shards = max(min(shards, len(starts)), 1)
+    size, extra = divmod(len(starts), shards)
+    documents = []
+    first = 0
+    for shard in range(shards):
+        last = first + size + (shard < extra) - 1
+        documents.append(head + xml_response[starts[first]:ends[last]] + tail)
+        first = last + 1
+    return documents
+
+def _parse_shard(document):
+    """
+    Parses one shard in a worker process.
+
+    Departures are sent back as plain field tuples, which pickle far more
+    cheaply than slotted objects.
+
+    Returns:
+        list: (journey_ref, [departure fields]) tuples in document order
+    """
+    try:
+        root = parse_data._xml.fromstring(document)
+    except parse_data._xml.ParseError as e:
+        raise ValueError(f"Failed to parse XML: {str(e)}")
+    journeys = []
+    for journey in root.iter(parse_data.JOURNEY_TAG):
+        journey_ref, departures = parse_data._parse_journey(journey)
+        journeys.append((journey_ref, [departure._fields() for departure in departures]))
+    return journeys
+
+def _parse_sharded(xml_response, workers, min_size):
+    """
+    Returns:
+        list: (journey_ref, departures) tuples in document order, or None if
+              the delivery should be parsed in the calling thread
+    """
+    if not xml_response or not isinstance(xml_response, str):
+        return None
+    workers = _workers(workers)
+    if workers < 2 or len(xml_response) < min_size:
+        return None
+    documents = split_journeys(xml_response, workers * SHARDS_PER_WORKER)
+    if documents is None:
+        logger.debug("Journeys not found in the raw delivery, parsing it in one piece")
+        return None
+    if len(documents) < 2:
+        return None
+
+    start = time.perf_counter()
+    # map() yields results in the order of the shards, whichever finishes first
+    journeys = [
+        (journey_ref, [Departure(*fields) for fields in departures])
+        for shard in _get_pool(workers).map(_parse_shard, documents)
+        for journey_ref, departures in shard
+    ]
+    PARSE_SECONDS.observe(time.perf_counter() - start)
+    PARSED_JOURNEYS.observe(len(journeys))
+    PARSED_DEPARTURES.observe(sum(len(departures) for _, departures in journeys))
+    logger.info(f"Parsed {len(journeys)} journeys in {len(documents)} shards on {workers} processes")
+    return journeys
+
+def parse_journeys_parallel(xml_response, workers=None, min_size=PARALLEL_PARSE_MIN_SIZE):
+    """
+    Counterpart of parse_data.parse_journeys() that parses large deliveries
+    on a pool of processes.
+
+    Deliveries shorter than min_size characters, or with fewer than two
+    workers configured, are parsed in the calling thread, since starting
+    the shards costs more than it saves on a single line's delivery.
+
+    Args:
+        xml_response (str): XML response from the Bane NOR API
+        workers (int, optional): Worker processes, defaults to
+            PARALLEL_PARSE_WORKERS
+        min_size (int): Smallest delivery, in characters, to shard
+
+    Returns:
+        list: (journey_ref, departures) tuples in document order, exactly
+              as from parse_journeys()
+
+    Raises:
+        ValueError: If the XML parsing fails or response format is unexpected
+    """
+    journeys = _parse_sharded(xml_response, workers, min_size)
+    if journeys is None:
+        return parse_journeys(xml_response)
+    return journeys
+
+def parse_stop_index_parallel(xml_response, workers=None, min_size=PARALLEL_PARSE_MIN_SIZE):
+    """
+    Counterpart of parse_data.parse_stop_index() that parses large
+    deliveries on a pool of processes (see parse_journeys_parallel()).
+
+    The shards are merged in document order, so every stop and direction
+    lists its departures in the same order as a serial parse would.
+
+    Returns:
+        StopIndex: Departures indexed by StopPointRef and direction
+
+    Raises:
+        ValueError: If the XML parsing fails or response format is unexpected
+    """
+    journeys = _parse_sharded(xml_response, workers, min_size)
+    if journeys is None:
+        return parse_stop_index(xml_response)
+    index = StopIndex()
+    for _, departures in journeys:
+        for departure in departures:
+            index.add(departure)
+    logger.info(f"Indexed {index.departure_count()} departures at {len(index.by_stop)} stops")
+    return index
@@ -1,21 +1,353 @@
 # jattavagen_departures/parse_data.py
 import logging
-import xml.etree.ElementTree as ET
+import time
 from datetime import datetime
+from zoneinfo import ZoneInfo
+from .config import STATIONS, DEFAULT_STATION, DISPLAY_TIMEZONE, XML_BACKEND
+from .metrics import PARSE_SECONDS, PARSED_DEPARTURES, PARSED_JOURNEYS
+from .xml_backend import select_backend
 
 # Set up logging
 logger = logging.getLogger('togtider.parse')
 
-def parse_departures(xml_response):
+# Define the namespace (the sample uses the default "siri" namespace)
+NAMESPACES = {"siri": "http://www.siri.org.uk/siri"}
+
+# Prefix of NeTEx quay identifiers used as StopPointRef
+QUAY_REF_PREFIX = "NSR:Quay:"
+
+# Directions departures are grouped by
+DIRECTIONS = ("southbound", "northbound")
+
+# Fully qualified tag names, compared directly against element tags so that
+# each journey and call is walked only once instead of via repeated find()
+SIRI_NS = "{http://www.siri.org.uk/siri}"
+SIRI_ROOT_TAG = SIRI_NS + "Siri"
+FRAME_TAG = SIRI_NS + "EstimatedJourneyVersionFrame"
+JOURNEY_TAG = SIRI_NS + "EstimatedVehicleJourney"
+LINE_REF_TAG = SIRI_NS + "LineRef"
+DIRECTION_TAG = SIRI_NS + "DirectionRef"
+FRAMED_JOURNEY_REF_TAG = SIRI_NS + "FramedVehicleJourneyRef"
+DATA_FRAME_REF_TAG = SIRI_NS + "DataFrameRef"
+DATED_JOURNEY_REF_TAG = SIRI_NS + "DatedVehicleJourneyRef"
+DESTINATION_TAG = SIRI_NS + "DestinationName"
+RECORDED_CALLS_TAG = SIRI_NS + "RecordedCalls"
+RECORDED_CALL_TAG = SIRI_NS + "RecordedCall"
+STOP_POINT_TAG = SIRI_NS + "StopPointRef"
+AIMED_DEPARTURE_TAG = SIRI_NS + "AimedDepartureTime"
+ACTUAL_DEPARTURE_TAG = SIRI_NS + "ActualDepartureTime"
+
+# Time zone for timestamps that come without an offset
+LOCAL_TZ = ZoneInfo(DISPLAY_TIMEZONE)
+
+# Parser used to build element trees, see xml_backend.select_backend()
+_xml = select_backend(XML_BACKEND)
+
+def parse_timestamp(text):
+    """
+    Converts an ISO 8601 timestamp from the API to epoch seconds.
+    
+    The offset in the timestamp is respected; timestamps without one are
+    taken to be local time in DISPLAY_TIMEZONE.
+    
+    Args:
+        text (str): Timestamp such as 2025-03-07T10:15:00+01:00
+        
+    Returns:
+        int: Seconds since the epoch
+        
+    Raises:
+        ValueError: If the text is not a valid timestamp
+    """
+    if text.endswith("Z"):
+        text = text[:-1] + "+00:00"
+    dt = datetime.fromisoformat(text)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=LOCAL_TZ)
+    return int(dt.timestamp())
+
+class Departure:
+    """
+    A single departure from a stop.
+    
+    Times are parsed once, when the delivery is parsed, into epoch seconds so
+    that filtering, sorting and formatting only compare integers.
+    """
+    
+    __slots__ = ("stop_ref", "aimed", "actual", "direction", "destination", "journey_ref", "line_ref")
+    
+    def __init__(self, stop_ref, aimed, actual, direction, destination, journey_ref=None, line_ref=None):
+        """
+        Args:
+            stop_ref (str): StopPointRef of the quay
+            aimed (int): Scheduled departure in epoch seconds
+            actual (int): Actual or expected departure in epoch seconds, or None
+            direction (str): 'southbound' or 'northbound'
+            destination (str): Destination name of the journey
+            journey_ref (str, optional): Identity of the journey across deliveries
+            line_ref (str, optional): LineRef of the journey
+        """
+        self.stop_ref = stop_ref
+        self.aimed = aimed
+        self.actual = actual
+        self.direction = direction
+        self.destination = destination
+        self.journey_ref = journey_ref
+        self.line_ref = line_ref
+    
+    def _fields(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+    
+    def __eq__(self, other):
+        if not isinstance(other, Departure):
+            return NotImplemented
+        return self._fields() == other._fields()
+    
+    def __hash__(self):
+        return hash(self._fields())
+    
+    def __repr__(self):
+        return f"Departure({', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)})"
+
+class StopIndex:
+    """
+    Departures from one parsed delivery, indexed by StopPointRef and direction.
+    
+    Built in a single pass over the XML so that any quay or station served by
+    the delivery can be looked up without parsing it again.
+    """
+    
+    def __init__(self):
+        self.by_stop = {}
+        # Epoch seconds at which the delivery was fetched, set by the service
+        self.fetched_at = None
+        # Minutes ahead the delivery was requested for, set by the service;
+        # None when unknown, e.g. for snapshots loaded from disk
+        self.preview_minutes = None
+    
+    def add(self, departure):
+        """
+        Adds a Departure under its stop and direction.
+        """
+        directions = self.by_stop.get(departure.stop_ref)
+        if directions is None:
+            directions = self.by_stop[departure.stop_ref] = {direction: [] for direction in DIRECTIONS}
+        directions[departure.direction].append(departure)
+    
+    @classmethod
+    def merged(cls, indexes):
+        """
+        Combines the indexes of several deliveries into one.
+        
+        A journey matching more than one request in a batch appears in
+        several deliveries, so departures are deduplicated by journey, stop
+        and scheduled time.
+        
+        Args:
+            indexes (list): StopIndex instances to combine
+            
+        Returns:
+            StopIndex: The combined index
+        """
+        if len(indexes) == 1:
+            return indexes[0]
+        merged = cls()
+        seen = set()
+        for index in indexes:
+            for directions in index.by_stop.values():
+                for group in directions.values():
+                    for departure in group:
+                        key = (departure.journey_ref, departure.stop_ref, departure.aimed)
+                        if key in seen:
+                            continue
+                        seen.add(key)
+                        merged.add(departure)
+        return merged
+    
+    def freeze(self):
+        """
+        Turns the per-direction lists into tuples so the index can be shared
+        between threads as a read-only snapshot.
+        
+        Returns:
+            StopIndex: This index, for chaining
+        """
+        for directions in self.by_stop.values():
+            for direction, group in directions.items():
+                directions[direction] = tuple(group)
+        return self
+    
+    def stops(self):
+        """
+        Returns:
+            list: All StopPointRefs with at least one departure
+        """
+        return list(self.by_stop)
+    
+    def for_stops(self, stop_refs, line=None):
+        """
+        Collects the departures for a group of quays.
+        
+        Args:
+            stop_refs (iterable): StopPointRefs to include
+            line (str, optional): Only include departures on this LineRef
+            
+        Returns:
+            dict: Dictionary with keys 'southbound' and 'northbound'
+        """
+        departures = {direction: [] for direction in DIRECTIONS}
+        for stop_ref in stop_refs:
+            directions = self.by_stop.get(stop_ref)
+            if directions is None:
+                continue
+            for direction, group in directions.items():
+                if line is None:
+                    departures[direction].extend(group)
+                else:
+                    departures[direction].extend(d for d in group if d.line_ref == line)
+        return departures
+    
+    def for_station(self, station=DEFAULT_STATION, line=None):
+        """
+        Collects the departures for a station using the quays in STATIONS.
+        
+        A StopPointRef can also be given directly to query a single quay. A
+        quay with no calls in the delivery gives empty groups.
+        
+        Args:
+            station (str): Station name from STATIONS, or a StopPointRef
+            line (str, optional): Only include departures on this LineRef
+            
+        Returns:
+            dict: Dictionary with keys 'southbound' and 'northbound'
+            
+        Raises:
+            ValueError: If the station is neither configured nor in the index
+        """
+        if station in STATIONS:
+            return self.for_stops(STATIONS[station], line)
+        # A quay without calls in this delivery simply has no departures
+        if station in self.by_stop or station.startswith(QUAY_REF_PREFIX):
+            return self.for_stops([station], line)
+        raise ValueError(f"Unknown station: {station}")
+    
+    def departure_count(self):
+        """
+        Returns:
+            int: Total number of departures across all stops
+        """
+        return sum(len(group) for directions in self.by_stop.values() for group in directions.values())
+
+def _parse_journey(journey):
     """
-    Parses the XML response and groups departures from Jåttåvågen by direction.
+    Extracts the departures for every recorded call in a single
+    EstimatedVehicleJourney.
+    
+    Args:
+        journey (Element): The journey element, from either XML backend
+        
+    Returns:
+        tuple: (journey_ref, departures) where journey_ref identifies the
+               journey across deliveries (None if the delivery has no
+               reference for it) and departures is a possibly empty list of
+               Departure records
+    """
+    direction_value = None
+    destination = None
+    recorded_calls = None
+    journey_ref = None
+    line_ref = None
+    
+    for child in journey:
+        tag = child.tag
+        if tag == LINE_REF_TAG and line_ref is None:
+            line_ref = child.text.strip() if child.text else None
+        elif tag == FRAMED_JOURNEY_REF_TAG:
+            # The framed reference is unique per operating day
+            parts = [field.text.strip() for field in child
+                     if field.tag in (DATA_FRAME_REF_TAG, DATED_JOURNEY_REF_TAG) and field.text]
+            if parts:
+                journey_ref = ":".join(parts)
+        elif tag == DATED_JOURNEY_REF_TAG and journey_ref is None:
+            journey_ref = child.text.strip() if child.text else None
+        elif tag == DIRECTION_TAG and direction_value is None:
+            direction_value = child.text.strip() if child.text else ""
+        elif tag == DESTINATION_TAG and destination is None:
+            destination = child.text.strip() if child.text else None
+        elif tag == RECORDED_CALLS_TAG and recorded_calls is None:
+            recorded_calls = child
+    
+    # Get the journey direction from DirectionRef.
+    if direction_value is None:
+        logger.warning("Journey without DirectionRef found, skipping")
+        return journey_ref, []
+    
+    # Here we determine if the journey is northbound or southbound
+    # STV = Stavanger = northbound
+    # EGS = Egersund = southbound
+    if direction_value == "STV":
+        dep_direction = "northbound"
+    else:
+        dep_direction = "southbound"
+    
+    if destination is None:
+        destination = "Unknown"
+    
+    # Process RecordedCalls for departures
+    if recorded_calls is None:
+        logger.warning(f"No RecordedCalls found for journey to {destination}")
+        return journey_ref, []
+    
+    # Process each call (stop) in the journey
+    departures = []
+    for call in recorded_calls:
+        if call.tag != RECORDED_CALL_TAG:
+            continue
+        
+        stop_ref = aimed = actual = None
+        for field in call:
+            tag = field.tag
+            if tag == STOP_POINT_TAG:
+                stop_ref = field.text
+            elif tag == AIMED_DEPARTURE_TAG:
+                aimed = field.text
+            elif tag == ACTUAL_DEPARTURE_TAG:
+                actual = field.text
+        
+        # Only add if we have a stop and a valid departure time. Calls without
+        # a departure time are normally the final arrival of the journey.
+        if not stop_ref:
+            logger.warning(f"Skipping call without StopPointRef for journey to {destination}")
+            continue
+        if not aimed:
+            logger.debug(f"Skipping departure without AimedDepartureTime at {stop_ref}")
+            continue
+        
+        try:
+            departures.append(Departure(
+                stop_ref,
+                parse_timestamp(aimed),
+                parse_timestamp(actual) if actual else None,
+                dep_direction,
+                destination,
+                journey_ref,
+                line_ref,
+            ))
+        except ValueError:
+            logger.warning(f"Skipping departure with invalid time at {stop_ref}: {aimed}, {actual}")
+    
+    logger.debug(f"Found {len(departures)} departures for {dep_direction} journey to {destination}")
+    return journey_ref, departures
+
+def parse_stop_index(xml_response):
+    """
+    Parses the XML response into a StopIndex covering every stop in it.
     
     Args:
         xml_response (str): XML response from the Bane NOR API
         
     Returns:
-        dict: Dictionary with keys 'southbound' and 'northbound', each containing
-              a list of departure dictionaries with information about each departure
+        StopIndex: Departures indexed by StopPointRef and direction
               
     Raises:
         ValueError: If the XML parsing fails or response format is unexpected
@@ -25,98 +357,207 @@ def parse_departures(xml_response):
         raise ValueError("Invalid XML response")
         
     try:
-        # Define the namespace (the sample uses the default "siri" namespace)
-        namespaces = {"siri": "http://www.siri.org.uk/siri"}
-        
         logger.debug("Parsing XML response")
-        root = ET.fromstring(xml_response)
-        
-        # We'll collect departures in a dictionary keyed by direction.
-        departures = {"southbound": [], "northbound": []}
-        
-        # Accept both possible StopPointRef codes for Jåttåvågen
-        valid_refs = {"NSR:Quay:609", "NSR:Quay:607"}
+        start = time.perf_counter()
+        root = _xml.fromstring(xml_response)
         
         # Ensure we found the root element correctly
-        if root.tag != "{http://www.siri.org.uk/siri}Siri":
+        if root.tag != SIRI_ROOT_TAG:
             logger.warning(f"Unexpected XML root tag: {root.tag}")
         
+        index = StopIndex()
+        
         # Count found journeys for logging
         journey_count = 0
         
         # Iterate over each EstimatedVehicleJourney
-        for journey in root.findall(".//siri:EstimatedVehicleJourney", namespaces):
+        for journey in root.iter(JOURNEY_TAG):
             journey_count += 1
-            
-            # Get the journey direction from DirectionRef.
-            direction_elem = journey.find("siri:DirectionRef", namespaces)
-            if direction_elem is None:
-                logger.warning("Journey without DirectionRef found, skipping")
-                continue
-                
-            direction_value = direction_elem.text.strip() if direction_elem.text else ""
-            logger.debug(f"Found journey with direction: {direction_value}")
-            
-            # Here we determine if the journey is northbound or southbound
-            # STV = Stavanger = northbound
-            # EGS = Egersund = southbound
-            if direction_value == "STV":
-                dep_direction = "northbound"
-            else:
-                dep_direction = "southbound"
-            
-            # Extract the destination from the journey
-            dest_elem = journey.find("siri:DestinationName", namespaces)
-            destination = dest_elem.text.strip() if dest_elem is not None and dest_elem.text else "Unknown"
-            
-            # Process RecordedCalls for departures
-            recorded_calls = journey.find("siri:RecordedCalls", namespaces)
-            if recorded_calls is None:
-                logger.warning(f"No RecordedCalls found for journey to {destination}")
-                continue
-            
-            # Process each call (stop) in the journey
-            call_count = 0
-            for call in recorded_calls.findall("siri:RecordedCall", namespaces):
-                call_count += 1
-                stop_ref_elem = call.find("siri:StopPointRef", namespaces)
-                
-                # Skip stops that aren't at Jåttåvågen
-                if stop_ref_elem is None or stop_ref_elem.text not in valid_refs:
-                    continue
-                
-                # Extract departure times
-                aimed_dep_elem = call.find("siri:AimedDepartureTime", namespaces)
-                actual_dep_elem = call.find("siri:ActualDepartureTime", namespaces)
-                
-                # Create a departure info dictionary
-                departure_info = {
-                    "StopPointRef": stop_ref_elem.text,
-                    "AimedDepartureTime": aimed_dep_elem.text if aimed_dep_elem is not None else None,
-                    "ActualDepartureTime": actual_dep_elem.text if actual_dep_elem is not None else None,
-                    "Direction": dep_direction,
-                    "Destination": destination,
-                }
-                
-                # Only add if we have a valid departure time
-                if departure_info["AimedDepartureTime"]:
-                    departures[dep_direction].append(departure_info)
-                    logger.debug(f"Added {dep_direction} departure to {destination}")
-                else:
-                    logger.warning(f"Skipping departure without AimedDepartureTime")
-            
-            logger.debug(f"Processed {call_count} calls for journey")
-            
-        logger.info(f"Parsed {journey_count} journeys, found {len(departures['southbound']) + len(departures['northbound'])} departures")
-        return departures
+            for departure in _parse_journey(journey)[1]:
+                index.add(departure)
         
-    except ET.ParseError as e:
+        PARSE_SECONDS.observe(time.perf_counter() - start)
+        PARSED_JOURNEYS.observe(journey_count)
+        PARSED_DEPARTURES.observe(index.departure_count())
+        logger.info(f"Parsed {journey_count} journeys, indexed {index.departure_count()} departures at {len(index.by_stop)} stops")
+        return index
+        
+    except _xml.ParseError as e:
         logger.error(f"XML parsing error: {str(e)}")
         raise ValueError(f"Failed to parse XML: {str(e)}")
     except Exception as e:
         logger.error(f"Error parsing departure data: {str(e)}", exc_info=True)
         raise
 
+def parse_journeys(xml_response):
+    """
+    Parses the XML response into departures keyed by journey.
+    
+    Used to merge deliveries that only contain changed journeys into
+    existing state (see journey_state.JourneyState).
+    
+    Args:
+        xml_response (str): XML response from the Bane NOR API
+        
+    Returns:
+        list: (journey_ref, departures) tuples in document order
+        
+    Raises:
+        ValueError: If the XML parsing fails or response format is unexpected
+    """
+    if not xml_response or not isinstance(xml_response, str):
+        logger.error("Invalid XML response provided")
+        raise ValueError("Invalid XML response")
+    
+    start = time.perf_counter()
+    try:
+        root = _xml.fromstring(xml_response)
+    except _xml.ParseError as e:
+        logger.error(f"XML parsing error: {str(e)}")
+        raise ValueError(f"Failed to parse XML: {str(e)}")
+    
+    journeys = [_parse_journey(journey) for journey in root.iter(JOURNEY_TAG)]
+    PARSE_SECONDS.observe(time.perf_counter() - start)
+    PARSED_JOURNEYS.observe(len(journeys))
+    PARSED_DEPARTURES.observe(sum(len(departures) for _, departures in journeys))
+    logger.info(f"Parsed {len(journeys)} journeys")
+    return journeys
+
+def parse_departures(xml_response, station=DEFAULT_STATION):
+    """
+    Parses the XML response and groups departures from a station by direction.
+    
+    Args:
+        xml_response (str): XML response from the Bane NOR API
+        station (str): Station name from STATIONS, or a StopPointRef
+        
+    Returns:
+        dict: Dictionary with keys 'southbound' and 'northbound', each containing
+              a list of Departure records
+              
+    Raises:
+        ValueError: If the XML parsing fails or response format is unexpected
+    """
+    return parse_stop_index(xml_response).for_station(station)
+
+def iter_journeys(chunks):
+    """
+    Incrementally parses a streamed XML response, yielding each
+    EstimatedVehicleJourney as soon as it has been read.
+    
+    Each journey element is detached from its EstimatedJourneyVersionFrame
+    once processed, so memory use stays at roughly one journey regardless of
+    the size of the delivery.
+    
+    Args:
+        chunks (iterable): Byte chunks of the XML response, e.g. from
+                           fetch_data.stream_timetable()
+                           
+    Yields:
+        tuple: (journey_ref, departures) per journey, as from _parse_journey()
+        
+    Raises:
+        ValueError: If the XML parsing fails or response format is unexpected
+    """
+    parser = _xml.pull_parser()
+    journey_count = 0
+    root = None
+    frame = None
+    
+    try:
+        for chunk in chunks:
+            if not chunk:
+                continue
+            parser.feed(chunk)
+            for event, elem in parser.read_events():
+                if event == "start":
+                    if root is None:
+                        root = elem
+                    elif elem.tag == FRAME_TAG:
+                        frame = elem
+                    continue
+                if elem.tag == JOURNEY_TAG:
+                    journey_count += 1
+                    yield _parse_journey(elem)
+                    # The journey is the frame's only remaining child, so
+                    # removing it is cheap and leaves nothing behind
+                    if frame is not None and len(frame) and frame[-1] is elem:
+                        frame.remove(elem)
+                    else:
+                        elem.clear()
+                elif elem.tag == FRAME_TAG:
+                    frame = None
+                    elem.clear()
+        parser.close()
+    except _xml.ParseError as e:
+        logger.error(f"XML parsing error: {str(e)}")
+        raise ValueError(f"Failed to parse XML: {str(e)}")
+    
+    # Ensure we found the root element correctly
+    if root is not None and root.tag != SIRI_ROOT_TAG:
+        logger.warning(f"Unexpected XML root tag: {root.tag}")
+    logger.debug(f"Streamed {journey_count} journeys")
+
+def iter_departures(chunks):
+    """
+    Incrementally parses a streamed XML response, yielding departures as soon
+    as their EstimatedVehicleJourney has been read (see iter_journeys()).
+    
+    Args:
+        chunks (iterable): Byte chunks of the XML response
+        
+    Yields:
+        Departure: Departure records in document order
+        
+    Raises:
+        ValueError: If the XML parsing fails or response format is unexpected
+    """
+    for _, departures in iter_journeys(chunks):
+        yield from departures
+
+def parse_stop_index_stream(chunks):
+    """
+    Streaming counterpart of parse_stop_index().
+    
+    Args:
+        chunks (iterable): Byte chunks of the XML response
+        
+    Returns:
+        StopIndex: Departures indexed by StopPointRef and direction
+        
+    Raises:
+        ValueError: If the XML parsing fails or response format is unexpected
+    """
+    # Parsing overlaps the download here, so only the counts are recorded;
+    # the elapsed time is part of the fetch latency
+    index = StopIndex()
+    journey_count = 0
+    for _, departures in iter_journeys(chunks):
+        journey_count += 1
+        for departure in departures:
+            index.add(departure)
+    PARSED_JOURNEYS.observe(journey_count)
+    PARSED_DEPARTURES.observe(index.departure_count())
+    logger.info(f"Parsed streamed response, indexed {index.departure_count()} departures at {len(index.by_stop)} stops")
+    return index
+
+def parse_departures_stream(chunks, station=DEFAULT_STATION):
+    """
+    Streaming counterpart of parse_departures().
+    
+    Args:
+        chunks (iterable): Byte chunks of the XML response
+        station (str): Station name from STATIONS, or a StopPointRef
+        
+    Returns:
+        dict: Dictionary with keys 'southbound' and 'northbound', in the same
+              format as parse_departures()
+              
+    Raises:
+        ValueError: If the XML parsing fails or response format is unexpected
+    """
+    return parse_stop_index_stream(chunks).for_station(station)
+
 if __name__ == "__main__":
     # For testing purposes
     logging.basicConfig(level=logging.DEBUG)
@@ -0,0 +1,116 @@
+# jattavagen_departures/prefetch.py
+import logging
+import threading
+from datetime import datetime
+from .config import (
+    DEFAULT_STATION,
+    PREFETCH_INTERVAL_SECONDS,
+    PREFETCH_IDLE_INTERVAL_SECONDS,
+    PREFETCH_NIGHT_INTERVAL_SECONDS,
+    PREFETCH_NIGHT_HOURS,
+    PREFETCH_BUSY_WINDOW_MINUTES,
+)
+from .service import refresh_departures, seconds_until_next_departure, set_background_refresh
+
+# Set up logging
+logger = logging.getLogger('togtider.prefetch')
+
+def next_interval(seconds_until_next, now=None):
+    """
+    Chooses how long to wait before the next background refresh.
+    
+    Polls tightly when a train leaves soon, loosely otherwise, and rarely
+    during the configured night hours.
+    
+    Args:
+        seconds_until_next (float): Seconds until the next departure, or None
+        now (datetime, optional): Current local time, for testing
+        
+    Returns:
+        float: Seconds to wait before refreshing again
+    """
+    if seconds_until_next is not None and seconds_until_next <= PREFETCH_BUSY_WINDOW_MINUTES * 60:
+        return PREFETCH_INTERVAL_SECONDS
+    
+    hour = (now or datetime.now()).hour
+    night_start, night_end = PREFETCH_NIGHT_HOURS
+    if night_start <= night_end:
+        at_night = night_start <= hour < night_end
+    else:
+        # The night window wraps around midnight, e.g. (23, 5)
+        at_night = hour >= night_start or hour < night_end
+    if at_night:
+        return PREFETCH_NIGHT_INTERVAL_SECONDS
+    return PREFETCH_IDLE_INTERVAL_SECONDS
+
+class Prefetcher(threading.Thread):
+    """
+    Background thread that keeps the shared departure cache hot.
+    
+    Each refresh parses into a new read-only snapshot that replaces the old
+    one in a single assignment, so tool calls only ever read memory.
+    """
+    
+    def __init__(self, station=DEFAULT_STATION):
+        """
+        Args:
+            station (str): Station whose next departure sets the poll rate
+        """
+        super().__init__(name="togtider-prefetch", daemon=True)
+        self.station = station
+        self._stop_event = threading.Event()
+    
+    def refresh_once(self):
+        """
+        Refreshes the snapshot once.
+        
+        Returns:
+            float: Seconds to wait before the next refresh
+        """
+        try:
+            index = refresh_departures()
+            delay = next_interval(seconds_until_next_departure(index, self.station))
+            logger.debug(f"Snapshot refreshed, next refresh in {delay} seconds")
+            return delay
+        except Exception as e:
+            # Keep serving the previous snapshot and try again soon
+            logger.error(f"Background refresh failed: {str(e)}")
+            return PREFETCH_INTERVAL_SECONDS
+    
+    def run(self):
+        logger.info("Background prefetcher started")
+        while not self._stop_event.is_set():
+            delay = self.refresh_once()
+            self._stop_event.wait(delay)
+        logger.info("Background prefetcher stopped")
+    
+    def stop(self):
+        """Stops the thread after the current refresh finishes."""
+        self._stop_event.set()
+
+_prefetcher = None
+
+def start_prefetcher(station=DEFAULT_STATION):
+    """
+    Starts the background prefetcher if it is not already running.
+    
+    Args:
+        station (str): Station whose next departure sets the poll rate
+        
+    Returns:
+        Prefetcher: The running prefetcher thread
+    """
+    global _prefetcher
+    if _prefetcher is None or not _prefetcher.is_alive():
+        _prefetcher = Prefetcher(station)
+        set_background_refresh(True)
+        _prefetcher.start()
+    return _prefetcher
+
+def stop_prefetcher():
+    """Stops the background prefetcher and returns the cache to TTL expiry."""
+    global _prefetcher
+    if _prefetcher is not None:
+        _prefetcher.stop()
+        _prefetcher = None
+    set_background_refresh(False)
@@ -0,0 +1,75 @@
+# jattavagen_departures/query.py
+import bisect
+from operator import attrgetter
+from .parse_data import DIRECTIONS
+
+class _Run:
+    """Departures sorted by scheduled time, with their times for bisecting."""
+
+    __slots__ = ("departures", "times")
+
+    def __init__(self, departures):
+        self.departures = tuple(sorted(departures, key=attrgetter("aimed")))
+        self.times = [d.aimed for d in self.departures]
+
+    def after(self, cutoff, limit=None):
+        start = bisect.bisect_left(self.times, cutoff)
+        end = len(self.departures) if limit is None else start + limit
+        return list(self.departures[start:end])
+
+class DepartureTimeline:
+    """
+    Departures for one station in one snapshot, sorted once per direction
+    and per direction and destination.
+
+    A query bisects to the first departure at or after its cutoff and
+    slices the next N from there, so it costs O(log n + N) instead of a
+    filter and sort over the whole station.
+    """
+
+    def __init__(self, departures):
+        """
+        Args:
+            departures (dict): Departures grouped by direction, as from
+                StopIndex.for_station()
+        """
+        self._directions = {}
+        self._destinations = {}
+        for direction, group in departures.items():
+            self._directions[direction] = _Run(group)
+            by_destination = {}
+            for d in group:
+                by_destination.setdefault(d.destination, []).append(d)
+            for destination, matching in by_destination.items():
+                self._destinations[(direction, destination)] = _Run(matching)
+
+    def next(self, after, limit=None, direction=None, destination=None):
+        """
+        Finds the next departures at or after a time.
+
+        Args:
+            after (int): Epoch seconds; earlier departures are left out
+            limit (int, optional): Most departures to return per direction
+            direction (str, optional): Only this direction
+            destination (str, optional): Only departures to this destination
+
+        Returns:
+            dict: Sorted lists keyed by direction, empty for directions that
+                  were not asked for
+
+        Raises:
+            ValueError: If the direction is unknown or the limit below one
+        """
+        if direction is not None and direction not in DIRECTIONS:
+            raise ValueError(f"Unknown direction: {direction}")
+        if limit is not None and limit < 1:
+            raise ValueError(f"Limit must be at least 1, got {limit}")
+
+        upcoming = {}
+        for name in DIRECTIONS:
+            if direction is not None and name != direction:
+                upcoming[name] = []
+                continue
+            run = self._directions.get(name) if destination is None else self._destinations.get((name, destination))
+            upcoming[name] = [] if run is None else run.after(after, limit)
+        return upcoming
@@ -1,71 +1,1252 @@
 # jattavagen_departures/service.py
+import asyncio
+import collections
+import contextlib
+import copy
+import functools
+import json
 import logging
-from .fetch_data import fetch_timetable
-from .parse_data import parse_departures
-from datetime import datetime, timedelta
+import queue
+import threading
+import time
+import weakref
+from .config import (
+    CACHE_TTL_SECONDS, STREAMING_PARSE, DEFAULT_STATION, INCREMENTAL_UPDATES,
+    SNAPSHOT_PATH, STALE_WHILE_REVALIDATE, SHARED_CACHE_DIR, SHARED_CACHE_POLL_SECONDS, HISTORY_DIR,
+    ADAPTIVE_PREVIEW, PREVIEW_INTERVAL_MINUTES, BOARD_CACHE_SIZE
+)
+from .fetch_data import (
+    PreviewWindow, fetch_timetable_hedged, fetch_timetable_hedged_async, plan_batches, stream_timetable,
+    stream_timetable_async
+)
+from .history import HistoryArchive, parse_clock
+from .journey_state import JourneyState
+from .metrics import BOARD_REQUESTS, FILTER_SECONDS, FORMAT_SECONDS
+from .parse_data import DIRECTIONS, LOCAL_TZ, StopIndex, iter_journeys, parse_stop_index_stream
+from .parallel_parse import parse_journeys_parallel, parse_stop_index_parallel
+from .query import DepartureTimeline
+from .shared_cache import SharedSnapshotStore
+from .snapshot import load_snapshot, save_snapshot
+from datetime import datetime
 
 # Set up logging
 logger = logging.getLogger('togtider.service')
 
-def get_upcoming_departures():
+
+class _Flight:
+    """A single in-progress load that concurrent callers can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+def _waiter_error(error):
+    """
+    Creates a separate exception for a caller that waited on a failed load.
+    
+    Re-raising the leader's exception object from every waiting thread would
+    pile all of their tracebacks onto the same instance.
+    """
+    try:
+        return copy.copy(error)
+    except Exception:
+        return RuntimeError(f"Timetable refresh failed: {error}")
+
+
+class DepartureCache:
+    """
+    Time-to-live cache for the parsed timetable with single-flight loading.
+
+    While a refresh is in progress, every other caller that misses the cache
+    waits for that refresh instead of starting its own upstream request.
+    With stale-while-revalidate enabled, callers are instead handed the
+    expired value at once while a single refresh runs in the background.
+    """
+
+    def __init__(self, loader, ttl, async_loader=None, seed_loader=None, stale_while_revalidate=False):
+        """
+        Args:
+            loader (callable): Function returning a freshly parsed timetable
+            ttl (float): Number of seconds a loaded value stays fresh
+            async_loader (callable, optional): Coroutine function returning a
+                freshly parsed timetable, used by get_async()
+            seed_loader (callable, optional): Function returning a
+                (value, age in seconds) pair to start from, or None. Called
+                once, on first access, e.g. to warm start from disk.
+            stale_while_revalidate (bool): Serve an expired value while it
+                is refreshed in the background instead of waiting for upstream
+        """
+        self._loader = loader
+        self._async_loader = async_loader
+        self._seed_loader = seed_loader
+        self.ttl = ttl
+        self.stale_while_revalidate = stale_while_revalidate
+        self._lock = threading.Lock()
+        self._value = None
+        self._loaded_at = 0.0
+        self._flight = None
+        self._async_flight = None
+        self._async_task = None
+        # Set when the latest refresh failed and the value is left over
+        self._refresh_failed = False
+        # Set while a background refresher keeps the value up to date, so
+        # readers never trigger a fetch once a value has been loaded
+        self.serve_stale = False
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stale_hits = 0
+        self.revalidations = 0
+        self.deadline_misses = 0
+
+    def _is_fresh(self):
+        """Must be called with the lock held."""
+        if self._value is None:
+            return False
+        return self.serve_stale or time.monotonic() - self._loaded_at < self.ttl
+
+    def _replaced(self, value):
+        """Must be called with the lock held."""
+        return value is not None and self._value is not None and self._value is not value
+
+    def _seed_once(self):
+        """Must be called with the lock held."""
+        if self._seed_loader is None:
+            return
+        seed_loader, self._seed_loader = self._seed_loader, None
+        if self._value is not None:
+            return
+        try:
+            seeded = seed_loader()
+        except Exception as e:
+            logger.warning(f"Could not seed timetable cache: {str(e)}")
+            return
+        if seeded is None:
+            return
+        value, age = seeded
+        self._value = value
+        self._loaded_at = time.monotonic() - max(age, 0.0)
+        logger.info(f"Seeded timetable cache with a snapshot from {age:.0f} seconds ago")
+
+    def _serve_stale_while_revalidating(self):
+        """
+        Must be called with the lock held.
+
+        Returns:
+            bool: True if the current value should be served as it is, in
+                  which case a background refresh has been started if none
+                  was running
+        """
+        if not self.stale_while_revalidate or self._value is None:
+            return False
+        self.stale_hits += 1
+        if self._flight is None:
+            self.revalidations += 1
+            flight = self._flight = _Flight()
+            threading.Thread(
+                target=self._revalidate, args=(flight,), name="togtider-revalidate", daemon=True
+            ).start()
+        return True
+
+    def _revalidate(self, flight):
+        try:
+            self._load(flight)
+        except Exception as e:
+            logger.warning(f"Background timetable refresh failed: {str(e)}")
+
+    def _deadline_exceeded(self):
+        """
+        Called when a caller's deadline passes while a refresh is still running.
+
+        Returns:
+            The expired value, if there is one
+
+        Raises:
+            TimeoutError: If there is nothing to fall back on
+        """
+        with self._lock:
+            self.deadline_misses += 1
+            value = self._value
+        if value is None:
+            raise TimeoutError("Deadline exceeded while waiting for the timetable")
+        logger.warning("Deadline exceeded while refreshing, serving stale timetable")
+        return value
+
+    def _store(self, value):
+        """Must be called with the lock held."""
+        self._value = value
+        self._loaded_at = time.monotonic()
+        self._refresh_failed = False
+
+    def _load(self, flight):
+        """Runs the loader for a flight this thread leads."""
+        try:
+            flight.value = self._loader()
+            with self._lock:
+                self._store(flight.value)
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            with self._lock:
+                self._refresh_failed = self._value is not None
+            raise
+        finally:
+            with self._lock:
+                self._flight = None
+            flight.done.set()
+
+    def get(self, force=False, deadline=None, replacing=None):
+        """
+        Returns the cached value, loading it if it is missing or expired.
+
+        Args:
+            force (bool): Load a new value even if the cached one is fresh.
+                Still joins a load that is already in flight.
+            deadline (float, optional): time.monotonic() value after which
+                the caller stops waiting for a load. The load itself carries
+                on for the next caller; this one gets the expired value.
+            replacing (optional): With force, the value the caller found
+                wanting. If another load has replaced it already, the newer
+                value is returned without loading again.
+
+        Raises:
+            Exception: Passes through any exception raised by the loader
+            TimeoutError: If the deadline passes and there is no value yet
+        """
+        with self._lock:
+            self._seed_once()
+            if (not force or self._replaced(replacing)) and self._is_fresh():
+                self.hits += 1
+                return self._value
+            if not force and self._serve_stale_while_revalidating():
+                return self._value
+
+            flight = self._flight
+            leader = flight is None
+            if leader:
+                self.misses += 1
+                flight = self._flight = _Flight()
+            else:
+                self.coalesced += 1
+
+        if leader and deadline is None:
+            return self._load(flight)
+        if leader:
+            # Load in the background so this caller can give up at its deadline
+            threading.Thread(target=self._revalidate, args=(flight,), name="togtider-load", daemon=True).start()
+        else:
+            logger.debug("Waiting for in-flight timetable refresh")
+
+        timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+        if not flight.done.wait(timeout):
+            return self._deadline_exceeded()
+        if flight.error is not None:
+            raise _waiter_error(flight.error) from flight.error
+        return flight.value
+
+    async def get_async(self, force=False, deadline=None, replacing=None):
+        """
+        Event loop counterpart of get().
+
+        Coroutines that miss while an async refresh is running await that
+        refresh instead of blocking a thread. Async and threaded refreshes are
+        coalesced separately, so at most one of each can be in flight. Stale
+        values are revalidated in a background thread, as in get().
+
+        Args:
+            force (bool): Load a new value even if the cached one is fresh,
+                see get()
+            deadline (float, optional): time.monotonic() value after which
+                the caller stops waiting, see get()
+            replacing (optional): The value a forced load replaces, see get()
+
+        Raises:
+            Exception: Passes through any exception raised by the async loader
+            TimeoutError: If the deadline passes and there is no value yet
+        """
+        with self._lock:
+            self._seed_once()
+            if (not force or self._replaced(replacing)) and self._is_fresh():
+                self.hits += 1
+                return self._value
+            if not force and self._serve_stale_while_revalidating():
+                return self._value
+
+            future = self._async_flight
+            leader = future is None
+            if leader:
+                self.misses += 1
+                future = self._async_flight = asyncio.get_running_loop().create_future()
+            else:
+                self.coalesced += 1
+
+        if leader and deadline is None:
+            return await self._load_async(future)
+        if leader:
+            # Load in a task of its own so this caller can give up at its deadline
+            self._async_task = asyncio.create_task(self._load_async_in_background(future))
+        else:
+            logger.debug("Waiting for in-flight async timetable refresh")
+
+        try:
+            if deadline is None:
+                return await asyncio.shield(future)
+            return await asyncio.wait_for(asyncio.shield(future), max(deadline - time.monotonic(), 0))
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            if not future.done():
+                return self._deadline_exceeded()
+            raise _waiter_error(future.exception()) from future.exception()
+        except Exception as e:
+            raise _waiter_error(e) from e
+
+    async def _load_async(self, future):
+        """Runs the async loader for a flight this coroutine leads."""
+        try:
+            value = await self._async_loader()
+            with self._lock:
+                self._store(value)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                with self._lock:
+                    self._refresh_failed = self._value is not None
+                future.set_exception(e)
+                # Mark the exception as retrieved when nobody was waiting
+                future.exception()
+            raise
+        finally:
+            with self._lock:
+                self._async_flight = None
+
+    async def _load_async_in_background(self, future):
+        try:
+            await self._load_async(future)
+        except Exception as e:
+            logger.warning(f"Background timetable refresh failed: {str(e)}")
+
+    def clear(self):
+        """Drops the cached value and resets the counters."""
+        with self._lock:
+            self._value = None
+            self._loaded_at = 0.0
+            self._refresh_failed = False
+            self.hits = self.misses = self.coalesced = 0
+            self.stale_hits = self.revalidations = self.deadline_misses = 0
+
+    def age(self):
+        """
+        Returns:
+            float: Seconds since the cached value was loaded, or None if empty
+        """
+        with self._lock:
+            if self._value is None:
+                return None
+            return time.monotonic() - self._loaded_at
+
+    def is_stale(self):
+        """
+        Returns:
+            bool: True if the cached value has expired without being
+                  replaced, or the latest attempt to replace it failed
+        """
+        with self._lock:
+            if self._value is None:
+                return False
+            return self._refresh_failed or not self._is_fresh()
+
+    def stats(self):
+        """
+        Returns:
+            dict: Hit, miss and coalesced counters plus the configured TTL
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "stale_hits": self.stale_hits,
+                "revalidations": self.revalidations,
+                "deadline_misses": self.deadline_misses,
+                "ttl": self.ttl,
+                "background_refresh": self.serve_stale,
+            }
+
+
+def _requestor_for_poll():
+    """
+    Returns:
+        tuple: (requestor_ref, full) for the next poll. Without incremental
+               updates every poll is full and uses the configured requestor.
+    """
+    if not INCREMENTAL_UPDATES:
+        return None, True
+    if _journey_state.needs_full_refresh():
+        return _journey_state.start_full_refresh(), True
+    return _journey_state.requestor_ref, False
+
+
+def _batch_requestor(requestor_ref, position):
+    """
+    Returns the RequestorRef for one request of a batched poll. Each request
+    asks for different lines and stops, so with incremental updates each one
+    needs its own requestor for the API to track what it has already sent.
+    """
+    if requestor_ref is None or position == 0:
+        return requestor_ref
+    return f"{requestor_ref}-{position}"
+
+
+def _publish(index, preview_minutes=PREVIEW_INTERVAL_MINUTES):
+    """
+    Turns a freshly parsed index into the read-only snapshot handed to the
+    cache, and persists it to SNAPSHOT_PATH for the next warm start.
+    Departures that have left are added to the HISTORY_DIR archive.
+    """
+    index.freeze()
+    index.fetched_at = time.time()
+    index.preview_minutes = preview_minutes
+    if SNAPSHOT_PATH:
+        try:
+            save_snapshot(index, SNAPSHOT_PATH)
+        except OSError as e:
+            logger.warning(f"Could not save snapshot to {SNAPSHOT_PATH}: {str(e)}")
+    if _history is not None:
+        try:
+            _history.record(index, now=index.fetched_at)
+        except OSError as e:
+            logger.warning(f"Could not archive departures in {HISTORY_DIR}: {str(e)}")
+    return index
+
+
+def _load_disk_snapshot():
+    """
+    Seeds the cache from the snapshot persisted by the previous process.
+
+    Returns:
+        tuple: (StopIndex, age in seconds), or None if there is no usable snapshot
+    """
+    if not SNAPSHOT_PATH:
+        return None
+    try:
+        index = load_snapshot(SNAPSHOT_PATH)
+    except FileNotFoundError:
+        logger.debug(f"No snapshot at {SNAPSHOT_PATH}, starting cold")
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable snapshot at {SNAPSHOT_PATH}: {str(e)}")
+        return None
+    age = time.time() - index.fetched_at if index.fetched_at else float("inf")
+    return index, age
+
+
+def _parse_responses(xml_responses, full, preview_minutes=PREVIEW_INTERVAL_MINUTES):
+    """
+    Parses the buffered responses of one poll (one per batch) into a single
+    read-only snapshot. Runs in a worker thread on the async path.
+    """
+    if INCREMENTAL_UPDATES:
+        journeys = [journey for xml_response in xml_responses for journey in parse_journeys_parallel(xml_response)]
+        return _publish(_journey_state.apply(journeys, full=full))
+    indexes = [parse_stop_index_parallel(xml_response) for xml_response in xml_responses]
+    return _publish(StopIndex.merged(indexes), preview_minutes)
+
+
+def _preview_minutes():
+    """Returns the PreviewInterval in minutes for the next poll."""
+    return PREVIEW_INTERVAL_MINUTES if _preview is None else _preview.next_minutes()
+
+
+@contextlib.contextmanager
+def _resync_on_failure():
+    """
+    With INCREMENTAL_UPDATES, the upstream may count the changes of a poll as
+    delivered even when the poll fails here, in the download, the parse or
+    any one request of a batch, and would never send them again. Makes the
+    next poll a full refresh so they are not lost.
+    """
+    try:
+        yield
+    except BaseException:
+        # Includes a poll cancelled mid-download
+        if INCREMENTAL_UPDATES:
+            logger.warning("Poll failed, the next poll fetches the full timetable")
+            _journey_state.require_full_refresh()
+        raise
+
+
+def _load_stop_index():
+    """Fetches a fresh timetable from the API and indexes it by stop."""
+    with _resync_on_failure():
+        requestor_ref, full = _requestor_for_poll()
+        batches = plan_batches()
+        preview_minutes = _preview_minutes()
+        logger.debug(f"Polling {len(batches)} batched requests")
+        if STREAMING_PARSE:
+            logger.debug("Streaming timetable into incremental parser")
+            if INCREMENTAL_UPDATES:
+                journeys = [
+                    journey
+                    for position, batch in enumerate(batches)
+                    for journey in iter_journeys(stream_timetable(
+                        requestor_ref=_batch_requestor(requestor_ref, position), batch=batch))
+                ]
+                return _publish(_journey_state.apply(journeys, full=full))
+            return _publish(StopIndex.merged([
+                parse_stop_index_stream(stream_timetable(batch=batch, preview_minutes=preview_minutes))
+                for batch in batches
+            ]), preview_minutes)
+        xml_responses = [
+            fetch_timetable_hedged(_batch_requestor(requestor_ref, position), batch, preview_minutes=preview_minutes)
+            for position, batch in enumerate(batches)
+        ]
+        logger.debug("XML data fetched successfully, parsing departures")
+        return _parse_responses(xml_responses, full, preview_minutes)
+
+
+async def _stream_batch_async(parse, requestor_ref, batch, preview_minutes):
+    """
+    Streams the response to one request into parse(), which runs in a worker
+    thread and reads the chunks as they arrive, so parsing overlaps the
+    download while the event loop only hands on bytes.
+
+    Args:
+        parse (callable): Takes an iterable of byte chunks, e.g.
+            parse_stop_index_stream
+        requestor_ref, batch, preview_minutes: See fetch_data.build_request()
+
+    Returns:
+        What parse() returns
+    """
+    chunks = queue.SimpleQueue()
+    parsed = asyncio.ensure_future(asyncio.to_thread(parse, iter(chunks.get, None)))
+    # A failed download leaves the parser with a truncated document; its
+    # error is superseded by the download's
+    parsed.add_done_callback(lambda future: future.cancelled() or future.exception())
+    try:
+        async for chunk in stream_timetable_async(
+                requestor_ref=requestor_ref, batch=batch, preview_minutes=preview_minutes):
+            chunks.put(chunk)
+    finally:
+        chunks.put(None)
+    return await parsed
+
+
+def _collect_journeys(chunks):
+    return list(iter_journeys(chunks))
+
+
+async def _load_stop_index_async():
+    """
+    Fetches a fresh timetable without blocking the event loop and parses it
+    in a worker thread so other coroutines keep running meanwhile. The
+    requests of a batched poll are sent concurrently. With STREAMING_PARSE
+    each response is parsed while it downloads, as in _load_stop_index().
+    """
+    with _resync_on_failure():
+        requestor_ref, full = _requestor_for_poll()
+        batches = plan_batches()
+        preview_minutes = _preview_minutes()
+        if STREAMING_PARSE:
+            logger.debug("Streaming timetable into incremental parser in worker threads")
+            if INCREMENTAL_UPDATES:
+                streamed = await asyncio.gather(*(
+                    _stream_batch_async(_collect_journeys, _batch_requestor(requestor_ref, position), batch, None)
+                    for position, batch in enumerate(batches)
+                ))
+                journeys = [journey for batch_journeys in streamed for journey in batch_journeys]
+                return await asyncio.to_thread(lambda: _publish(_journey_state.apply(journeys, full=full)))
+            indexes = await asyncio.gather(*(
+                _stream_batch_async(parse_stop_index_stream, None, batch, preview_minutes) for batch in batches
+            ))
+            return await asyncio.to_thread(_publish, StopIndex.merged(indexes), preview_minutes)
+        xml_responses = await asyncio.gather(*(
+            fetch_timetable_hedged_async(_batch_requestor(requestor_ref, position), batch, preview_minutes=preview_minutes)
+            for position, batch in enumerate(batches)
+        ))
+        logger.debug("XML data fetched successfully, parsing departures in worker thread")
+        return await asyncio.to_thread(_parse_responses, xml_responses, full, preview_minutes)
+
+
+def _read_shared():
+    try:
+        return _shared_store.read()
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not read shared snapshot: {str(e)}")
+        return None
+
+
+def _share(index):
+    try:
+        _shared_store.publish(index)
+    except OSError as e:
+        logger.warning(f"Could not publish shared snapshot: {str(e)}")
+    return index
+
+
+def _shared_age(index):
+    if index.fetched_at is None:
+        return float("inf")
+    return time.time() - index.fetched_at
+
+
+def _shared_refresh_due(index):
+    """Returns True if the shared snapshot is missing or older than CACHE_TTL_SECONDS."""
+    return index is None or _shared_age(index) >= CACHE_TTL_SECONDS
+
+
+def _shared_abandoned(index):
+    """
+    Returns True if the shared snapshot has gone unrefreshed for twice
+    CACHE_TTL_SECONDS, e.g. because the refresher's fetches keep failing.
+    """
+    return index is not None and _shared_age(index) >= 2 * CACHE_TTL_SECONDS
+
+
+def _refresh_shared():
+    """
+    Runs one round of the elected worker's refresh timer, publishing a new
+    snapshot if the current one is due whether or not this worker has
+    had any requests of its own.
+
+    Returns:
+        float: Seconds until the shared snapshot is next due
+    """
+    try:
+        index = _cache.get(force=True)
+    except Exception as e:
+        logger.warning(f"Scheduled refresh of the shared snapshot failed: {str(e)}")
+        return SHARED_CACHE_POLL_SECONDS
+    return max(CACHE_TTL_SECONDS - _shared_age(index), SHARED_CACHE_POLL_SECONDS)
+
+
+def _shared_refresh_loop(store):
+    delay = CACHE_TTL_SECONDS
+    while True:
+        time.sleep(delay)
+        if _shared_store is not store or not store.is_refresher():
+            return
+        delay = _refresh_shared()
+
+
+def _start_shared_refresher():
+    """
+    Starts the refresh timer once this worker is elected, so the shared
+    snapshot stays fresh while the other workers get all the traffic.
+    """
+    global _shared_refresher
+    with _shared_refresher_lock:
+        if _shared_refresher is not None and _shared_refresher.is_alive():
+            return
+        _shared_refresher = threading.Thread(
+            target=_shared_refresh_loop, args=(_shared_store,), name="togtider-shared-refresh", daemon=True
+        )
+        _shared_refresher.start()
+
+
+def _follow_shared(index):
+    """Returns the snapshot a worker that is not the refresher serves."""
+    if _shared_abandoned(index):
+        logger.debug(f"Shared snapshot not refreshed for {_shared_age(index):.0f} seconds, serving it as stale")
+    return index
+
+
+def _load_shared():
+    """
+    Loader used when worker processes share one snapshot through
+    SHARED_CACHE_DIR. Only the elected refresher fetches from the API, on a
+    timer as well as on its own requests; the others pick up what it
+    publishes and report it as stale once it stops (see is_stale()). A
+    worker only fetches for itself before anything has been published.
+    """
+    index = _read_shared()
+    if not _shared_refresh_due(index):
+        return index
+    if _shared_store.try_elect():
+        _start_shared_refresher()
+        return _share(_load_stop_index())
+    if index is not None:
+        return _follow_shared(index)
+    logger.info("No shared snapshot published yet, fetching in this worker")
+    return _load_stop_index()
+
+
+async def _load_shared_async():
+    """Event loop counterpart of _load_shared()."""
+    index = await asyncio.to_thread(_read_shared)
+    if not _shared_refresh_due(index):
+        return index
+    if _shared_store.try_elect():
+        _start_shared_refresher()
+        return await asyncio.to_thread(_share, await _load_stop_index_async())
+    if index is not None:
+        return _follow_shared(index)
+    logger.info("No shared snapshot published yet, fetching in this worker")
+    return await _load_stop_index_async()
+
+
+_journey_state = JourneyState()
+_history = HistoryArchive(HISTORY_DIR) if HISTORY_DIR else None
+_shared_store = SharedSnapshotStore(SHARED_CACHE_DIR) if SHARED_CACHE_DIR else None
+_shared_refresher = None
+_shared_refresher_lock = threading.Lock()
+# Narrowed to what this process's callers need. A snapshot shared with other
+# processes, or patched by incremental deliveries that only update journeys
+# inside the window, has to cover the full window.
+_preview = (
+    PreviewWindow(slack=CACHE_TTL_SECONDS / 60)
+    if ADAPTIVE_PREVIEW and not SHARED_CACHE_DIR and not INCREMENTAL_UPDATES
+    else None
+)
+# With a shared store the cache only decides how often to look for a new
+# generation; _load_shared() decides when the API is actually asked
+_cache = DepartureCache(
+    _load_shared if _shared_store else _load_stop_index,
+    SHARED_CACHE_POLL_SECONDS if _shared_store else CACHE_TTL_SECONDS,
+    async_loader=_load_shared_async if _shared_store else _load_stop_index_async,
+    seed_loader=_load_disk_snapshot,
+    stale_while_revalidate=STALE_WHILE_REVALIDATE,
+)
+
+
+def get_cache_stats():
+    """
+    Returns:
+        dict: Counters for the shared departure cache
+    """
+    return _cache.stats()
+
+
+def is_stale():
+    """
+    Returns:
+        bool: True if departures are currently served from an expired
+              snapshot, e.g. one loaded from disk or kept after a failed
+              refresh, or a shared snapshot the refresher stopped refreshing
+    """
+    if _cache.is_stale():
+        return True
+    return _shared_store is not None and _shared_abandoned(_read_shared())
+
+
+def clear_cache():
+    """Empties the shared departure cache so the next call fetches fresh data."""
+    _cache.clear()
+    _journey_state.reset()
+    with _boards_lock:
+        _boards.clear()
+    if _preview is not None:
+        _preview.clear()
+
+
+def get_shared_cache_stats():
+    """
+    Returns:
+        dict: Generation and refresher role for the shared snapshot, or None
+              when SHARED_CACHE_DIR is not set
+    """
+    if _shared_store is None:
+        return None
+    return {
+        "directory": _shared_store.directory,
+        "generation": _shared_store.generation(),
+        "refresher": _shared_store.is_refresher(),
+    }
+
+
+def get_delay_history(station=DEFAULT_STATION, direction=None, destination=None, scheduled=None,
+                      group_by="scheduled", days=None):
+    """
+    Summarizes how late departures from a station have been, from the
+    archive kept in HISTORY_DIR.
+
+    Args:
+        station (str): Station name from STATIONS, or a StopPointRef
+        direction (str, optional): 'southbound' or 'northbound'
+        destination (str, optional): Only departures to this destination
+        scheduled (str, optional): Only departures scheduled at this local
+            time of day, as HH:MM
+        group_by (str): 'scheduled' (time of day), 'weekday' or 'hour'
+        days (float, optional): Only departures from the last days
+
+    Returns:
+        dict: Delay statistics in minutes per group and direction
+
+    Raises:
+        RuntimeError: If HISTORY_DIR is not set
+        ValueError: If the station, direction, time or grouping is unknown
+    """
+    if _history is None:
+        raise RuntimeError("No departure history is kept, set HISTORY_DIR to enable it")
+    return _history.delays(station, direction, destination, scheduled, group_by, days)
+
+
+def get_journey_stats():
+    """
+    Returns:
+        dict: Tracked journeys and full/delta update counters, meaningful
+              when INCREMENTAL_UPDATES is enabled
+    """
+    return _journey_state.stats()
+
+
+def refresh_departures():
+    """
+    Fetches and parses a new timetable and swaps it into the shared cache,
+    regardless of whether the cached one has expired.
+
+    Returns:
+        StopIndex: The newly loaded snapshot
+    """
+    return _cache.get(force=True)
+
+
+def set_background_refresh(enabled):
+    """
+    Tells the shared cache whether a background refresher owns its freshness.
+
+    While enabled, callers are always served the last loaded snapshot and
+    only the very first call (before any snapshot exists) fetches.
+
+    Args:
+        enabled (bool): Whether a background refresher is running
+    """
+    _cache.serve_stale = enabled
+
+
+def seconds_until_next_departure(index, station=DEFAULT_STATION):
+    """
+    Args:
+        index (StopIndex): A parsed snapshot
+        station (str): Station name from STATIONS, or a StopPointRef
+
+    Returns:
+        float: Seconds until the next departure from the station, or None if
+               the snapshot has no upcoming departures there
+    """
+    upcoming = [
+        group[0].aimed
+        for group in _timeline(index, station, None).next(int(time.time()), limit=1).values()
+        if group
+    ]
+    if not upcoming:
+        return None
+    return min(upcoming) - time.time()
+
+
+def _deadline(timeout):
+    """Turns a caller's timeout in seconds into a time.monotonic() deadline."""
+    return None if timeout is None else time.monotonic() + timeout
+
+
+async def get_snapshot_async(timeout=None):
+    """
+    Returns:
+        StopIndex: The current snapshot, refreshed first if it has expired
+    """
+    return await _cache.get_async(deadline=_deadline(timeout))
+
+
+# Sorted departures per station, built once for each snapshot
+_timelines = weakref.WeakKeyDictionary()
+
+
+def _timeline(index, station, line):
+    timelines = _timelines.get(index)
+    if timelines is None:
+        timelines = _timelines.setdefault(index, {})
+    timeline = timelines.get((station, line))
+    if timeline is None:
+        # Concurrent callers may both build it, which is harmless
+        timeline = timelines[(station, line)] = DepartureTimeline(index.for_station(station, line))
+    return timeline
+
+
+def _cutoff(after=None):
+    """
+    Args:
+        after (str, optional): Local time of day today as HH:MM
+
+    Returns:
+        int: Epoch seconds from which departures count as upcoming; never
+             earlier than now, since departed trains are left out
+    """
+    now = int(time.time())
+    if after is None:
+        return now
+    minute = parse_clock(after)
+    today = datetime.now(LOCAL_TZ).replace(hour=minute // 60, minute=minute % 60, second=0, microsecond=0)
+    return max(now, int(today.timestamp()))
+
+
+def query_departures(index, station=DEFAULT_STATION, line=None, limit=None, direction=None,
+                     destination=None, after=None):
+    """
+    Looks up the next departures from a station in a snapshot.
+
+    Args:
+        index (StopIndex): A parsed snapshot
+        station (str): Station name from STATIONS, or a StopPointRef
+        line (str, optional): Only include departures on this LineRef
+        limit (int, optional): Most departures to return per direction
+        direction (str, optional): Only this direction
+        destination (str, optional): Only departures to this destination
+        after (str, optional): Only departures from this local time of day
+            today, as HH:MM
+
+    Returns:
+        dict: Sorted lists of upcoming departures keyed by direction
+
+    Raises:
+        ValueError: If the station, direction, limit or time is invalid
+    """
+    start = time.perf_counter()
+    upcoming = _timeline(index, station, line).next(_cutoff(after), limit, direction, destination)
+    FILTER_SECONDS.observe(time.perf_counter() - start)
+    if _preview is not None:
+        _record_need(index, upcoming, limit, direction)
+    return upcoming
+
+
+def _record_need(index, upcoming, limit, direction):
+    """
+    Tells the preview window how far ahead a query's answer reached: the
+    last departure a limited query returned, and the whole window for any
+    other query or for a limited one that came back short, so that a single
+    refresh answers it in full (see _widen()).
+    """
+    if limit is None:
+        _preview.need(PREVIEW_INTERVAL_MINUTES)
+        return
+    furthest = None
+    for name in DIRECTIONS if direction is None else (direction,):
+        group = upcoming[name]
+        if len(group) < limit:
+            _preview.need(PREVIEW_INTERVAL_MINUTES)
+            return
+        if furthest is None or group[-1].aimed > furthest:
+            furthest = group[-1].aimed
+    _preview.need((furthest - time.time()) / 60)
+
+
+def _cut_short(index, upcoming, limit, direction):
+    """
+    Returns:
+        bool: True if the snapshot was requested for a narrowed preview
+              window and the query needs more of it: every query without a
+              limit, and a limited one that got fewer departures than it
+              asked for
+    """
+    if not index.preview_minutes or index.preview_minutes >= PREVIEW_INTERVAL_MINUTES:
+        return False
+    if limit is None:
+        return True
+    return any(len(upcoming[name]) < limit for name in (DIRECTIONS if direction is None else (direction,)))
+
+
+def _widen(index, deadline):
+    """
+    Refreshes a snapshot whose preview window was too narrow for a query.
+    The query has already recorded its need for the whole window, so the
+    refresh asks for that. Callers that find the same snapshot wanting
+    share one refresh, and a caller whose snapshot was already replaced
+    gets the newer one without another fetch.
+    """
+    logger.info(f"Too few departures within {index.preview_minutes} minutes, refreshing with a wider preview window")
+    return _cache.get(force=True, deadline=deadline, replacing=index)
+
+
+async def _widen_async(index, deadline):
+    """Event loop counterpart of _widen()."""
+    logger.info(f"Too few departures within {index.preview_minutes} minutes, refreshing with a wider preview window")
+    return await _cache.get_async(force=True, deadline=deadline, replacing=index)
+
+
+def get_upcoming_departures(station=DEFAULT_STATION, line=None, timeout=None, limit=None,
+                            direction=None, destination=None, after=None):
     """
     Fetches the XML timetable, parses departures,
     filters out departures that have already passed,
     sorts them, and returns a dictionary with groups.
+
+    The parsed timetable is indexed by stop and shared between callers for
+    CACHE_TTL_SECONDS, so concurrent requests for any station on the line
+    result in at most one upstream fetch. Each station's departures are
+    sorted once per snapshot, see query_departures(). A query without a
+    limit, or a limited one that comes back short, from a snapshot with a
+    narrowed preview window is answered again from a refresh with the full
+    window (see ADAPTIVE_PREVIEW).
+
+    Args:
+        station (str): Station name from STATIONS, or a StopPointRef
+        line (str, optional): Only include departures on this LineRef
+        timeout (float, optional): Seconds to wait for a refresh before
+            answering from the expired snapshot (see is_stale())
+        limit, direction, destination, after: See query_departures()
+
+    Raises:
+        TimeoutError: If the timeout passes before any snapshot has loaded
     """
-    logger.info("Fetching timetable data")
+    logger.info(f"Fetching timetable data for {station}")
     try:
-        xml_response = fetch_timetable()
-        logger.debug("XML data fetched successfully, parsing departures")
-        departures = parse_departures(xml_response)
-        
-        # Get current time as offset-aware
-        now = datetime.now().astimezone()
-        logger.debug(f"Current time: {now.isoformat()}")
-        
-        # Filter and sort departures by adding the offset correction
-        for direction, group in departures.items():
-            logger.debug(f"Processing {len(group)} {direction} departures")
-            group[:] = [
-                d for d in group 
-                if (datetime.fromisoformat(d["AimedDepartureTime"]) + timedelta(hours=2)) >= now
-            ]
-            group.sort(key=lambda d: datetime.fromisoformat(d["AimedDepartureTime"]) + timedelta(hours=2))
-            logger.debug(f"After filtering: {len(group)} {direction} departures remaining")
-        
-        return departures
+        deadline = _deadline(timeout)
+        index = _cache.get(deadline=deadline)
+        upcoming = query_departures(index, station, line, limit, direction, destination, after)
+        if _cut_short(index, upcoming, limit, direction):
+            wider = _widen(index, deadline)
+            if wider is not index:
+                upcoming = query_departures(wider, station, line, limit, direction, destination, after)
+        return upcoming
     except Exception as e:
         logger.error(f"Error getting departures: {str(e)}", exc_info=True)
         raise
 
+async def get_upcoming_departures_async(station=DEFAULT_STATION, line=None, timeout=None, limit=None,
+                                        direction=None, destination=None, after=None):
+    """
+    Async counterpart of get_upcoming_departures() for use inside an event
+    loop, e.g. by the MCP server. The fetch does not block the loop and the
+    parse runs in a worker thread.
+
+    Args:
+        station (str): Station name from STATIONS, or a StopPointRef
+        line (str, optional): Only include departures on this LineRef
+        timeout (float, optional): Seconds to wait for a refresh, see
+            get_upcoming_departures()
+        limit, direction, destination, after: See query_departures()
+    """
+    logger.info(f"Fetching timetable data for {station}")
+    try:
+        deadline = _deadline(timeout)
+        index = await _cache.get_async(deadline=deadline)
+        upcoming = query_departures(index, station, line, limit, direction, destination, after)
+        if _cut_short(index, upcoming, limit, direction):
+            wider = await _widen_async(index, deadline)
+            if wider is not index:
+                upcoming = query_departures(wider, station, line, limit, direction, destination, after)
+        return upcoming
+    except Exception as e:
+        logger.error(f"Error getting departures: {str(e)}", exc_info=True)
+        raise
+
+@functools.lru_cache(maxsize=4096)
+def _clock(minute):
+    """Formats an epoch minute as local HH:MM; cached since boards repeat the same minutes."""
+    return datetime.fromtimestamp(minute * 60, LOCAL_TZ).strftime("%H:%M")
+
+def format_departure(dep):
+    """
+    Formats one departure as shown on the board.
+
+    Returns:
+        dict: Local aimed and actual time, destination and status
+    """
+    aimed = _clock(dep.aimed // 60)
+    actual = _clock(dep.actual // 60) if dep.actual is not None else aimed
+    status = "on schedule" if aimed == actual else "delayed"
+    return {
+        "aimed": aimed,
+        "actual": actual,
+        "destination": dep.destination,
+        "status": status
+    }
+
 def format_departures(departures):
     """
     Format the departures into a JSON-friendly dict structure.
     """
-    from datetime import datetime, timedelta
-    
     logger.info("Formatting departure data")
-    
-    def format_iso_timestamp(iso_str):
-        dt = datetime.fromisoformat(iso_str) + timedelta(hours=2)
-        return dt.strftime("%H:%M")
+    start = time.perf_counter()
     
     formatted = {
         "timestamp": datetime.now().isoformat()
     }
     
     for direction, deps in departures.items():
-        formatted[direction] = []
-        for dep in deps:
-            aimed = format_iso_timestamp(dep['AimedDepartureTime'])
-            actual = format_iso_timestamp(dep['ActualDepartureTime']) if dep['ActualDepartureTime'] else aimed
-            status = "on schedule" if aimed == actual else "delayed"
-            formatted[direction].append({
-                "aimed": aimed,
-                "actual": actual,
-                "destination": dep['Destination'],
-                "status": status
-            })
+        formatted[direction] = [format_departure(dep) for dep in deps]
     
+    FORMAT_SECONDS.observe(time.perf_counter() - start)
     logger.info(f"Formatted {sum(len(deps) for deps in departures.values())} departures")
     return formatted
+
+
+def _snapshot_version(index):
+    """
+    Identifies a snapshot. The fetch time is stored in snapshot files, so
+    processes sharing a snapshot (see SHARED_CACHE_DIR) agree on it.
+    """
+    if index.fetched_at is None:
+        return f"i{id(index):x}"
+    return f"{int(index.fetched_at * 1000):x}"
+
+
+class DepartureBoard:
+    """
+    A formatted and serialized board for one station, built once and then
+    shared read-only between callers for as long as it is unchanged.
+
+    The board depends only on the snapshot and on which departures are
+    still upcoming, so it stays valid until a new snapshot arrives or its
+    earliest departure leaves. The version names exactly that, and a client
+    holding a board with the same version has the same departures.
+    """
+
+    __slots__ = ("version", "data", "json", "snapshot_version", "valid_through", "cut_short")
+
+    def __init__(self, index, departures):
+        """
+        Args:
+            index (StopIndex): The snapshot the board was built from
+            departures (dict): Upcoming departures per direction, as from
+                query_departures()
+        """
+        first = min((group[0].aimed for group in departures.values() if group), default=None)
+        self.snapshot_version = _snapshot_version(index)
+        # query_departures() keeps departures with aimed >= now
+        self.valid_through = first
+        self.version = self.snapshot_version if first is None else f"{self.snapshot_version}-{first:x}"
+        self.data = format_departures(departures)
+        self.json = json.dumps(self.data, ensure_ascii=False)
+        # Set by _board() when the query needs a wider preview window
+        self.cut_short = False
+
+    def is_current(self, index):
+        """
+        Returns:
+            bool: True if the board still shows what query_departures()
+                  would give for the snapshot right now
+        """
+        if self.snapshot_version != _snapshot_version(index):
+            return False
+        return self.valid_through is None or int(time.time()) <= self.valid_through
+
+
+# Boards of each snapshot, dropped with it, so a board is never served from
+# a snapshot with a different preview window; within a snapshot at most
+# BOARD_CACHE_SIZE, since queries carry caller-supplied values
+_boards = weakref.WeakKeyDictionary()
+_boards_lock = threading.Lock()
+
+
+def _board(index, station, line, query):
+    """Returns the cached board for the query, rebuilding it if it has changed."""
+    key = (station, line, *query)
+    if query[-1] is not None:
+        # A time of day names a different moment once the date has changed
+        key += (datetime.now(LOCAL_TZ).date(),)
+    with _boards_lock:
+        boards = _boards.get(index)
+        if boards is None:
+            boards = _boards[index] = collections.OrderedDict()
+        board = boards.get(key)
+        if board is not None:
+            boards.move_to_end(key)
+    if board is not None and board.is_current(index):
+        BOARD_REQUESTS.inc(result="hit")
+        return board
+    # Concurrent callers may both rebuild, which is harmless
+    upcoming = query_departures(index, station, line, *query)
+    board = DepartureBoard(index, upcoming)
+    board.cut_short = _cut_short(index, upcoming, query[0], query[1])
+    with _boards_lock:
+        boards[key] = board
+        boards.move_to_end(key)
+        while len(boards) > BOARD_CACHE_SIZE:
+            boards.popitem(last=False)
+    BOARD_REQUESTS.inc(result="miss")
+    return board
+
+
+def get_departure_board(station=DEFAULT_STATION, line=None, timeout=None, limit=None,
+                        direction=None, destination=None, after=None):
+    """
+    Like get_upcoming_departures(), but returns the formatted board, which
+    is only rebuilt when the snapshot changes or a departure has passed.
+
+    Args:
+        station (str): Station name from STATIONS, or a StopPointRef
+        line (str, optional): Only include departures on this LineRef
+        timeout (float, optional): Seconds to wait for a refresh, see
+            get_upcoming_departures()
+        limit, direction, destination, after: See query_departures()
+
+    Returns:
+        DepartureBoard: The board; its data must not be modified
+    """
+    logger.info(f"Fetching departure board for {station}")
+    deadline = _deadline(timeout)
+    query = (limit, direction, destination, after)
+    index = _cache.get(deadline=deadline)
+    board = _board(index, station, line, query)
+    if board.cut_short:
+        wider = _widen(index, deadline)
+        if wider is not index:
+            board = _board(wider, station, line, query)
+    return board
+
+
+async def get_departure_board_async(station=DEFAULT_STATION, line=None, timeout=None, limit=None,
+                                    direction=None, destination=None, after=None):
+    """Async counterpart of get_departure_board()."""
+    logger.info(f"Fetching departure board for {station}")
+    deadline = _deadline(timeout)
+    query = (limit, direction, destination, after)
+    index = await _cache.get_async(deadline=deadline)
+    board = _board(index, station, line, query)
+    if board.cut_short:
+        wider = await _widen_async(index, deadline)
+        if wider is not index:
+            board = _board(wider, station, line, query)
+    return board
+
+
+def board_response(board, station, since_version=None):
+    """
+    Builds the tool response for a board.
+
+    Args:
+        board (DepartureBoard): The current board
+        station (str): The station the board was requested for
+        since_version (str, optional): Version the client already has; if
+            it is still current only a short not-modified reply is built
+
+    Returns:
+        dict: JSON-compatible response
+    """
+    if since_version is not None and since_version == board.version:
+        BOARD_REQUESTS.inc(result="not_modified")
+        return {
+            "not_modified": True,
+            "version": board.version,
+            "station": station,
+            "stale": is_stale(),
+        }
+    return {
+        "data": board.data,
+        "station": station,
+        "stale": is_stale(),
+        "version": board.version,
+        "timestamp": board.data.get("timestamp", None)
+    }
+
+
+def board_response_json(board, station, since_version=None):
+    """
+    Serialized form of board_response(). The board itself was serialized
+    when it was built, so only the few response fields around it are
+    encoded per call.
+
+    Returns:
+        str: The response as JSON
+    """
+    response = board_response(board, station, since_version)
+    if "data" not in response:
+        return json.dumps(response, ensure_ascii=False)
+    envelope = json.dumps({key: value for key, value in response.items() if key != "data"}, ensure_ascii=False)
+    return f'{{"data": {board.json}, {envelope[1:]}'
@@ -0,0 +1,144 @@
+# jattavagen_departures/shared_cache.py
+import logging
+import mmap
+import os
+import struct
+import threading
+from .snapshot import load_snapshot, save_snapshot
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Set up logging
+logger = logging.getLogger('togtider.shared')
+
+SNAPSHOT_FILE = "snapshot.bin"
+GENERATION_FILE = "generation"
+LOCK_FILE = "refresher.lock"
+GENERATION = struct.Struct("<Q")
+
+class SharedSnapshotStore:
+    """
+    A snapshot shared by every worker process using the same directory.
+
+    One worker at a time is elected refresher by holding an exclusive lock
+    on a file; the lock is released by the operating system when that
+    worker exits, so another one takes over on its next poll. The
+    refresher writes snapshots in the snapshot.py format and then bumps a
+    generation counter in a small memory-mapped file. Readers never take a
+    lock: they compare the counter with the generation they hold and only
+    reload the snapshot file when it has moved on.
+    """
+
+    def __init__(self, directory):
+        """
+        Args:
+            directory (str): Directory shared by the workers
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.snapshot_path = os.path.join(directory, SNAPSHOT_FILE)
+        self._lock = threading.Lock()
+        self._lock_file = None
+        self._index = None
+        self._generation = None
+
+        generation_path = os.path.join(directory, GENERATION_FILE)
+        fd = os.open(generation_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < GENERATION.size:
+                os.ftruncate(fd, GENERATION.size)
+            self._counter = mmap.mmap(fd, GENERATION.size)
+        finally:
+            os.close(fd)
+
+    def try_elect(self):
+        """
+        Makes this process the refresher if no other process is.
+
+        Returns:
+            bool: True if this process is the refresher
+        """
+        with self._lock:
+            if self._lock_file is not None:
+                return True
+            if fcntl is None:
+                # Without advisory locks every process refreshes for itself
+                return True
+            lock_file = open(os.path.join(self.directory, LOCK_FILE), "a+b")
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            self._lock_file = lock_file
+        logger.info(f"Elected refresher for the shared snapshot in {self.directory}")
+        return True
+
+    def is_refresher(self):
+        with self._lock:
+            return self._lock_file is not None or fcntl is None
+
+    def resign(self):
+        """Gives up the refresher role, e.g. on shutdown."""
+        with self._lock:
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+
+    def generation(self):
+        """
+        Returns:
+            int: The generation of the latest published snapshot, 0 if none
+        """
+        return GENERATION.unpack_from(self._counter)[0]
+
+    def publish(self, index):
+        """
+        Writes a new snapshot and moves the generation on. Must only be
+        called by the refresher.
+
+        Args:
+            index (StopIndex): The frozen snapshot to share
+        """
+        save_snapshot(index, self.snapshot_path)
+        generation = self.generation() + 1
+        # Readers only look at the snapshot file after seeing the new
+        # generation, and the file was replaced atomically before it
+        GENERATION.pack_into(self._counter, 0, generation)
+        with self._lock:
+            self._index = index
+            self._generation = generation
+        logger.debug(f"Published shared snapshot generation {generation}")
+
+    def read(self):
+        """
+        Returns the latest published snapshot, reloading it only if another
+        process has published since the last call.
+
+        Returns:
+            StopIndex: The snapshot, or None if nothing has been published
+
+        Raises:
+            ValueError: If the snapshot file is corrupt
+        """
+        generation = self.generation()
+        with self._lock:
+            if generation == self._generation:
+                return self._index
+        if generation == 0:
+            return None
+        try:
+            index = load_snapshot(self.snapshot_path)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            self._index = index
+            self._generation = generation
+        return index
+
+    def close(self):
+        self.resign()
+        self._counter.close()
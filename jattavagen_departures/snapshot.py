@@ -0,0 +1,182 @@
+# jattavagen_departures/snapshot.py
+import logging
+import mmap
+import os
+import struct
+import tempfile
+from .parse_data import Departure, StopIndex
+
+# Set up logging
+logger = logging.getLogger('togtider.snapshot')
+
+# File layout, all little-endian:
+#   header   magic, format version, flags, fetched_at, string count,
+#            departure count, size of the string data
+#   offsets  (string count + 1) uint32 offsets into the string data
+#   strings  UTF-8 string data
+#   records  one fixed-size record per departure, grouped by stop and direction
+# Every field has a fixed position, so the file can be memory-mapped and
+# read without copying it first.
+MAGIC = b"TGSN"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sHHdIII")
+OFFSET = struct.Struct("<I")
+# stop, aimed, actual, direction, destination, journey_ref, line_ref
+RECORD = struct.Struct("<IqqIIII")
+
+# Placeholders for departures without an actual time or an optional string
+NO_TIME = -(2 ** 63)
+NO_STRING = 0xFFFFFFFF
+
+def _departures(index):
+    for directions in index.by_stop.values():
+        for group in directions.values():
+            yield from group
+
+def dump_snapshot(index):
+    """
+    Serializes a StopIndex into the snapshot format.
+
+    Args:
+        index (StopIndex): The snapshot to serialize
+
+    Returns:
+        bytes: The encoded snapshot
+    """
+    strings = {}
+
+    def ref(value):
+        if value is None:
+            return NO_STRING
+        position = strings.get(value)
+        if position is None:
+            position = strings[value] = len(strings)
+        return position
+
+    records = [
+        RECORD.pack(
+            ref(d.stop_ref),
+            d.aimed,
+            NO_TIME if d.actual is None else d.actual,
+            ref(d.direction),
+            ref(d.destination),
+            ref(d.journey_ref),
+            ref(d.line_ref),
+        )
+        for d in _departures(index)
+    ]
+
+    encoded = [value.encode("utf-8") for value in strings]
+    offsets = [0]
+    for value in encoded:
+        offsets.append(offsets[-1] + len(value))
+
+    fetched_at = index.fetched_at if index.fetched_at is not None else 0.0
+    return b"".join([
+        HEADER.pack(MAGIC, FORMAT_VERSION, 0, fetched_at, len(encoded), len(records), offsets[-1]),
+        b"".join(OFFSET.pack(offset) for offset in offsets),
+        b"".join(encoded),
+        b"".join(records),
+    ])
+
+def load_snapshot_bytes(data):
+    """
+    Rebuilds a StopIndex from an encoded snapshot.
+
+    Args:
+        data (bytes-like): The encoded snapshot, e.g. a memory-mapped file
+
+    Returns:
+        StopIndex: The frozen snapshot, with fetched_at set
+
+    Raises:
+        ValueError: If the data is not a snapshot, is truncated, or was
+            written by an incompatible format version
+    """
+    view = memoryview(data)
+    try:
+        if len(view) < HEADER.size:
+            raise ValueError("Snapshot is truncated")
+        magic, version, _, fetched_at, string_count, departure_count, strings_size = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError("Not a togtider snapshot")
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {version}, expected {FORMAT_VERSION}")
+
+        offsets_start = HEADER.size
+        strings_start = offsets_start + OFFSET.size * (string_count + 1)
+        records_start = strings_start + strings_size
+        if len(view) != records_start + RECORD.size * departure_count:
+            raise ValueError("Snapshot is truncated")
+
+        offsets = [offset for (offset,) in struct.iter_unpack("<I", view[offsets_start:strings_start])]
+        blob = view[strings_start:records_start]
+        strings = [str(blob[start:end], "utf-8") for start, end in zip(offsets, offsets[1:])]
+        strings.append(None)  # Resolves NO_STRING through the same lookup
+
+        def lookup(position):
+            return strings[position if position != NO_STRING else -1]
+
+        index = StopIndex()
+        for stop, aimed, actual, direction, destination, journey_ref, line_ref in RECORD.iter_unpack(view[records_start:]):
+            index.add(Departure(
+                lookup(stop),
+                aimed,
+                None if actual == NO_TIME else actual,
+                lookup(direction),
+                lookup(destination),
+                lookup(journey_ref),
+                lookup(line_ref),
+            ))
+    except (struct.error, IndexError, KeyError, UnicodeDecodeError) as e:
+        raise ValueError(f"Corrupt snapshot: {str(e)}")
+    finally:
+        view.release()
+
+    index.fetched_at = fetched_at or None
+    return index.freeze()
+
+def save_snapshot(index, path):
+    """
+    Writes a snapshot to disk.
+
+    The file is replaced atomically, so a reader (or a crash halfway
+    through) never sees a partially written snapshot.
+
+    Args:
+        index (StopIndex): The snapshot to write
+        path (str): Destination file
+    """
+    data = dump_snapshot(index)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".togtider-", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    logger.debug(f"Saved snapshot with {index.departure_count()} departures ({len(data)} bytes) to {path}")
+
+def load_snapshot(path):
+    """
+    Reads a snapshot written by save_snapshot().
+
+    Args:
+        path (str): Snapshot file
+
+    Returns:
+        StopIndex: The frozen snapshot, with fetched_at set
+
+    Raises:
+        OSError: If the file cannot be read
+        ValueError: If the file is not a valid snapshot
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError("Snapshot is empty")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            index = load_snapshot_bytes(mapped)
+    logger.info(f"Loaded snapshot with {index.departure_count()} departures from {path}")
+    return index
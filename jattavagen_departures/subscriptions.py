@@ -0,0 +1,224 @@
+# jattavagen_departures/subscriptions.py
+import logging
+import threading
+from urllib.parse import quote, unquote
+from .parse_data import DIRECTIONS
+from .service import format_departure, query_departures
+
+# Set up logging
+logger = logging.getLogger('togtider.subscriptions')
+
+BOARD_URI_PREFIX = "togtider://departures/"
+BOARD_URI_TEMPLATE = BOARD_URI_PREFIX + "{station}/{direction}"
+
+def board_uri(station, direction):
+    """
+    Returns:
+        str: The resource URI of a station's board in one direction
+    """
+    return f"{BOARD_URI_PREFIX}{quote(station, safe='')}/{direction}"
+
+def parse_board_uri(uri):
+    """
+    Returns:
+        tuple: (station, direction) named by a board URI
+
+    Raises:
+        ValueError: If the URI is not a board URI
+    """
+    if not uri.startswith(BOARD_URI_PREFIX):
+        raise ValueError(f"Not a departure board: {uri}")
+    station, _, direction = uri[len(BOARD_URI_PREFIX):].partition("/")
+    if not station or direction not in DIRECTIONS:
+        raise ValueError(f"Not a departure board: {uri}")
+    return unquote(station), direction
+
+def snapshot_lookup(index):
+    """
+    Returns:
+        callable: (station, direction) -> upcoming departures in the snapshot
+    """
+    return lambda station, direction: query_departures(index, station, direction=direction)[direction]
+
+def departure_id(departure):
+    """
+    Identifies a departure across snapshots: its journey, or its
+    destination when the journey is unknown, and its scheduled time.
+    """
+    return f"{departure.journey_ref or departure.destination}@{departure.aimed}"
+
+def _entry(departure):
+    return {"id": departure_id(departure), **format_departure(departure)}
+
+def diff_departures(old, new):
+    """
+    Compares two boards as shown to clients, so changes that do not alter
+    the displayed minute are not reported.
+
+    Args:
+        old (list): Departures previously sent
+        new (list): Departures now upcoming
+
+    Returns:
+        list: 'removed' (departed or cancelled), 'added' and 'changed'
+              entries, in that order; changed entries carry the new
+              actual time and status_changed when the status flipped
+    """
+    before = {departure_id(d): d for d in old}
+    after = {departure_id(d): d for d in new}
+
+    changes = [{"change": "removed", "id": key} for key in before if key not in after]
+    for key, departure in after.items():
+        previous = before.get(key)
+        if previous is None:
+            changes.append({"change": "added", **_entry(departure)})
+            continue
+        shown, was_shown = format_departure(departure), format_departure(previous)
+        if shown != was_shown:
+            changes.append({
+                "change": "changed",
+                "id": key,
+                **shown,
+                "status_changed": shown["status"] != was_shown["status"],
+            })
+    return changes
+
+class _Topic:
+    __slots__ = ("station", "direction", "departures", "version", "subscribers")
+
+    def __init__(self, station, direction, departures):
+        self.station = station
+        self.direction = direction
+        self.departures = departures
+        self.version = 0
+        self.subscribers = set()
+
+class BoardUpdate:
+    """The changes to one board, computed once for all of its subscribers."""
+
+    __slots__ = ("uri", "version", "changes", "subscribers")
+
+    def __init__(self, uri, version, changes, subscribers):
+        self.uri = uri
+        self.version = version
+        self.changes = changes
+        self.subscribers = subscribers
+
+class SubscriptionHub:
+    """
+    Subscribers per station and direction, and the board each of them was
+    last sent.
+
+    update() diffs every subscribed board against the current snapshot once,
+    however many clients follow it, and returns the same changes for all of
+    them. Subscribers are opaque hashable handles, e.g. MCP sessions.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._topics = {}
+
+    def subscribe(self, subscriber, station, direction, lookup):
+        """
+        Args:
+            subscriber (hashable): Who to notify
+            station (str): Station name from STATIONS, or a StopPointRef
+            direction (str): 'southbound' or 'northbound'
+            lookup (callable): (station, direction) -> upcoming departures,
+                used for the board new subscribers start from
+
+        Returns:
+            str: The URI notifications for the board are sent for
+
+        Raises:
+            ValueError: If the station or direction is unknown
+        """
+        if direction not in DIRECTIONS:
+            raise ValueError(f"Unknown direction: {direction}")
+        key = (station, direction)
+        with self._lock:
+            topic = self._topics.get(key)
+        if topic is None:
+            departures = lookup(station, direction)
+            with self._lock:
+                topic = self._topics.setdefault(key, _Topic(station, direction, departures))
+        with self._lock:
+            topic.subscribers.add(subscriber)
+        logger.info(f"Subscribed to {station} {direction}")
+        return board_uri(station, direction)
+
+    def unsubscribe(self, subscriber, station=None, direction=None):
+        """
+        Stops notifying a subscriber about one board, or about every board
+        when no station is given.
+        """
+        with self._lock:
+            for key, topic in list(self._topics.items()):
+                if station is not None and key != (station, direction):
+                    continue
+                topic.subscribers.discard(subscriber)
+                if not topic.subscribers:
+                    del self._topics[key]
+
+    def has_subscribers(self):
+        with self._lock:
+            return bool(self._topics)
+
+    def board(self, station, direction, lookup):
+        """
+        Returns a board as a subscriber sees it, so diffs can be applied to it.
+
+        Args:
+            station (str): Station name from STATIONS, or a StopPointRef
+            direction (str): 'southbound' or 'northbound'
+            lookup (callable): Used when nobody follows the board yet
+
+        Returns:
+            dict: Version and departures, each with its id
+        """
+        if direction not in DIRECTIONS:
+            raise ValueError(f"Unknown direction: {direction}")
+        with self._lock:
+            topic = self._topics.get((station, direction))
+            if topic is not None:
+                version, departures = topic.version, topic.departures
+        if topic is None:
+            version, departures = 0, lookup(station, direction)
+        return {
+            "station": station,
+            "direction": direction,
+            "version": version,
+            "departures": [_entry(d) for d in departures],
+        }
+
+    def update(self, lookup):
+        """
+        Diffs every subscribed board against the current departures.
+
+        Args:
+            lookup (callable): (station, direction) -> upcoming departures
+
+        Returns:
+            list: A BoardUpdate for every board that changed
+        """
+        with self._lock:
+            topics = list(self._topics.values())
+        updates = []
+        for topic in topics:
+            try:
+                departures = lookup(topic.station, topic.direction)
+            except ValueError as e:
+                logger.warning(f"Cannot update {topic.station} {topic.direction}: {str(e)}")
+                continue
+            changes = diff_departures(topic.departures, departures)
+            if not changes:
+                continue
+            with self._lock:
+                topic.departures = departures
+                topic.version += 1
+                updates.append(BoardUpdate(
+                    board_uri(topic.station, topic.direction), topic.version, changes, list(topic.subscribers)
+                ))
+        if updates:
+            logger.debug(f"{len(updates)} of {len(topics)} subscribed boards changed")
+        return updates
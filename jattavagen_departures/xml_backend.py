@@ -0,0 +1,116 @@
+# jattavagen_departures/xml_backend.py
+import logging
+import threading
+import xml.etree.ElementTree as ET
+
+# Set up logging
+logger = logging.getLogger('togtider.xml')
+
+class StdlibBackend:
+    """Builds trees with xml.etree.ElementTree, which is always available."""
+
+    name = "stdlib"
+    ParseError = ET.ParseError
+
+    def fromstring(self, text):
+        """
+        Args:
+            text (str or bytes): A complete XML document
+
+        Returns:
+            Element: The root element
+        """
+        return ET.fromstring(text)
+
+    def pull_parser(self):
+        """
+        Returns:
+            XMLPullParser: A parser reporting start and end events
+        """
+        return ET.XMLPullParser(events=("start", "end"))
+
+class LxmlBackend:
+    """
+    Builds trees with lxml. Elements expose the same tag, text, iteration
+    and removal API, so the parse code is shared.
+
+    libxml2 builds a delivery's tree faster than the stdlib parser, but
+    walking an lxml tree from Python is slower, since every element visited
+    needs a proxy object, so a whole parse takes about as long on either
+    backend. lxml's pull parser is slower than the stdlib's at the
+    journey-sized chunks the streaming parser reads, so streams can be left
+    to the stdlib.
+
+    Entity expansion and network access are switched off, and libxml2's
+    limits on node size and nesting depth are kept, since the documents
+    come from over the network.
+    """
+
+    name = "lxml"
+
+    def __init__(self, stdlib_streams=False):
+        """
+        Args:
+            stdlib_streams (bool): Use the stdlib pull parser for streams
+        """
+        from lxml import etree
+        self._etree = etree
+        self._stdlib_streams = stdlib_streams
+        self.ParseError = (etree.ParseError, ET.ParseError)
+        # lxml parsers must not be shared between threads
+        self._local = threading.local()
+
+    def _parser(self, decoded):
+        """Returns this thread's parser for decoded text or for raw bytes."""
+        name = "text_parser" if decoded else "bytes_parser"
+        parser = getattr(self._local, name, None)
+        if parser is None:
+            # Decoded text no longer has the encoding its declaration names
+            parser = self._etree.XMLParser(
+                encoding="utf-8" if decoded else None,
+                resolve_entities=False,
+                no_network=True,
+            )
+            setattr(self._local, name, parser)
+        return parser
+
+    def fromstring(self, text):
+        if isinstance(text, str):
+            return self._etree.fromstring(text.encode("utf-8"), self._parser(decoded=True))
+        return self._etree.fromstring(text, self._parser(decoded=False))
+
+    def pull_parser(self):
+        if self._stdlib_streams:
+            return StdlibBackend.pull_parser(self)
+        return self._etree.XMLPullParser(
+            events=("start", "end"), resolve_entities=False, no_network=True
+        )
+
+BACKENDS = {
+    StdlibBackend.name: StdlibBackend,
+    LxmlBackend.name: LxmlBackend,
+}
+
+def select_backend(name="stdlib"):
+    """
+    Picks the XML backend.
+
+    Args:
+        name (str): 'lxml', 'stdlib', or 'auto' for lxml when it is
+            installed, for whole documents only
+
+    Returns:
+        StdlibBackend or LxmlBackend: The backend to parse with
+
+    Raises:
+        ValueError: If the name is not a known backend
+    """
+    if name != "auto" and name not in BACKENDS:
+        raise ValueError(f"Unknown XML backend: {name}")
+    if name in ("auto", LxmlBackend.name):
+        try:
+            return LxmlBackend(stdlib_streams=name == "auto")
+        except ImportError:
+            if name == LxmlBackend.name:
+                logger.warning("XML_BACKEND is 'lxml' but lxml is not installed, using the stdlib parser")
+    return StdlibBackend()
@@ -8,6 +8,8 @@ from Jåttåvågen station in Stavanger, Norway.
 Usage:
     - Import and call run_tool() from your Python code
     - Run directly with python mcp_tool.py for testing
+    - Run python mcp_tool.py --daemon to keep a warm process that later
+      invocations hand their tool calls to over a Unix socket
 
 Returns:
     JSON-compatible dictionary with northbound and southbound departures.
@@ -15,7 +17,9 @@ Returns:
 import logging
 import json
 import sys
-from jattavagen_departures.service import get_upcoming_departures, format_departures
+# Only the lightweight client is imported up front; the service (requests,
+# httpx, parsing) is imported when there is no daemon to answer instead
+from jattavagen_departures.daemon import error_response, request_daemon, serve, tool_response
 
 # Set up logging
 logging.basicConfig(
@@ -29,7 +33,8 @@ def run_tool(context=None):
     Entry point for MCP integration.
     
     Args:
-        context (dict, optional): Optional context dictionary for future use.
+        context (dict, optional): Optional context dictionary. A 'station' key
+            selects the station (or StopPointRef) to get departures for.
         
     Returns:
         dict: JSON-compatible dictionary with departure information.
@@ -41,16 +46,13 @@ def run_tool(context=None):
         logger.info("MCP tool invoked")
         if context:
             logger.debug(f"Context provided: {context}")
-            
-        departures = get_upcoming_departures()
-        formatted = format_departures(departures)
         
-        # Add metadata to the response
-        response = {
-            "data": formatted,
-            "station": "Jåttåvågen",
-            "timestamp": formatted.get("timestamp", None)
-        }
+        response = request_daemon(context)
+        if response is None:
+            # No daemon running, so fetch in this process
+            response = tool_response(context)
+        else:
+            logger.debug("Answered by daemon")
         
         logger.info("MCP tool execution completed successfully")
         return response
@@ -59,11 +61,7 @@ def run_tool(context=None):
         logger.error(f"Error in MCP tool: {str(e)}", exc_info=True)
         # For MCP integration, we might want to return an error object
         # rather than raising an exception
-        return {
-            "error": True,
-            "message": str(e),
-            "type": type(e).__name__
-        }
+        return error_response(e)
 
 def display_help():
     """Display help information about this tool."""
@@ -78,6 +76,7 @@ Usage:
   python mcp_tool.py --help      - Display this help message
   python mcp_tool.py --json      - Output as raw JSON
   python mcp_tool.py --pretty    - Output as formatted pretty JSON (default)
+  python mcp_tool.py --daemon    - Keep a warm process that later runs answer from
   
 The tool returns a JSON object with northbound and southbound departures,
 including scheduled and actual departure times.
@@ -97,6 +96,9 @@ if __name__ == "__main__":
             pretty_output = False
         elif sys.argv[1] == "--pretty":
             pretty_output = True
+        elif sys.argv[1] == "--daemon":
+            serve()
+            sys.exit(0)
     
     try:
         result = run_tool()
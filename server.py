@@ -1,11 +1,29 @@
+import asyncio
+import json
+import logging
 import os
-from typing import Dict, Any
+from typing import Any, Dict, Optional
 
 from dotenv import load_dotenv
+from mcp import types
 from mcp.server.fastmcp import FastMCP, Context
 from pydantic import Field
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
 
-from jattavagen_departures.service import get_upcoming_departures, format_departures
+from jattavagen_departures.config import (
+    DEFAULT_STATION, METRICS_PATH, PREFETCH_ENABLED, SUBSCRIPTION_POLL_SECONDS, TOOL_DEADLINE_SECONDS
+)
+from jattavagen_departures.metrics import render_prometheus
+from jattavagen_departures.prefetch import start_prefetcher
+from jattavagen_departures.service import (
+    board_response_json, get_delay_history, get_departure_board_async, get_snapshot_async
+)
+from jattavagen_departures.subscriptions import (
+    BOARD_URI_TEMPLATE, SubscriptionHub, parse_board_uri, snapshot_lookup
+)
+
+logger = logging.getLogger('togtider.server')
 
 
 # Load environment variables
@@ -28,26 +46,125 @@ mcp = FastMCP(
     port=8080
 )
 
-@mcp.tool()
-def togtider(
-#    station: str = Field(description="The train station to get departures for", default="Jåttåvågen"), 
+# The board is serialized once when it is built, so the tool returns the
+# JSON text itself rather than a dict FastMCP would serialize on every call
+@mcp.tool(structured_output=False)
+async def togtider(
+    station: str = Field(description="The train station (or StopPointRef) to get departures for", default=DEFAULT_STATION), 
+    limit: Optional[int] = Field(description="Only the next this many departures in each direction", default=None, ge=1),
+    direction: Optional[str] = Field(description="Only 'southbound' or 'northbound' departures", default=None),
+    destination: Optional[str] = Field(description="Only departures to this destination, e.g. Stavanger", default=None),
+    after: Optional[str] = Field(description="Only departures from this local time today, as HH:MM", default=None),
+    since_version: Optional[str] = Field(description="Version of a previous response; if the departures have not changed since, only a short not_modified reply is sent", default=None),
     ctx: Context = Field(description="MCP context")
+) -> str:
+    """
+    Endpoint to get departures from a station on the line (Jåttåvågen by default).
+    Returns JSON with northbound and southbound departures and a version,
+    or {"not_modified": true} when since_version is still current. Use limit,
+    direction, destination and after to ask for just the next few trains.
+    """
+    board = await get_departure_board_async(
+        station,
+        timeout=TOOL_DEADLINE_SECONDS,
+        limit=limit,
+        direction=direction,
+        destination=destination,
+        after=after,
+    )
+    return board_response_json(board, station, since_version)
+
+@mcp.tool()
+async def togtider_history(
+    station: str = Field(description="The train station (or StopPointRef) to summarize", default=DEFAULT_STATION),
+    direction: Optional[str] = Field(description="'southbound' or 'northbound'", default=None),
+    destination: Optional[str] = Field(description="Only departures to this destination", default=None),
+    scheduled: Optional[str] = Field(description="Only departures scheduled at this local time, as HH:MM", default=None),
+    group_by: str = Field(description="'scheduled' (time of day), 'weekday' or 'hour'", default="scheduled"),
+    days: Optional[float] = Field(description="Only departures from the last this many days", default=None),
 ) -> Dict[str, Any]:
     """
-    Endpoint to get departures from Jåttåvågen station.
-    Returns JSON with northbound and southbound departures.
+    How late trains from a station usually are: mean, median, 90th
+    percentile and worst delay in minutes per scheduled time, weekday or
+    hour, from the departures observed since history was enabled.
+    """
+    return await asyncio.to_thread(
+        get_delay_history, station, direction, destination, scheduled, group_by, days
+    )
+
+_hub = SubscriptionHub()
+_pusher = None
+
+@mcp.resource(BOARD_URI_TEMPLATE, mime_type="application/json")
+async def departure_board(station: str, direction: str) -> str:
+    """
+    Upcoming departures from a station in one direction. Subscribe to it to
+    be sent only the changes, as notifications carrying the new version and
+    a list of added, changed and removed departures.
+    """
+    station, direction = parse_board_uri(BOARD_URI_TEMPLATE.format(station=station, direction=direction))
+    index = await get_snapshot_async(TOOL_DEADLINE_SECONDS)
+    return json.dumps(_hub.board(station, direction, snapshot_lookup(index)), ensure_ascii=False)
+
+async def _push_changes():
+    """Diffs the subscribed boards once per poll and notifies every subscriber."""
+    while _hub.has_subscribers():
+        await asyncio.sleep(SUBSCRIPTION_POLL_SECONDS)
+        try:
+            index = await get_snapshot_async()
+        except Exception as e:
+            logger.warning(f"Skipping subscription update: {str(e)}")
+            continue
+        for update in _hub.update(snapshot_lookup(index)):
+            notification = types.ServerNotification(types.ResourceUpdatedNotification(
+                params=types.ResourceUpdatedNotificationParams(
+                    uri=update.uri, version=update.version, changes=update.changes
+                )
+            ))
+            for session in update.subscribers:
+                try:
+                    await session.send_notification(notification)
+                except Exception as e:
+                    logger.info(f"Dropping subscriber that could not be notified: {str(e)}")
+                    _hub.unsubscribe(session)
+
+@mcp._mcp_server.subscribe_resource()
+async def subscribe(uri) -> None:
+    global _pusher
+    station, direction = parse_board_uri(str(uri))
+    index = await get_snapshot_async(TOOL_DEADLINE_SECONDS)
+    _hub.subscribe(mcp._mcp_server.request_context.session, station, direction, snapshot_lookup(index))
+    if _pusher is None or _pusher.done():
+        _pusher = asyncio.create_task(_push_changes())
+
+@mcp._mcp_server.unsubscribe_resource()
+async def unsubscribe(uri) -> None:
+    station, direction = parse_board_uri(str(uri))
+    _hub.unsubscribe(mcp._mcp_server.request_context.session, station, direction)
+
+# The low-level server does not advertise subscriptions by itself
+_get_capabilities = mcp._mcp_server.get_capabilities
+
+def _get_capabilities_with_subscriptions(*args, **kwargs):
+    capabilities = _get_capabilities(*args, **kwargs)
+    if capabilities.resources is not None:
+        capabilities.resources.subscribe = True
+    return capabilities
+
+mcp._mcp_server.get_capabilities = _get_capabilities_with_subscriptions
+
+@mcp.custom_route(METRICS_PATH, methods=["GET"])
+async def metrics(request: Request) -> PlainTextResponse:
+    """
+    Per-stage latency and size histograms plus upstream error counts
+    in the Prometheus text format.
     """
-    deps = get_upcoming_departures()
-    formatted = format_departures(deps)
-        
-    # Add metadata to the response
-    return  {
-        "data": formatted,
-        "station": "Jåttåvågen",
-        "timestamp": formatted.get("timestamp", None)
-    }
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
 
 if __name__ == "__main__":
+    # Keep a hot snapshot in memory so tool calls never wait on Bane NOR
+    if PREFETCH_ENABLED:
+        start_prefetcher()
     mcp.run(transport="sse")
 
 # Alternatively run with: mcp run server.py --transport sse
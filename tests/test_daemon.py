@@ -0,0 +1,78 @@
+# tests/test_daemon.py
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+import mcp_tool
+from jattavagen_departures import daemon
+
+@unittest.skipUnless(hasattr(socket, "AF_UNIX"), "Unix sockets are not available")
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "togtider.sock")
+
+    def start_daemon(self):
+        server = daemon.create_server(self.path)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_daemon_answers_tool_calls(self):
+        """Test that a request over the socket is answered by the daemon's service"""
+        self.start_daemon()
+        answer = {"data": {}, "station": "NSR:Quay:609", "stale": False, "timestamp": None}
+
+        with patch.object(daemon, "tool_response_json", return_value=json.dumps(answer)) as tool:
+            response = daemon.request_daemon({"station": "NSR:Quay:609"}, path=self.path)
+
+        self.assertEqual(response, answer)
+        tool.assert_called_once_with({"station": "NSR:Quay:609"})
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_daemon_reports_errors(self):
+        """Test that service errors come back as the tool's error object"""
+        self.start_daemon()
+
+        with patch.object(daemon, "tool_response_json", side_effect=ValueError("Unknown station: Oslo")):
+            response = daemon.request_daemon({"station": "Oslo"}, path=self.path)
+
+        self.assertEqual(response, {"error": True, "message": "Unknown station: Oslo", "type": "ValueError"})
+
+    def test_missing_or_dead_daemon(self):
+        """Test that no socket, or one nobody listens on, means no daemon"""
+        self.assertIsNone(daemon.request_daemon(path=self.path))
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as leftover:
+            leftover.bind(self.path)
+        self.assertIsNone(daemon.request_daemon(path=self.path))
+
+        # A new daemon replaces the leftover socket file
+        self.start_daemon()
+        with self.assertRaises(RuntimeError):
+            daemon.create_server(self.path)
+
+    def test_tool_falls_back_to_in_process(self):
+        """Test that mcp_tool answers itself when no daemon is running"""
+        answer = {"data": {}, "station": "Jåttåvågen", "stale": False, "timestamp": None}
+        with patch.object(mcp_tool, "request_daemon", return_value=None), \
+             patch.object(mcp_tool, "tool_response", return_value=answer) as tool:
+            self.assertEqual(mcp_tool.run_tool(), answer)
+        tool.assert_called_once_with(None)
+
+    def test_client_does_not_import_service(self):
+        """Test that starting mcp_tool leaves the heavy imports until they are needed"""
+        code = "import sys, mcp_tool; print(sorted(m for m in ('requests', 'httpx', 'jattavagen_departures.service') if m in sys.modules))"
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True)
+        self.assertEqual(output.stdout.strip(), "[]")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,281 @@
+# tests/test_fetch_data.py
+import asyncio
+import gzip
+import threading
+import time
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest.mock import MagicMock, patch
+from jattavagen_departures import fetch_data, metrics
+
+BODY = b'<?xml version="1.0" encoding="UTF-8"?>\n<Siri xmlns="http://www.siri.org.uk/siri">' + b'<x/>' * 500 + b'</Siri>'
+
+class _GzipHandler(BaseHTTPRequestHandler):
+    """Answers every POST with a gzip-compressed SIRI body when asked to."""
+    protocol_version = "HTTP/1.1"
+    seen_encodings = []
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        accept = self.headers.get("Accept-Encoding", "")
+        self.seen_encodings.append(accept)
+        body = gzip.compress(BODY) if "gzip" in accept else BODY
+        self.send_response(200)
+        if "gzip" in accept:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class TestFetchTimetable(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), _GzipHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.endpoint = f"http://127.0.0.1:{cls.server.server_port}/"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_fetch_negotiates_gzip_and_reports_sizes(self):
+        """Test that responses are compressed on the wire and decoded sizes are reported"""
+        metrics.reset_metrics()
+        with patch.object(fetch_data, "API_ENDPOINT", self.endpoint):
+            text = fetch_data.fetch_timetable()
+
+        stats = fetch_data.get_transfer_stats()
+        self.assertEqual(text, BODY.decode("utf-8"))
+        self.assertIn("gzip", _GzipHandler.seen_encodings[-1])
+        self.assertEqual(stats["last_content_encoding"], "gzip")
+        self.assertEqual(stats["last_decoded_bytes"], len(BODY))
+        self.assertLess(stats["last_bytes_on_wire"], len(BODY))
+        self.assertEqual(metrics.FETCH_SECONDS.snapshot()["count"], 1)
+        self.assertEqual(metrics.RESPONSE_BYTES.snapshot()["sum"], len(BODY))
+
+    def test_stream_yields_decoded_body(self):
+        """Test that the streaming fetch yields the decoded body through the same session"""
+        with patch.object(fetch_data, "API_ENDPOINT", self.endpoint):
+            body = b"".join(fetch_data.stream_timetable(chunk_size=64))
+
+        self.assertEqual(body, BODY)
+        self.assertEqual(fetch_data.get_transfer_stats()["last_decoded_bytes"], len(BODY))
+
+    def test_async_stream_yields_decoded_body(self):
+        """Test that the event loop stream yields the same decoded body"""
+        async def read():
+            try:
+                return b"".join([chunk async for chunk in fetch_data.stream_timetable_async(chunk_size=64)])
+            finally:
+                await fetch_data.close_async_client()
+
+        with patch.object(fetch_data, "API_ENDPOINT", self.endpoint):
+            body = asyncio.run(read())
+
+        self.assertEqual(body, BODY)
+        self.assertEqual(fetch_data.get_transfer_stats()["last_decoded_bytes"], len(BODY))
+
+    def test_stream_accepts_split_xml_declaration(self):
+        """Test that a declaration split across tiny chunks is not rejected"""
+        with patch.object(fetch_data, "API_ENDPOINT", self.endpoint):
+            body = b"".join(fetch_data.stream_timetable(chunk_size=3))
+
+        self.assertEqual(body, BODY)
+        self.assertEqual(fetch_data.get_transfer_stats()["last_decoded_bytes"], len(BODY))
+
+    def test_async_fetch_negotiates_gzip(self):
+        """Test that the async client decodes gzip and reports wire bytes"""
+        async def fetch():
+            try:
+                return await fetch_data.fetch_timetable_async()
+            finally:
+                await fetch_data.close_async_client()
+
+        with patch.object(fetch_data, "API_ENDPOINT", self.endpoint):
+            text = asyncio.run(fetch())
+
+        stats = fetch_data.get_transfer_stats()
+        self.assertEqual(text, BODY.decode("utf-8"))
+        self.assertEqual(stats["last_decoded_bytes"], len(BODY))
+        self.assertLess(stats["last_bytes_on_wire"], len(BODY))
+
+class TestSessions(unittest.TestCase):
+    def test_requestor_scoped_requests_are_not_resent(self):
+        """Test that only connection failures are retried for requests with a RequestorRef"""
+        session = fetch_data.create_session(retries=2, idempotent=False)
+        retry = session.get_adapter("https://example.com").max_retries
+
+        self.assertEqual(retry.connect, 2)
+        self.assertEqual((retry.read, retry.status, retry.other), (0, 0, 0))
+        self.assertIs(fetch_data._session_for("togtider-1"), fetch_data._requestor_session)
+        self.assertIs(fetch_data._session_for(None), fetch_data._session)
+
+class TestBatchedRequests(unittest.TestCase):
+    def test_plan_batches_respects_limits(self):
+        """Test that lines and stops are packed into the fewest requests within the limits"""
+        lines = [(f"GOA:Line:{n}", "EGS") for n in range(5)]
+        stops = [f"NSR:Quay:{n}" for n in range(3)]
+
+        batches = fetch_data.plan_batches(lines, stops, max_lines=2, max_stops=10)
+
+        self.assertEqual(len(batches), 3)
+        self.assertTrue(all(len(batch_lines) <= 2 and batch_stops == stops for batch_lines, batch_stops in batches))
+        self.assertEqual([line for batch_lines, _ in batches for line in batch_lines], lines)
+
+    def test_plan_batches_without_stops(self):
+        """Test that an empty stop filter still gives one request per line chunk"""
+        self.assertEqual(fetch_data.plan_batches([("GOA:Line:59", "EGS")], []), [([("GOA:Line:59", "EGS")], [])])
+
+    def test_build_request_lists_every_entry(self):
+        """Test that a batch becomes one request with all its lines and stops"""
+        batch = ([("GOA:Line:59", "EGS"), ("GOA:Line:59", "STV")], ["NSR:Quay:609", "NSR:Quay:607"])
+        body = fetch_data.build_request(batch=batch).decode("utf-8")
+
+        self.assertEqual(body.count("<LineDirection>"), 2)
+        self.assertIn("<DirectionRef>STV</DirectionRef>", body)
+        self.assertEqual(body.count("<StopPointRef>"), 2)
+
+class TestPreviewWindow(unittest.TestCase):
+    def test_window_covers_recent_needs(self):
+        """Test that polls narrow to the furthest recent need and widen again at once"""
+        window = fetch_data.PreviewWindow(minimum=30, maximum=120, step=15, polls=2, slack=0.5)
+        self.assertEqual(window.next_minutes(), 120)
+
+        window.need(20)
+        window.need(41)
+        self.assertEqual(window.next_minutes(), 45)
+        self.assertEqual(window.next_minutes(), 45)
+
+        window.need(5)
+        self.assertEqual(window.next_minutes(), 45)
+        self.assertEqual(window.next_minutes(), 45)
+        window.need(5)
+        self.assertEqual(window.next_minutes(), 30)
+
+        window.need(500)
+        self.assertEqual(window.next_minutes(), 120)
+
+    def test_request_asks_for_the_window(self):
+        self.assertIn("<PreviewInterval>PT45M</PreviewInterval>", fetch_data.build_request(preview_minutes=45).decode("utf-8"))
+        self.assertIn("<PreviewInterval>PT120M</PreviewInterval>", fetch_data.build_request().decode("utf-8"))
+
+    def test_savings_are_counted_against_full_window(self):
+        """Test that narrower responses report the bytes the latest full-window one had beyond them"""
+        metrics.reset_metrics()
+        response = MagicMock(headers={"Content-Encoding": "gzip"})
+        batch = ([("GOA:Line:59", "EGS")], [])
+        before = fetch_data.get_transfer_stats()
+
+        fetch_data._record_transfer(response, 5000, wire_bytes=1000, batch=batch, preview_minutes=30)
+        fetch_data._record_transfer(response, 9000, wire_bytes=1800, batch=batch)
+        fetch_data._record_transfer(response, 4000, wire_bytes=800, batch=batch, preview_minutes=45)
+
+        stats = fetch_data.get_transfer_stats()
+        self.assertEqual(stats["last_preview_minutes"], 45)
+        self.assertEqual(stats["saved_bytes_on_wire"] - before["saved_bytes_on_wire"], 1000)
+        self.assertEqual(stats["saved_decoded_bytes"] - before["saved_decoded_bytes"], 5000)
+        self.assertEqual(metrics.RESPONSE_SAVED_BYTES.value(measure="wire"), 1000)
+
+class TestRequestTimeout(unittest.TestCase):
+    def test_retries_stay_within_total_budget(self):
+        """Test that all attempts together never exceed the configured total"""
+        for retries in (0, 1, 2, 5):
+            with self.subTest(retries=retries):
+                connect, read = fetch_data.request_timeout(retries=retries, total=10, connect=2)
+                self.assertLessEqual((connect + read) * (retries + 1), 10 + 1e-9)
+                self.assertGreater(read, 0)
+
+    def test_deadline_shortens_budget(self):
+        """Test that a near deadline caps the budget and a passed one raises"""
+        self.assertLessEqual(fetch_data.remaining_budget(time.monotonic() + 1, total=10), 1)
+        self.assertEqual(fetch_data.remaining_budget(None, total=10), 10)
+        with self.assertRaises(TimeoutError):
+            fetch_data.remaining_budget(time.monotonic() - 1)
+
+class TestHedgedFetch(unittest.TestCase):
+    def setUp(self):
+        metrics.reset_metrics()
+        fetch_data._latencies.clear()
+        for _ in range(20):
+            fetch_data._latencies.record(0.05)
+        patcher = patch.multiple(fetch_data, HEDGE_ENABLED=True, HEDGE_MIN_DELAY_SECONDS=0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(fetch_data._latencies.clear)
+
+    def test_percentile_needs_enough_samples(self):
+        """Test the latency percentile and that too few samples disable hedging"""
+        tracker = fetch_data.LatencyTracker()
+        for latency in range(1, 101):
+            tracker.record(latency / 100)
+        self.assertEqual(tracker.percentile(95), 0.95)
+        self.assertIsNone(fetch_data.LatencyTracker().percentile(95, min_samples=1))
+
+    def test_slow_request_is_hedged(self):
+        """Test that a duplicate is sent after the percentile and the fastest response wins"""
+        calls = []
+
+        def fetch(requestor_ref=None, batch=None, deadline=None, preview_minutes=None):
+            calls.append(time.monotonic())
+            if len(calls) == 1:
+                time.sleep(1)
+                return "slow"
+            return "fast"
+
+        start = time.monotonic()
+        with patch.object(fetch_data, "fetch_timetable", side_effect=fetch):
+            text = fetch_data.fetch_timetable_hedged()
+
+        self.assertEqual(text, "fast")
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(metrics.HEDGED_REQUESTS.value(outcome="won"), 1)
+
+    def test_incremental_polls_are_not_hedged(self):
+        """Test that requests with a RequestorRef are sent exactly once"""
+        with patch.object(fetch_data, "fetch_timetable", return_value="delta") as fetch:
+            self.assertEqual(fetch_data.fetch_timetable_hedged(requestor_ref="togtider-1"), "delta")
+        fetch.assert_called_once_with("togtider-1", None, None, None)
+
+    def test_deadline_bounds_hedged_fetch(self):
+        """Test that a fetch with only slow responses gives up at the deadline"""
+        def fetch(requestor_ref=None, batch=None, deadline=None, preview_minutes=None):
+            time.sleep(0.5)
+            return "late"
+
+        start = time.monotonic()
+        with patch.object(fetch_data, "fetch_timetable", side_effect=fetch):
+            with self.assertRaises(TimeoutError):
+                fetch_data.fetch_timetable_hedged(deadline=time.monotonic() + 0.2)
+        self.assertLess(time.monotonic() - start, 0.45)
+
+    def test_async_slow_request_is_hedged(self):
+        """Test that the async fetch hedges too and cancels the losing request"""
+        cancelled = []
+
+        async def fetch(requestor_ref=None, batch=None, deadline=None, preview_minutes=None):
+            if not cancelled:
+                cancelled.append(False)
+                try:
+                    await asyncio.sleep(1)
+                except asyncio.CancelledError:
+                    cancelled[0] = True
+                    raise
+                return "slow"
+            return "fast"
+
+        async def run():
+            text = await fetch_data.fetch_timetable_hedged_async()
+            await asyncio.sleep(0)
+            return text
+
+        with patch.object(fetch_data, "fetch_timetable_async", side_effect=fetch):
+            self.assertEqual(asyncio.run(run()), "fast")
+        self.assertEqual(cancelled, [True])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+# tests/test_history.py
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from unittest.mock import patch
+from jattavagen_departures.history import SEGMENT_PREFIX, HistoryArchive, parse_clock
+from jattavagen_departures.parse_data import LOCAL_TZ, Departure, StopIndex
+
+def local(text):
+    return int(datetime.fromisoformat(text).replace(tzinfo=LOCAL_TZ).timestamp())
+
+def snapshot(*departures):
+    index = StopIndex()
+    for departure in departures:
+        index.add(departure)
+    return index.freeze()
+
+class TestHistoryArchive(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        # Rescans on every query, as if the interval had always passed
+        self.archive = HistoryArchive(self.directory.name, rescan_interval=0)
+        # A Monday
+        self.aimed = local("2025-03-10T07:42:00")
+        self.now = self.aimed + 3600
+
+    def departure(self, aimed, delay_minutes, direction="southbound", stop_ref="NSR:Quay:609"):
+        actual = None if delay_minutes is None else aimed + delay_minutes * 60
+        return Departure(stop_ref, aimed, actual, direction, "Egersund", f"J{aimed}")
+
+    def test_polls_are_deduplicated(self):
+        """Test that a departure seen by several polls is archived once"""
+        first = snapshot(self.departure(self.aimed, 2), self.departure(self.aimed + 600, None))
+        second = snapshot(self.departure(self.aimed, 2), self.departure(self.aimed + 600, 1))
+
+        self.assertEqual(self.archive.record(first, now=self.now), 1)
+        self.assertEqual(self.archive.record(second, now=self.now), 1)
+        self.assertEqual(self.archive.record(second, now=self.now), 0)
+        self.assertEqual(self.archive.departure_count(), 2)
+
+    def test_departures_in_the_future_are_skipped(self):
+        index = snapshot(self.departure(self.now + 600, 0))
+        self.assertEqual(self.archive.record(index, now=self.now), 0)
+
+    def test_delays_per_scheduled_time(self):
+        """Test the statistics for one scheduled departure across days"""
+        for day, delay in enumerate((0, 2, 4, 10)):
+            aimed = self.aimed + day * 86400
+            self.archive.record(snapshot(
+                self.departure(aimed, delay),
+                self.departure(aimed + 300, 1, direction="northbound", stop_ref="NSR:Quay:607"),
+            ), now=aimed + 3600)
+
+        result = self.archive.delays("Jåttåvågen", direction="southbound", scheduled="07:42", now=self.now + 5 * 86400)
+
+        self.assertEqual(result["departures"], 4)
+        self.assertEqual(result["groups"], [{
+            "scheduled": "07:42",
+            "direction": "southbound",
+            "count": 4,
+            "mean_delay_minutes": 4.0,
+            "median_delay_minutes": 2.0,
+            "p90_delay_minutes": 10.0,
+            "max_delay_minutes": 10.0,
+        }])
+
+        by_weekday = self.archive.delays("Jåttåvågen", group_by="weekday", now=self.now + 5 * 86400)
+        self.assertEqual(
+            [(group["weekday"], group["direction"], group["count"]) for group in by_weekday["groups"]],
+            [("Monday", "southbound", 1), ("Monday", "northbound", 1),
+             ("Tuesday", "southbound", 1), ("Tuesday", "northbound", 1),
+             ("Wednesday", "southbound", 1), ("Wednesday", "northbound", 1),
+             ("Thursday", "southbound", 1), ("Thursday", "northbound", 1)],
+        )
+
+        recent = self.archive.delays("Jåttåvågen", group_by="hour", days=1, now=self.aimed + 3 * 86400 + 3600)
+        self.assertEqual([group["hour"] for group in recent["groups"]], ["07:00", "07:00"])
+        self.assertEqual(recent["departures"], 2)
+
+    def test_history_survives_reopening(self):
+        """Test that a new archive on the same directory sees the same rows"""
+        self.archive.record(snapshot(self.departure(self.aimed, 3)), now=self.now)
+
+        reopened = HistoryArchive(self.directory.name, rescan_interval=0)
+        reopened.record(snapshot(self.departure(self.aimed, 3)), now=self.now)
+
+        self.assertEqual(reopened.departure_count(), 1)
+        self.assertEqual(reopened.delays("NSR:Quay:609", now=self.now)["groups"][0]["mean_delay_minutes"], 3.0)
+        # Blocks appended by another writer are picked up on the next query
+        reopened.record(snapshot(self.departure(self.aimed + 600, 1)), now=self.now)
+        self.assertEqual(self.archive.departure_count(), 2)
+
+    def test_incomplete_block_is_ignored_and_replaced(self):
+        """Test that a block cut short by a crash is skipped and overwritten"""
+        self.archive.record(snapshot(self.departure(self.aimed, 3)), now=self.now)
+        segment = os.path.join(self.directory.name, os.listdir(self.directory.name)[0])
+        self.assertTrue(os.path.basename(segment).startswith(SEGMENT_PREFIX))
+        with open(segment, "ab") as f:
+            f.write(b"TGHA\x01\x00")
+
+        reopened = HistoryArchive(self.directory.name)
+        self.assertEqual(reopened.departure_count(), 1)
+        reopened.record(snapshot(self.departure(self.aimed + 600, 1)), now=self.now)
+        self.assertEqual(HistoryArchive(self.directory.name).departure_count(), 2)
+
+    def test_segments_are_read_when_a_query_covers_them(self):
+        """Test that opening reads nothing and a query for recent days skips older segments"""
+        for day in range(3):
+            aimed = self.aimed + day * 86400
+            self.archive.record(snapshot(self.departure(aimed, day)), now=aimed + 3600)
+
+        reopened = HistoryArchive(self.directory.name)
+        self.assertEqual(reopened._read_until, {})
+
+        recent = reopened.delays("Jåttåvågen", days=1, now=self.aimed + 2 * 86400 + 3600)
+        self.assertEqual(recent["departures"], 1)
+        # The last day begins a day before now, partway through the second segment
+        self.assertEqual(len(reopened._read_until), 2)
+        self.assertEqual(reopened.departure_count(), 3)
+
+    def test_directory_is_rescanned_at_most_once_per_interval(self):
+        """Test that queries within the interval neither list the directory nor see other writers"""
+        self.archive.record(snapshot(self.departure(self.aimed, 3)), now=self.now)
+        reader = HistoryArchive(self.directory.name, rescan_interval=3600)
+        self.assertEqual(reader.departure_count(), 1)
+
+        self.archive.record(snapshot(self.departure(self.aimed + 600, 1)), now=self.now)
+        with patch("jattavagen_departures.history.os.listdir", wraps=os.listdir) as listdir:
+            self.assertEqual(reader.departure_count(), 1)
+            reader.delays("Jåttåvågen", now=self.now)
+        listdir.assert_not_called()
+
+        reader.rescan_interval = 0
+        self.assertEqual(reader.departure_count(), 2)
+
+    def test_invalid_queries(self):
+        with self.assertRaises(ValueError):
+            self.archive.delays("Nowhere")
+        with self.assertRaises(ValueError):
+            self.archive.delays("Jåttåvågen", group_by="month")
+        with self.assertRaises(ValueError):
+            parse_clock("7.42")
+        with self.assertRaises(ValueError):
+            parse_clock("24:00")
+        self.assertEqual(parse_clock("07:42"), 462)
+
+if __name__ == '__main__':
+    unittest.main()
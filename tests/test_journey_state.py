@@ -0,0 +1,104 @@
+# tests/test_journey_state.py
+import unittest
+from datetime import datetime, timedelta
+from jattavagen_departures.journey_state import JourneyState
+from jattavagen_departures.parse_data import Departure, parse_journeys
+
+def departure(stop_ref, aimed, direction="southbound", destination="Egersund", actual=None, journey_ref=None):
+    """Builds a Departure from datetimes."""
+    return Departure(
+        stop_ref,
+        int(aimed.timestamp()),
+        int(actual.timestamp()) if actual else None,
+        direction,
+        destination,
+        journey_ref,
+    )
+
+class TestJourneyState(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime.now().astimezone()
+        self.state = JourneyState(full_refresh_interval=600, retention_minutes=30)
+
+    def test_delta_replaces_only_changed_journeys(self):
+        """Test that a delta updates its journeys and keeps the rest"""
+        soon = self.now + timedelta(minutes=10)
+        later = self.now + timedelta(minutes=40)
+        self.state.apply([
+            ("J1", [departure("NSR:Quay:609", soon, journey_ref="J1")]),
+            ("J2", [departure("NSR:Quay:609", later, journey_ref="J2")]),
+        ], full=True)
+
+        delayed = soon + timedelta(minutes=3)
+        index = self.state.apply([
+            ("J1", [departure("NSR:Quay:609", soon, actual=delayed, journey_ref="J1")]),
+        ])
+
+        southbound = index.for_station("NSR:Quay:609")["southbound"]
+        self.assertEqual(len(southbound), 2)
+        self.assertEqual(
+            {d.journey_ref: d.actual for d in southbound},
+            {"J1": int(delayed.timestamp()), "J2": None},
+        )
+        self.assertEqual(self.state.stats()["delta_updates"], 1)
+
+    def test_full_refresh_replaces_state(self):
+        """Test that a full delivery drops journeys it no longer contains"""
+        soon = self.now + timedelta(minutes=10)
+        self.state.apply([("J1", [departure("NSR:Quay:609", soon, journey_ref="J1")])], full=True)
+        index = self.state.apply([("J2", [departure("NSR:Quay:609", soon, journey_ref="J2")])], full=True)
+
+        refs = [d.journey_ref for d in index.for_station("NSR:Quay:609")["southbound"]]
+        self.assertEqual(refs, ["J2"])
+
+    def test_ended_journeys_are_pruned(self):
+        """Test that journeys whose departures are past the retention are dropped"""
+        old = self.now - timedelta(hours=1)
+        index = self.state.apply([("J1", [departure("NSR:Quay:609", old, journey_ref="J1")])], full=True)
+
+        self.assertEqual(index.for_station("NSR:Quay:609")["southbound"], [])
+        self.assertEqual(self.state.stats()["journeys"], 0)
+
+    def test_full_refresh_schedule(self):
+        """Test that the first poll is full and starts a new requestor"""
+        self.assertTrue(self.state.needs_full_refresh())
+        requestor = self.state.start_full_refresh()
+        self.state.apply([], full=True)
+
+        self.assertFalse(self.state.needs_full_refresh())
+        self.assertEqual(self.state.requestor_ref, requestor)
+
+    def test_failed_poll_requires_full_refresh(self):
+        """Test that the next poll after a failed delta is full, keeping the journeys so far"""
+        soon = self.now + timedelta(minutes=10)
+        self.state.start_full_refresh()
+        self.state.apply([("J1", [departure("NSR:Quay:609", soon, journey_ref="J1")])], full=True)
+
+        self.state.require_full_refresh()
+
+        self.assertTrue(self.state.needs_full_refresh())
+        self.assertEqual(self.state.stats()["journeys"], 1)
+
+    def test_parse_journeys_reads_framed_reference(self):
+        """Test that the journey reference combines the data frame and dated journey"""
+        xml = """<?xml version="1.0" encoding="UTF-8"?>
+<Siri xmlns="http://www.siri.org.uk/siri"><ServiceDelivery><EstimatedTimetableDelivery>
+<EstimatedJourneyVersionFrame><EstimatedVehicleJourney>
+  <FramedVehicleJourneyRef>
+    <DataFrameRef>2025-03-07</DataFrameRef>
+    <DatedVehicleJourneyRef>GOA:ServiceJourney:1234</DatedVehicleJourneyRef>
+  </FramedVehicleJourneyRef>
+  <DirectionRef>EGS</DirectionRef>
+  <RecordedCalls><RecordedCall>
+    <StopPointRef>NSR:Quay:609</StopPointRef>
+    <AimedDepartureTime>2025-03-07T10:15:00+01:00</AimedDepartureTime>
+  </RecordedCall></RecordedCalls>
+</EstimatedVehicleJourney></EstimatedJourneyVersionFrame>
+</EstimatedTimetableDelivery></ServiceDelivery></Siri>"""
+        [(journey_ref, departures)] = parse_journeys(xml)
+
+        self.assertEqual(journey_ref, "2025-03-07:GOA:ServiceJourney:1234")
+        self.assertEqual(departures[0].journey_ref, journey_ref)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+# tests/test_load_harness.py
+import gzip
+import os
+import tempfile
+import threading
+import unittest
+import requests
+from benchmarks.load_test import percentile, summarize
+from benchmarks.replay_server import Replay, ReplayServer
+from jattavagen_departures.parse_data import parse_stop_index
+
+class TestReplayServer(unittest.TestCase):
+    def start(self, replay):
+        server = ReplayServer(("127.0.0.1", 0), replay)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return f"http://127.0.0.1:{server.server_port}/rest"
+
+    def test_serves_synthetic_delivery(self):
+        """Test that the replayed delivery parses like a real one, gzipped on request"""
+        url = self.start(Replay(journeys=10, calls=6))
+
+        response = requests.post(url, data=b"<Siri/>", headers={"Accept-Encoding": "gzip"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(parse_stop_index(response.text).departure_count(), 60)
+
+    def test_replays_records_in_turn(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        records = []
+        for name in ("first", "second"):
+            path = os.path.join(directory.name, f"{name}.xml")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(f"<Siri>{name}</Siri>")
+            records.append(path)
+        url = self.start(Replay(records=records))
+
+        bodies = [requests.post(url, headers={"Accept-Encoding": "identity"}).text for _ in range(3)]
+
+        self.assertEqual(bodies, ["<Siri>first</Siri>", "<Siri>second</Siri>", "<Siri>first</Siri>"])
+
+    def test_injects_errors(self):
+        replay = Replay(journeys=1, calls=1, error_rate=1.0, error_status=502)
+        url = self.start(replay)
+
+        self.assertEqual(requests.post(url).status_code, 502)
+        self.assertEqual((replay.requests, replay.errors), (1, 1))
+        self.assertEqual(gzip.decompress(replay.next_body()[1]), replay.next_body()[0])
+
+class TestLoadSummary(unittest.TestCase):
+    def test_percentiles(self):
+        samples = [i / 1000 for i in range(1, 101)]
+        summary = summarize(samples, errors=2, elapsed=2.0, clients=4)
+
+        self.assertEqual(summary["calls"], 102)
+        self.assertEqual(summary["calls_per_second"], 51.0)
+        self.assertEqual((summary["p50_ms"], summary["p95_ms"], summary["p99_ms"]), (50.0, 95.0, 99.0))
+        self.assertIsNone(percentile([], 50))
+
+if __name__ == '__main__':
+    unittest.main()
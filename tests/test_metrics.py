@@ -0,0 +1,61 @@
+# tests/test_metrics.py
+import unittest
+from unittest.mock import patch
+import requests
+from jattavagen_departures import fetch_data, metrics
+from jattavagen_departures.parse_data import parse_stop_index
+from jattavagen_departures.service import format_departures, query_departures
+from benchmarks.siri_fixture import generate_delivery
+
+class TestHistogram(unittest.TestCase):
+    def test_buckets_are_cumulative(self):
+        """Test that each bucket counts every observation up to its bound"""
+        histogram = metrics.Histogram("test_seconds", "Test", (0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot["buckets"], {0.1: 2, 1: 3, float("inf"): 4})
+        self.assertEqual(snapshot["count"], 4)
+        self.assertAlmostEqual(snapshot["sum"], 3.65)
+
+    def test_render_uses_prometheus_text_format(self):
+        """Test the bucket, sum and count samples of a rendered histogram"""
+        histogram = metrics.Histogram("test_bytes", "Test sizes", (1000,))
+        histogram.observe(10)
+
+        self.assertEqual(histogram.render(), [
+            "# HELP test_bytes Test sizes",
+            "# TYPE test_bytes histogram",
+            'test_bytes_bucket{le="1000"} 1',
+            'test_bytes_bucket{le="+Inf"} 1',
+            "test_bytes_sum 10",
+            "test_bytes_count 1",
+        ])
+
+class TestStageMetrics(unittest.TestCase):
+    def setUp(self):
+        metrics.reset_metrics()
+
+    def test_stages_are_recorded(self):
+        """Test that parsing, querying and formatting each record their cost"""
+        index = parse_stop_index(generate_delivery(journeys=10, calls_per_journey=6)).freeze()
+        format_departures(query_departures(index))
+
+        self.assertEqual(metrics.PARSE_SECONDS.snapshot()["count"], 1)
+        self.assertEqual(metrics.PARSED_JOURNEYS.snapshot()["sum"], 10)
+        self.assertEqual(metrics.PARSED_DEPARTURES.snapshot()["sum"], 60)
+        self.assertEqual(metrics.FILTER_SECONDS.snapshot()["count"], 1)
+        self.assertEqual(metrics.FORMAT_SECONDS.snapshot()["count"], 1)
+
+    def test_upstream_errors_are_counted_by_type(self):
+        """Test that failed fetches are counted and appear in the exposition"""
+        with patch.object(fetch_data._session, "post", side_effect=requests.ConnectionError("down")):
+            with self.assertRaises(requests.ConnectionError):
+                fetch_data.fetch_timetable()
+
+        self.assertEqual(metrics.UPSTREAM_ERRORS.value(kind="ConnectionError"), 1)
+        self.assertIn('togtider_upstream_errors_total{kind="ConnectionError"} 1', metrics.render_prometheus())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+# tests/test_parallel_parse.py
+import unittest
+from unittest.mock import patch
+from jattavagen_departures import parallel_parse
+from jattavagen_departures.parallel_parse import (
+    parse_journeys_parallel,
+    parse_stop_index_parallel,
+    split_journeys,
+)
+from jattavagen_departures.parse_data import parse_journeys, parse_stop_index
+from benchmarks.siri_fixture import generate_delivery
+
+def _frames(xml):
+    """Moves the second half of a delivery's journeys into a second frame."""
+    journeys = xml.split("<EstimatedVehicleJourney>")
+    middle = len(journeys) // 2
+    journeys[middle - 1] += "</EstimatedJourneyVersionFrame><EstimatedJourneyVersionFrame>"
+    return "<EstimatedVehicleJourney>".join(journeys)
+
+class TestSplitJourneys(unittest.TestCase):
+    def test_shards_hold_consecutive_journeys(self):
+        """Test that every shard is a complete delivery, even across frames"""
+        xml = _frames(generate_delivery(journeys=7, calls_per_journey=3))
+
+        documents = split_journeys(xml, 3)
+
+        self.assertEqual(len(documents), 3)
+        refs = [journey_ref for document in documents for journey_ref, _ in parse_journeys(document)]
+        self.assertEqual(refs, [journey_ref for journey_ref, _ in parse_journeys(xml)])
+        self.assertEqual([len(parse_journeys(document)) for document in documents], [3, 2, 2])
+
+    def test_prefixed_journeys_are_not_split(self):
+        xml = generate_delivery(journeys=4).replace("EstimatedVehicleJourney>", "siri:EstimatedVehicleJourney>")
+        self.assertIsNone(split_journeys(xml, 2))
+
+class TestParallelParse(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        parallel_parse.shutdown_pool()
+
+    def test_matches_serial_parse(self):
+        """Test that sharded parsing gives the same journeys and index, in the same order"""
+        xml = _frames(generate_delivery(journeys=25, calls_per_journey=6, lines=3))
+
+        journeys = parse_journeys_parallel(xml, workers=2, min_size=0)
+        index = parse_stop_index_parallel(xml, workers=2, min_size=0)
+
+        self.assertEqual(journeys, parse_journeys(xml))
+        self.assertEqual(index.by_stop, parse_stop_index(xml).by_stop)
+
+    def test_invalid_shard_raises_value_error(self):
+        xml = generate_delivery(journeys=4).replace("<LineRef>", "<LineRef><", 1)
+        with self.assertRaises(ValueError):
+            parse_stop_index_parallel(xml, workers=2, min_size=0)
+
+    def test_small_deliveries_are_parsed_in_process(self):
+        xml = generate_delivery(journeys=4)
+        with patch.object(parallel_parse, "_get_pool") as get_pool:
+            index = parse_stop_index_parallel(xml, workers=4)
+            parse_journeys_parallel(xml, workers=1, min_size=0)
+        get_pool.assert_not_called()
+        self.assertEqual(index.by_stop, parse_stop_index(xml).by_stop)
+
+if __name__ == '__main__':
+    unittest.main()
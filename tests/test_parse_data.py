@@ -0,0 +1,124 @@
+# tests/test_parse_data.py
+import unittest
+from jattavagen_departures.parse_data import (
+    iter_departures,
+    parse_departures,
+    parse_departures_stream,
+    parse_stop_index,
+    parse_timestamp,
+)
+from benchmarks.siri_fixture import generate_delivery
+
+SAMPLE_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<Siri xmlns="http://www.siri.org.uk/siri">
+    <ServiceDelivery>
+        <EstimatedTimetableDelivery>
+            <EstimatedJourneyVersionFrame>
+                <EstimatedVehicleJourney>
+                    <DirectionRef>EGS</DirectionRef>
+                    <DestinationName>Egersund</DestinationName>
+                    <RecordedCalls>
+                        <RecordedCall>
+                            <StopPointRef>NSR:Quay:600</StopPointRef>
+                            <AimedDepartureTime>2025-03-07T10:10:00+01:00</AimedDepartureTime>
+                        </RecordedCall>
+                        <RecordedCall>
+                            <StopPointRef>NSR:Quay:609</StopPointRef>
+                            <AimedDepartureTime>2025-03-07T10:15:00+01:00</AimedDepartureTime>
+                            <ActualDepartureTime>2025-03-07T10:17:00+01:00</ActualDepartureTime>
+                        </RecordedCall>
+                    </RecordedCalls>
+                </EstimatedVehicleJourney>
+                <EstimatedVehicleJourney>
+                    <DirectionRef>STV</DirectionRef>
+                    <DestinationName>Stavanger</DestinationName>
+                    <RecordedCalls>
+                        <RecordedCall>
+                            <StopPointRef>NSR:Quay:607</StopPointRef>
+                            <AimedDepartureTime>2025-03-07T10:20:00+01:00</AimedDepartureTime>
+                            <ActualDepartureTime>2025-03-07T10:20:00+01:00</ActualDepartureTime>
+                        </RecordedCall>
+                    </RecordedCalls>
+                </EstimatedVehicleJourney>
+            </EstimatedJourneyVersionFrame>
+        </EstimatedTimetableDelivery>
+    </ServiceDelivery>
+</Siri>
+"""
+
+def chunked(data, size):
+    """Splits bytes into fixed-size chunks, like a streamed response body."""
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+class TestParseDepartures(unittest.TestCase):
+    def test_parse_departures(self):
+        """Test that only Jåttåvågen calls are kept and grouped by direction"""
+        departures = parse_departures(SAMPLE_XML)
+
+        self.assertEqual(len(departures["southbound"]), 1)
+        self.assertEqual(len(departures["northbound"]), 1)
+        self.assertEqual(departures["southbound"][0].stop_ref, "NSR:Quay:609")
+        self.assertEqual(departures["southbound"][0].destination, "Egersund")
+        self.assertEqual(departures["northbound"][0].destination, "Stavanger")
+
+    def test_times_are_parsed_once_to_epoch_seconds(self):
+        """Test that timestamps keep their UTC offset when converted"""
+        departure = parse_departures(SAMPLE_XML)["southbound"][0]
+
+        self.assertEqual(departure.aimed, parse_timestamp("2025-03-07T09:15:00Z"))
+        self.assertEqual(departure.actual - departure.aimed, 120)
+
+    def test_timestamp_without_offset_is_local_time(self):
+        """Test that a naive timestamp is read as Norwegian local time"""
+        self.assertEqual(parse_timestamp("2025-03-07T10:15:00"), parse_timestamp("2025-03-07T10:15:00+01:00"))
+
+    def test_stop_index_covers_all_stops(self):
+        """Test that every quay in the delivery can be queried from one parse"""
+        index = parse_stop_index(SAMPLE_XML)
+
+        self.assertEqual(sorted(index.stops()), ["NSR:Quay:600", "NSR:Quay:607", "NSR:Quay:609"])
+        self.assertEqual(len(index.for_station("NSR:Quay:600")["southbound"]), 1)
+        self.assertEqual(index.for_station("Jåttåvågen"), parse_departures(SAMPLE_XML))
+        self.assertEqual(index.for_station("NSR:Quay:1"), {"southbound": [], "northbound": []})
+        with self.assertRaises(ValueError):
+            index.for_station("Nowhere")
+
+    def test_stream_matches_full_parse(self):
+        """Test that the incremental parser gives the same result for any chunking"""
+        expected = parse_departures(SAMPLE_XML)
+        data = SAMPLE_XML.encode("utf-8")
+
+        for size in (1, 7, 64, len(data)):
+            with self.subTest(chunk_size=size):
+                self.assertEqual(parse_departures_stream(chunked(data, size)), expected)
+
+    def test_stream_yields_per_journey(self):
+        """Test that departures are emitted before the whole document is read"""
+        data = SAMPLE_XML.encode("utf-8")
+        cut = data.index(b"</EstimatedVehicleJourney>") + len(b"</EstimatedVehicleJourney>")
+        fed = []
+
+        def chunks():
+            for part in (data[:cut], data[cut:]):
+                fed.append(part)
+                yield part
+
+        first = next(iter_departures(chunks()))
+        self.assertEqual(first.destination, "Egersund")
+        self.assertEqual(len(fed), 1)
+
+    def test_stream_rejects_malformed_xml(self):
+        """Test that parse errors are reported as ValueError"""
+        with self.assertRaises(ValueError):
+            parse_departures_stream([b"<Siri><broken>"])
+
+    def test_synthetic_fixture_parses(self):
+        """Test that the benchmark fixture parses to the expected departures"""
+        index = parse_stop_index(generate_delivery(journeys=10, calls_per_journey=6))
+        self.assertEqual(index.departure_count(), 60)
+        station = index.for_station()
+        self.assertEqual(len(station["southbound"]), 10)
+        self.assertEqual(len(station["northbound"]), 10)
+
+if __name__ == '__main__':
+    unittest.main()
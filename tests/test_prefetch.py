@@ -0,0 +1,50 @@
+# tests/test_prefetch.py
+import unittest
+from datetime import datetime
+from unittest.mock import patch
+from jattavagen_departures import prefetch
+from jattavagen_departures.config import (
+    PREFETCH_INTERVAL_SECONDS,
+    PREFETCH_IDLE_INTERVAL_SECONDS,
+    PREFETCH_NIGHT_INTERVAL_SECONDS,
+)
+from jattavagen_departures.prefetch import Prefetcher, next_interval
+
+class TestNextInterval(unittest.TestCase):
+    def test_polls_tightly_before_a_departure(self):
+        """Test that an imminent departure gives the shortest interval, even at night"""
+        night = datetime(2025, 3, 7, 2, 0)
+        self.assertEqual(next_interval(120, now=night), PREFETCH_INTERVAL_SECONDS)
+
+    def test_polls_loosely_when_idle(self):
+        """Test the idle interval during the day and the night interval at night"""
+        day = datetime(2025, 3, 7, 12, 0)
+        night = datetime(2025, 3, 7, 2, 0)
+        self.assertEqual(next_interval(None, now=day), PREFETCH_IDLE_INTERVAL_SECONDS)
+        self.assertEqual(next_interval(3600, now=night), PREFETCH_NIGHT_INTERVAL_SECONDS)
+
+    def test_night_window_can_wrap_midnight(self):
+        """Test that a night window like (23, 5) covers both sides of midnight"""
+        with patch.object(prefetch, "PREFETCH_NIGHT_HOURS", (23, 5)):
+            self.assertEqual(next_interval(None, now=datetime(2025, 3, 7, 23, 30)), PREFETCH_NIGHT_INTERVAL_SECONDS)
+            self.assertEqual(next_interval(None, now=datetime(2025, 3, 7, 4, 0)), PREFETCH_NIGHT_INTERVAL_SECONDS)
+            self.assertEqual(next_interval(None, now=datetime(2025, 3, 7, 12, 0)), PREFETCH_IDLE_INTERVAL_SECONDS)
+
+class TestPrefetcher(unittest.TestCase):
+    @patch('jattavagen_departures.prefetch.seconds_until_next_departure', return_value=60)
+    @patch('jattavagen_departures.prefetch.refresh_departures')
+    def test_refresh_once(self, mock_refresh, mock_next):
+        """Test that a refresh swaps in a snapshot and schedules the next one"""
+        delay = Prefetcher().refresh_once()
+
+        mock_refresh.assert_called_once()
+        mock_next.assert_called_once_with(mock_refresh.return_value, "Jåttåvågen")
+        self.assertEqual(delay, PREFETCH_INTERVAL_SECONDS)
+
+    @patch('jattavagen_departures.prefetch.refresh_departures', side_effect=ValueError("down"))
+    def test_failed_refresh_retries_soon(self, mock_refresh):
+        """Test that an upstream failure keeps the thread alive and retries soon"""
+        self.assertEqual(Prefetcher().refresh_once(), PREFETCH_INTERVAL_SECONDS)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# tests/test_query.py
+import time
+import unittest
+from datetime import datetime
+from unittest.mock import patch
+from jattavagen_departures.parse_data import LOCAL_TZ, Departure, StopIndex
+from jattavagen_departures.query import DepartureTimeline
+from jattavagen_departures.service import clear_cache, query_departures
+
+class TestDepartureTimeline(unittest.TestCase):
+    def setUp(self):
+        self.now = int(time.time())
+        self.southbound = [
+            Departure("NSR:Quay:609", self.now + minutes * 60, None, "southbound", destination)
+            for minutes, destination in ((30, "Egersund"), (-5, "Egersund"), (10, "Nærbø"), (20, "Egersund"))
+        ]
+        self.northbound = [Departure("NSR:Quay:607", self.now + 15 * 60, None, "northbound", "Stavanger")]
+        self.timeline = DepartureTimeline({"southbound": self.southbound, "northbound": self.northbound})
+
+    def aimed(self, departures):
+        return [(d.aimed - self.now) // 60 for d in departures]
+
+    def test_next_departures_are_sorted_and_cut_off(self):
+        upcoming = self.timeline.next(self.now)
+        self.assertEqual(self.aimed(upcoming["southbound"]), [10, 20, 30])
+        self.assertEqual(self.aimed(upcoming["northbound"]), [15])
+
+    def test_limit_direction_and_destination(self):
+        self.assertEqual(self.aimed(self.timeline.next(self.now, limit=2)["southbound"]), [10, 20])
+
+        southbound = self.timeline.next(self.now, direction="southbound")
+        self.assertEqual(southbound["northbound"], [])
+
+        egersund = self.timeline.next(self.now, limit=1, destination="Egersund")
+        self.assertEqual(self.aimed(egersund["southbound"]), [20])
+        self.assertEqual(egersund["northbound"], [])
+        self.assertEqual(self.timeline.next(self.now, destination="Oslo"), {"southbound": [], "northbound": []})
+
+    def test_cutoff_is_inclusive(self):
+        """Test that a departure exactly at the cutoff is still upcoming"""
+        upcoming = self.timeline.next(self.now + 20 * 60, direction="southbound")
+        self.assertEqual(self.aimed(upcoming["southbound"]), [20, 30])
+
+    def test_invalid_queries(self):
+        with self.assertRaises(ValueError):
+            self.timeline.next(self.now, direction="eastbound")
+        with self.assertRaises(ValueError):
+            self.timeline.next(self.now, limit=0)
+
+class TestQueryDepartures(unittest.TestCase):
+    def setUp(self):
+        clear_cache()
+        self.index = StopIndex()
+        self.today = datetime.now(LOCAL_TZ).replace(hour=0, minute=0, second=0, microsecond=0)
+        for hour in (9, 12, 18):
+            aimed = int(self.today.replace(hour=hour).timestamp())
+            self.index.add(Departure("NSR:Quay:609", aimed, None, "southbound", "Egersund"))
+        self.index.freeze()
+
+    def test_after_a_time_of_day(self):
+        """Test that 'after' is a local time today, but never before now"""
+        morning = self.today.replace(hour=8).timestamp()
+        with patch('jattavagen_departures.service.time.time', return_value=morning):
+            upcoming = query_departures(self.index, after="10:00")
+            self.assertEqual([datetime.fromtimestamp(d.aimed, LOCAL_TZ).hour for d in upcoming["southbound"]], [12, 18])
+
+        evening = self.today.replace(hour=13).timestamp()
+        with patch('jattavagen_departures.service.time.time', return_value=evening):
+            upcoming = query_departures(self.index, after="10:00", limit=1)
+            self.assertEqual([datetime.fromtimestamp(d.aimed, LOCAL_TZ).hour for d in upcoming["southbound"]], [18])
+
+    def test_timeline_is_built_once_per_snapshot(self):
+        with patch('jattavagen_departures.service.DepartureTimeline', wraps=DepartureTimeline) as timeline:
+            query_departures(self.index, limit=1)
+            query_departures(self.index, direction="southbound")
+        timeline.assert_called_once()
+
+if __name__ == '__main__':
+    unittest.main()
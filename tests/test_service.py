@@ -1,27 +1,39 @@
 # tests/test_service.py
+import asyncio
+import gc
+import json
+import threading
+import time
 import unittest
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from unittest.mock import patch, MagicMock
-from jattavagen_departures.service import get_upcoming_departures, format_departures
+from jattavagen_departures import service
+from benchmarks.siri_fixture import generate_delivery
+from jattavagen_departures.fetch_data import PreviewWindow
+from jattavagen_departures.parse_data import Departure, StopIndex
+from jattavagen_departures.service import (
+    DepartureBoard,
+    DepartureCache,
+    board_response,
+    board_response_json,
+    clear_cache,
+    format_departures,
+    get_departure_board,
+    get_upcoming_departures,
+    get_upcoming_departures_async,
+)
 
 class TestDepartureService(unittest.TestCase):
+    def setUp(self):
+        clear_cache()
+
     def test_format_departures(self):
         """Test that departures are properly formatted"""
-        # Create a dummy departures dict similar to what get_upcoming_departures returns.
-        current_time = datetime.now().astimezone()
+        # Create dummy departures similar to what get_upcoming_departures returns.
+        now = int(time.time())
         dummy_departures = {
-            "southbound": [{
-                "AimedDepartureTime": (current_time + timedelta(minutes=10)).isoformat(),
-                "ActualDepartureTime": (current_time + timedelta(minutes=10)).isoformat(),
-                "Destination": "Egersund",
-                "Direction": "southbound"
-            }],
-            "northbound": [{
-                "AimedDepartureTime": (current_time + timedelta(minutes=20)).isoformat(),
-                "ActualDepartureTime": (current_time + timedelta(minutes=22)).isoformat(),
-                "Destination": "Stavanger",
-                "Direction": "northbound"
-            }]
+            "southbound": [Departure("NSR:Quay:609", now + 600, now + 600, "southbound", "Egersund")],
+            "northbound": [Departure("NSR:Quay:607", now + 1200, now + 1320, "northbound", "Stavanger")]
         }
         
         formatted = format_departures(dummy_departures)
@@ -53,42 +65,28 @@ class TestDepartureService(unittest.TestCase):
             self.assertEqual(formatted["northbound"][0]["destination"], "Stavanger")
             self.assertEqual(formatted["northbound"][0]["status"], "delayed")
     
-    @patch('jattavagen_departures.service.fetch_timetable')
-    @patch('jattavagen_departures.service.parse_departures')
+    @patch('jattavagen_departures.service.fetch_timetable_hedged')
+    @patch('jattavagen_departures.service.parse_stop_index_parallel')
     def test_get_upcoming_departures(self, mock_parse, mock_fetch):
         """Test that departures are fetched, filtered and sorted"""
         # Mock the API response
         mock_fetch.return_value = "<xml>dummy xml</xml>"
         
-        # Set up the mock parse_departures to return test data
-        current_time = datetime.now().astimezone()
-        past_time = (current_time - timedelta(minutes=10)).isoformat()
-        future_time1 = (current_time + timedelta(minutes=10)).isoformat()
-        future_time2 = (current_time + timedelta(minutes=20)).isoformat()
+        # Set up the mock parse_stop_index_parallel to return test data
+        now = int(time.time())
+        past_time = now - 600
+        future_time1 = now + 600
+        future_time2 = now + 1200
         
-        mock_parse.return_value = {
-            "southbound": [
-                {
-                    "AimedDepartureTime": past_time,
-                    "ActualDepartureTime": past_time,
-                    "Destination": "Egersund",
-                    "Direction": "southbound"
-                },
-                {
-                    "AimedDepartureTime": future_time2,
-                    "ActualDepartureTime": future_time2,
-                    "Destination": "Egersund",
-                    "Direction": "southbound"
-                },
-                {
-                    "AimedDepartureTime": future_time1,
-                    "ActualDepartureTime": future_time1,
-                    "Destination": "Nærbø",
-                    "Direction": "southbound"
-                }
-            ],
-            "northbound": []
-        }
+        index = StopIndex()
+        for departure in [
+            Departure("NSR:Quay:609", past_time, past_time, "southbound", "Egersund"),
+            Departure("NSR:Quay:609", future_time2, future_time2, "southbound", "Egersund"),
+            Departure("NSR:Quay:607", future_time1, future_time1, "southbound", "Nærbø"),
+            Departure("NSR:Quay:100", future_time1, future_time1, "northbound", "Stavanger"),
+        ]:
+            index.add(departure)
+        mock_parse.return_value = index
         
         # Call the function
         result = get_upcoming_departures()
@@ -101,8 +99,500 @@ class TestDepartureService(unittest.TestCase):
         self.assertEqual(len(result["southbound"]), 2)
         
         # Verify sorting
-        self.assertEqual(result["southbound"][0]["Destination"], "Nærbø")
-        self.assertEqual(result["southbound"][1]["Destination"], "Egersund")
+        self.assertEqual(result["southbound"][0].destination, "Nærbø")
+        self.assertEqual(result["southbound"][1].destination, "Egersund")
+
+        # Verify that stops outside the station are left out
+        self.assertEqual(result["northbound"], [])
+
+    @patch('jattavagen_departures.service.fetch_timetable_hedged')
+    @patch('jattavagen_departures.service.parse_stop_index_parallel')
+    def test_stations_share_one_fetch(self, mock_parse, mock_fetch):
+        """Test that different stations are answered from the same parsed delivery"""
+        mock_fetch.return_value = "<xml>dummy xml</xml>"
+        future_time = int(time.time()) + 3600
+        index = StopIndex()
+        for stop_ref in ("NSR:Quay:609", "NSR:Quay:100"):
+            index.add(Departure(stop_ref, future_time, None, "northbound", "Stavanger"))
+        mock_parse.return_value = index
+
+        jattavagen = get_upcoming_departures()
+        other = get_upcoming_departures("NSR:Quay:100")
+
+        mock_fetch.assert_called_once()
+        mock_parse.assert_called_once()
+        self.assertEqual(jattavagen["northbound"][0].stop_ref, "NSR:Quay:609")
+        self.assertEqual(other["northbound"][0].stop_ref, "NSR:Quay:100")
+        with self.assertRaises(ValueError):
+            get_upcoming_departures("Nowhere")
+
+    @patch('jattavagen_departures.service._preview', PreviewWindow(minimum=30, maximum=120, step=15, slack=0.5))
+    @patch('jattavagen_departures.service.PREVIEW_INTERVAL_MINUTES', 120)
+    @patch('jattavagen_departures.service.fetch_timetable_hedged')
+    @patch('jattavagen_departures.service.parse_stop_index_parallel')
+    def test_short_answer_widens_preview_window(self, mock_parse, mock_fetch):
+        """Test that next-N queries narrow the window and a short answer refetches a wider one"""
+        mock_fetch.return_value = "<xml>dummy xml</xml>"
+        now = int(time.time())
+
+        def parse(xml_response):
+            # Like the API, only departures within the requested window
+            minutes = mock_fetch.call_args.kwargs["preview_minutes"]
+            index = StopIndex()
+            for offset in (5, 10, 50):
+                if offset < minutes:
+                    for direction in ("southbound", "northbound"):
+                        index.add(Departure("NSR:Quay:609", now + offset * 60, None, direction, "Egersund"))
+            return index
+
+        mock_parse.side_effect = parse
+
+        get_upcoming_departures(limit=2)
+        # Expire the snapshot but keep the needs the window was narrowed to
+        service._cache.clear()
+        short = get_upcoming_departures(limit=2)
+        widened = get_upcoming_departures(limit=3)
+
+        # A short answer widens straight to the full window, in one refresh
+        self.assertEqual([call.kwargs["preview_minutes"] for call in mock_fetch.call_args_list], [120, 30, 120])
+        self.assertEqual(len(short["southbound"]), 2)
+        self.assertEqual([d.aimed - now for d in widened["northbound"]], [300, 600, 3000])
+
+    @patch('jattavagen_departures.service._preview', PreviewWindow(minimum=30, maximum=120, step=15, slack=0.5))
+    @patch('jattavagen_departures.service.PREVIEW_INTERVAL_MINUTES', 120)
+    @patch('jattavagen_departures.service.fetch_timetable_hedged')
+    @patch('jattavagen_departures.service.parse_stop_index_parallel')
+    def test_full_board_after_narrowed_window(self, mock_parse, mock_fetch):
+        """Test that full-board queries are never answered from a narrowed snapshot"""
+        mock_fetch.return_value = "<xml>dummy xml</xml>"
+        now = int(time.time())
+
+        def parse(xml_response):
+            minutes = mock_fetch.call_args.kwargs["preview_minutes"]
+            index = StopIndex()
+            for offset in (5, 10, 50, 100):
+                if offset < minutes:
+                    for direction in ("southbound", "northbound"):
+                        index.add(Departure("NSR:Quay:609", now + offset * 60, None, direction, "Egersund"))
+            return index
+
+        mock_parse.side_effect = parse
+
+        get_upcoming_departures(limit=2)
+        service._cache.clear()
+        narrowed = get_departure_board(limit=2)
+        board = get_departure_board()
+        upcoming = get_upcoming_departures()
+        limited = get_upcoming_departures(limit=2)
+
+        self.assertEqual([call.kwargs["preview_minutes"] for call in mock_fetch.call_args_list], [120, 30, 120])
+        self.assertEqual(len(narrowed.data["southbound"]), 2)
+        self.assertEqual(len(board.data["southbound"]), 4)
+        self.assertEqual(len(board.data["northbound"]), 4)
+        self.assertEqual(len(upcoming["northbound"]), 4)
+        self.assertEqual(len(limited["northbound"]), 2)
+
+    @patch('jattavagen_departures.service.plan_batches')
+    @patch('jattavagen_departures.service.fetch_timetable_hedged')
+    def test_batches_are_merged_and_fanned_out(self, mock_fetch, mock_plan):
+        """Test that several batched deliveries become one index answering each line"""
+        future_time = (datetime.now().astimezone() + timedelta(hours=3)).isoformat()
+
+        def delivery(journey_ref, line_ref):
+            return f"""<?xml version="1.0" encoding="UTF-8"?>
+<Siri xmlns="http://www.siri.org.uk/siri"><ServiceDelivery><EstimatedTimetableDelivery>
+<EstimatedJourneyVersionFrame><EstimatedVehicleJourney>
+  <LineRef>{line_ref}</LineRef>
+  <DatedVehicleJourneyRef>{journey_ref}</DatedVehicleJourneyRef>
+  <DirectionRef>EGS</DirectionRef>
+  <DestinationName>Egersund</DestinationName>
+  <RecordedCalls><RecordedCall>
+    <StopPointRef>NSR:Quay:609</StopPointRef>
+    <AimedDepartureTime>{future_time}</AimedDepartureTime>
+  </RecordedCall></RecordedCalls>
+</EstimatedVehicleJourney></EstimatedJourneyVersionFrame>
+</EstimatedTimetableDelivery></ServiceDelivery></Siri>"""
+
+        batches = [([("GOA:Line:59", "EGS")], ["NSR:Quay:609"]), ([("GOA:Line:60", "EGS")], ["NSR:Quay:609"]),
+                   ([("GOA:Line:59", "EGS")], ["NSR:Quay:607"])]
+        mock_plan.return_value = batches
+        # The first journey matches two of the batches and is delivered twice
+        mock_fetch.side_effect = [delivery("J1", "GOA:Line:59"), delivery("J2", "GOA:Line:60"), delivery("J1", "GOA:Line:59")]
+
+        everything = get_upcoming_departures()
+        line_60 = get_upcoming_departures(line="GOA:Line:60")
+
+        self.assertEqual(mock_fetch.call_count, 3)
+        self.assertEqual(sorted(d.journey_ref for d in everything["southbound"]), ["J1", "J2"])
+        self.assertEqual([d.journey_ref for d in line_60["southbound"]], ["J2"])
+
+    @patch('jattavagen_departures.service.STREAMING_PARSE', False)
+    @patch('jattavagen_departures.service.INCREMENTAL_UPDATES', True)
+    @patch('jattavagen_departures.service.plan_batches', return_value=[None])
+    @patch('jattavagen_departures.service.fetch_timetable_hedged')
+    def test_failed_delta_poll_resyncs(self, mock_fetch, mock_plan):
+        """Test that after a failed delta poll the next poll is a full one with a new requestor"""
+        start = datetime.now(timezone.utc).replace(microsecond=0)
+        delivery = generate_delivery(journeys=4, calls_per_journey=3, start=start)
+        mock_fetch.side_effect = [delivery, ConnectionError("reset mid-body"), delivery]
+
+        get_upcoming_departures()
+        service._cache.clear()
+        with self.assertRaises(ConnectionError):
+            get_upcoming_departures()
+        service._cache.clear()
+        get_upcoming_departures()
+
+        requestors = [call.args[0] for call in mock_fetch.call_args_list]
+        self.assertEqual(requestors[1], requestors[0])
+        self.assertNotEqual(requestors[2], requestors[1])
+        self.assertEqual(service._journey_state.stats()["full_refreshes"], 2)
+
+    @patch('jattavagen_departures.service.STREAMING_PARSE', True)
+    @patch('jattavagen_departures.service.INCREMENTAL_UPDATES', False)
+    @patch('jattavagen_departures.service.fetch_timetable_hedged_async')
+    @patch('jattavagen_departures.service.stream_timetable_async')
+    def test_async_path_streams(self, mock_stream, mock_fetch):
+        """Test that the event loop path parses the streamed response instead of buffering it"""
+        start = datetime.now(timezone.utc).replace(microsecond=0)
+        body = generate_delivery(journeys=6, calls_per_journey=6, start=start).encode("utf-8")
+
+        async def stream(**kwargs):
+            for position in range(0, len(body), 500):
+                await asyncio.sleep(0)
+                yield body[position:position + 500]
+
+        mock_stream.side_effect = stream
+
+        result = asyncio.run(get_upcoming_departures_async())
+
+        mock_fetch.assert_not_called()
+        mock_stream.assert_called_once()
+        self.assertGreater(len(result["southbound"]) + len(result["northbound"]), 0)
+
+    @patch('jattavagen_departures.service.fetch_timetable_hedged_async')
+    @patch('jattavagen_departures.service.parse_stop_index_parallel')
+    def test_get_upcoming_departures_async(self, mock_parse, mock_fetch):
+        """Test that concurrent async callers share one non-blocking fetch"""
+        async def slow_fetch(*args, **kwargs):
+            await asyncio.sleep(0.05)
+            return "<xml>dummy xml</xml>"
+
+        mock_fetch.side_effect = slow_fetch
+        index = StopIndex()
+        index.add(Departure("NSR:Quay:609", int(time.time()) + 3600, None, "southbound", "Egersund"))
+        mock_parse.return_value = index
+
+        async def run():
+            return await asyncio.gather(*(get_upcoming_departures_async() for _ in range(5)))
+
+        results = asyncio.run(run())
+
+        mock_fetch.assert_called_once()
+        mock_parse.assert_called_once_with("<xml>dummy xml</xml>")
+        self.assertTrue(all(r["southbound"][0].destination == "Egersund" for r in results))
+
+    def test_format_uses_local_time_zone(self):
+        """Test that times with any UTC offset are shown in Norwegian local time"""
+        aimed = int(datetime.fromisoformat("2025-07-01T08:15:00+00:00").timestamp())
+        departures = {"southbound": [Departure("NSR:Quay:609", aimed, aimed + 120, "southbound", "Egersund")]}
+
+        formatted = format_departures(departures)
+
+        self.assertEqual(formatted["southbound"][0]["aimed"], "10:15")
+        self.assertEqual(formatted["southbound"][0]["actual"], "10:17")
+        self.assertEqual(formatted["southbound"][0]["status"], "delayed")
+
+class TestDepartureBoard(unittest.TestCase):
+    def setUp(self):
+        clear_cache()
+        self.now = int(time.time())
+        self.index = StopIndex()
+        for minutes in (10, 20):
+            self.index.add(Departure("NSR:Quay:609", self.now + minutes * 60, None, "northbound", "Stavanger"))
+        self.index.fetched_at = time.time()
+
+    @patch('jattavagen_departures.service.format_departures', wraps=format_departures)
+    @patch('jattavagen_departures.service.fetch_timetable_hedged')
+    @patch('jattavagen_departures.service.parse_stop_index_parallel')
+    def test_board_is_built_once_per_snapshot(self, mock_parse, mock_fetch, mock_format):
+        """Test that repeated calls reuse the formatted and serialized board"""
+        mock_fetch.return_value = "<xml>dummy xml</xml>"
+        mock_parse.return_value = self.index
+
+        first = get_departure_board()
+        second = get_departure_board()
+
+        self.assertIs(first, second)
+        mock_format.assert_called_once()
+        self.assertEqual(json.loads(first.json), first.data)
+        self.assertEqual(len(first.data["northbound"]), 2)
+
+    @patch('jattavagen_departures.service.BOARD_CACHE_SIZE', 3)
+    def test_board_cache_is_bounded(self):
+        """Test that boards are kept per snapshot and only the most recent queries within it"""
+        for destination in ("A", "B", "C", "D", "E"):
+            service._board(self.index, service.DEFAULT_STATION, None, (None, None, destination, None))
+        service._board(self.index, service.DEFAULT_STATION, None, (None, None, "C", None))
+        service._board(self.index, service.DEFAULT_STATION, None, (None, None, "F", None))
+
+        self.assertEqual([key[4] for key in service._boards[self.index]], ["E", "C", "F"])
+
+        newer = StopIndex()
+        newer.fetched_at = self.index.fetched_at + 30
+        service._board(newer, service.DEFAULT_STATION, None, (None, None, None, None))
+        del self.index
+        gc.collect()
+        self.assertEqual(len(service._boards), 1)
+
+    def test_board_expires_when_departure_leaves(self):
+        board = DepartureBoard(self.index, {"northbound": list(self.index.for_station()["northbound"])})
+        self.assertTrue(board.is_current(self.index))
+
+        with patch('jattavagen_departures.service.time.time', return_value=self.now + 10 * 60 + 1):
+            self.assertFalse(board.is_current(self.index))
+
+        newer = StopIndex()
+        newer.fetched_at = self.index.fetched_at + 30
+        self.assertFalse(board.is_current(newer))
+
+    def test_version_follows_content(self):
+        """Test that equal boards share a version and changed boards do not"""
+        upcoming = {"northbound": list(self.index.for_station()["northbound"])}
+        board = DepartureBoard(self.index, upcoming)
+        self.assertEqual(DepartureBoard(self.index, upcoming).version, board.version)
+        self.assertNotEqual(DepartureBoard(self.index, {"northbound": upcoming["northbound"][1:]}).version, board.version)
+
+    def test_not_modified_reply(self):
+        board = DepartureBoard(self.index, self.index.for_station())
+
+        full = board_response(board, "Jåttåvågen", since_version="older")
+        unchanged = board_response(board, "Jåttåvågen", since_version=board.version)
+
+        self.assertIs(full["data"], board.data)
+        self.assertEqual(full["version"], board.version)
+        self.assertTrue(unchanged["not_modified"])
+        self.assertNotIn("data", unchanged)
+        self.assertEqual(json.loads(board_response_json(board, "Jåttåvågen")), board_response(board, "Jåttåvågen"))
+        self.assertEqual(json.loads(board_response_json(board, "Jåttåvågen", board.version)), unchanged)
+
+class TestDepartureCache(unittest.TestCase):
+    def test_value_is_reused_within_ttl(self):
+        """Test that a fresh value is served without calling the loader again"""
+        loader = MagicMock(return_value={"southbound": [], "northbound": []})
+        cache = DepartureCache(loader, ttl=60)
+
+        first = cache.get()
+        second = cache.get()
+
+        self.assertIs(first, second)
+        loader.assert_called_once()
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_expired_value_is_reloaded(self):
+        """Test that a zero TTL forces a reload on every call"""
+        loader = MagicMock(return_value={})
+        cache = DepartureCache(loader, ttl=0)
+
+        cache.get()
+        cache.get()
+
+        self.assertEqual(loader.call_count, 2)
+
+    def test_concurrent_callers_share_one_load(self):
+        """Test that callers arriving during a refresh wait for it instead of loading"""
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow_loader():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {"southbound": [], "northbound": []}
+
+        cache = DepartureCache(slow_loader, ttl=60)
+        results = []
+        leader = threading.Thread(target=lambda: results.append(cache.get()))
+        leader.start()
+        started.wait(5)
+
+        followers = [threading.Thread(target=lambda: results.append(cache.get())) for _ in range(5)]
+        for t in followers:
+            t.start()
+        # Give the followers time to join the in-flight load before releasing it
+        while cache.stats()["coalesced"] < 5:
+            time.sleep(0.01)
+        release.set()
+        for t in [leader] + followers:
+            t.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 6)
+        self.assertTrue(all(r is results[0] for r in results))
+
+    def test_forced_load_is_skipped_once_value_is_replaced(self):
+        """Test that callers forcing out the same value share one load"""
+        loads = []
+        cache = DepartureCache(lambda: loads.append(len(loads)) or object(), ttl=60)
+        first = cache.get()
+
+        newer = cache.get(force=True, replacing=first)
+        again = cache.get(force=True, replacing=first)
+        awaited = asyncio.run(cache.get_async(force=True, replacing=first))
+
+        self.assertIsNot(newer, first)
+        self.assertIs(again, newer)
+        self.assertIs(awaited, newer)
+        self.assertEqual(len(loads), 2)
+
+    def test_serve_stale_skips_reload(self):
+        """Test that a background-refreshed cache never reloads once populated"""
+        loader = MagicMock(return_value={})
+        cache = DepartureCache(loader, ttl=0)
+        cache.serve_stale = True
+
+        cache.get()
+        cache.get()
+        cache.get(force=True)
+
+        self.assertEqual(loader.call_count, 2)
+
+    def test_loader_error_is_raised_to_all_waiters(self):
+        """Test that a failed load is not cached and the error propagates"""
+        loader = MagicMock(side_effect=ValueError("boom"))
+        cache = DepartureCache(loader, ttl=60)
+
+        with self.assertRaises(ValueError):
+            cache.get()
+        with self.assertRaises(ValueError):
+            cache.get()
+        self.assertEqual(loader.call_count, 2)
+
+    def test_waiters_get_their_own_exception(self):
+        """Test that callers coalesced onto a failed load each get a separate exception"""
+        started = threading.Event()
+        release = threading.Event()
+        original = ValueError("boom")
+
+        def failing_loader():
+            started.set()
+            release.wait(5)
+            raise original
+
+        cache = DepartureCache(failing_loader, ttl=60)
+        errors = []
+
+        def call():
+            try:
+                cache.get()
+            except ValueError as e:
+                errors.append(e)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=call)
+        follower.start()
+        while cache.stats()["coalesced"] < 1:
+            time.sleep(0.01)
+        release.set()
+        for t in (leader, follower):
+            t.join(5)
+
+        self.assertEqual(len(errors), 2)
+        waiter_error = next(e for e in errors if e is not original)
+        self.assertEqual(str(waiter_error), "boom")
+        self.assertIs(waiter_error.__cause__, original)
+
+    def test_stale_value_is_served_while_revalidating(self):
+        """Test that an expired value is returned at once and refreshed in the background"""
+        release = threading.Event()
+
+        def loader():
+            release.wait(5)
+            return "new"
+
+        cache = DepartureCache(loader, ttl=60, seed_loader=lambda: ("old", 600), stale_while_revalidate=True)
+
+        # Every caller gets the stale value while one refresh is running
+        self.assertEqual(cache.get(), "old")
+        self.assertEqual(cache.get(), "old")
+        self.assertTrue(cache.is_stale())
+        self.assertEqual(cache.stats()["revalidations"], 1)
+
+        release.set()
+        deadline = time.monotonic() + 5
+        while cache.is_stale() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(cache.get(), "new")
+        self.assertEqual(cache.stats()["revalidations"], 1)
+
+    def test_failed_revalidation_keeps_stale_value(self):
+        """Test that an upstream failure leaves the old value in place, marked stale"""
+        loader = MagicMock(side_effect=["old", ValueError("timeout")])
+        cache = DepartureCache(loader, ttl=60, stale_while_revalidate=True)
+        cache.get()
+
+        with self.assertRaises(ValueError):
+            cache.get(force=True)
+
+        self.assertEqual(cache.get(), "old")
+        self.assertTrue(cache.is_stale())
+
+    def test_deadline_serves_expired_value(self):
+        """Test that a caller stops waiting at its deadline while the load carries on"""
+        release = threading.Event()
+
+        def loader():
+            release.wait(5)
+            return "new"
+
+        cache = DepartureCache(loader, ttl=60, seed_loader=lambda: ("old", 600))
+        start = time.monotonic()
+        self.assertEqual(cache.get(deadline=time.monotonic() + 0.1), "old")
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(cache.stats()["deadline_misses"], 1)
+
+        release.set()
+        self.assertEqual(cache.get(), "new")
+
+    def test_deadline_without_value_times_out(self):
+        """Test that a deadline with nothing to fall back on raises TimeoutError"""
+        release = threading.Event()
+        self.addCleanup(release.set)
+        cache = DepartureCache(lambda: release.wait(5), ttl=60)
+
+        with self.assertRaises(TimeoutError):
+            cache.get(deadline=time.monotonic() + 0.05)
+
+    def test_async_deadline_serves_expired_value(self):
+        """Test that an async caller gets the expired value at its deadline"""
+        async def loader():
+            await asyncio.sleep(0.5)
+            return "new"
+
+        cache = DepartureCache(MagicMock(), ttl=60, async_loader=loader, seed_loader=lambda: ("old", 600))
+
+        async def run():
+            first = await cache.get_async(deadline=time.monotonic() + 0.05)
+            second = await cache.get_async()
+            return first, second
+
+        self.assertEqual(asyncio.run(run()), ("old", "new"))
+
+    def test_seed_is_served_without_loading(self):
+        """Test that a recent seed counts as fresh and an old one as stale"""
+        loader = MagicMock(return_value="loaded")
+        cache = DepartureCache(loader, ttl=60, seed_loader=lambda: ("seeded", 5))
+        self.assertEqual(cache.get(), "seeded")
+        self.assertFalse(cache.is_stale())
+        loader.assert_not_called()
+
+        cache = DepartureCache(loader, ttl=60, seed_loader=lambda: ("seeded", 600), stale_while_revalidate=True)
+        self.assertEqual(cache.get(), "seeded")
+        self.assertTrue(cache.is_stale())
 
 if __name__ == '__main__':
     unittest.main()
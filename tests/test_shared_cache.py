@@ -0,0 +1,100 @@
+# tests/test_shared_cache.py
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+from jattavagen_departures import service, shared_cache
+from jattavagen_departures.parse_data import parse_stop_index
+from benchmarks.siri_fixture import generate_delivery
+
+def snapshot(journeys=4, fetched_at=None):
+    index = parse_stop_index(generate_delivery(journeys=journeys, calls_per_journey=6)).freeze()
+    index.fetched_at = fetched_at or time.time()
+    return index
+
+@unittest.skipIf(shared_cache.fcntl is None, "Advisory file locks are not available")
+class TestSharedSnapshotStore(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        # Two stores on the same directory stand in for two worker processes
+        self.first = shared_cache.SharedSnapshotStore(directory.name)
+        self.second = shared_cache.SharedSnapshotStore(directory.name)
+        self.addCleanup(self.first.close)
+        self.addCleanup(self.second.close)
+
+    def test_one_refresher_at_a_time(self):
+        """Test that only one worker holds the refresher role until it resigns"""
+        self.assertTrue(self.first.try_elect())
+        self.assertFalse(self.second.try_elect())
+        self.assertTrue(self.first.try_elect())
+
+        self.first.resign()
+        self.assertTrue(self.second.try_elect())
+
+    def test_readers_reload_only_new_generations(self):
+        """Test that a reader decodes each published generation once"""
+        self.assertIsNone(self.second.read())
+
+        self.first.publish(snapshot(journeys=4))
+        first_read = self.second.read()
+        self.assertEqual(self.second.generation(), 1)
+        self.assertEqual(first_read.departure_count(), 24)
+        self.assertIs(self.second.read(), first_read)
+
+        self.first.publish(snapshot(journeys=6))
+        self.assertEqual(self.second.read().departure_count(), 36)
+
+    def test_followers_do_not_fetch(self):
+        """Test that only the elected worker calls the API while the snapshot is fresh"""
+        self.first.publish(snapshot())
+        with patch.object(service, "_shared_store", self.second), \
+             patch.object(service, "_load_stop_index") as fetch:
+            self.assertTrue(self.first.try_elect())
+            index = service._load_shared()
+
+        fetch.assert_not_called()
+        self.assertEqual(index.departure_count(), 24)
+
+    def test_due_snapshot_is_refreshed_by_refresher(self):
+        """Test that an old snapshot makes the refresher fetch and publish"""
+        self.first.publish(snapshot(fetched_at=time.time() - 3600))
+        with patch.object(service, "_shared_store", self.first), \
+             patch.object(service, "_load_stop_index", return_value=snapshot(journeys=6)):
+            service._load_shared()
+
+        self.assertEqual(self.second.read().departure_count(), 36)
+        self.assertEqual(self.second.generation(), 2)
+
+    def test_idle_refresher_is_reported_stale(self):
+        """Test that followers flag a snapshot the refresher has stopped refreshing"""
+        self.assertTrue(self.first.try_elect())
+        self.first.publish(snapshot(fetched_at=time.time() - 3 * service.CACHE_TTL_SECONDS))
+        cache = service.DepartureCache(service._load_shared, 1)
+        with patch.object(service, "_shared_store", self.second), \
+             patch.object(service, "_cache", cache), \
+             patch.object(service, "_load_stop_index") as fetch:
+            index = cache.get()
+            stale = service.is_stale()
+
+        fetch.assert_not_called()
+        self.assertEqual(index.departure_count(), 24)
+        self.assertTrue(stale)
+
+    def test_refresher_timer_publishes_without_requests(self):
+        """Test that the refresher's timer replaces a due snapshot on its own"""
+        self.assertTrue(self.first.try_elect())
+        self.first.publish(snapshot(fetched_at=time.time() - service.CACHE_TTL_SECONDS))
+        cache = service.DepartureCache(service._load_shared, 1)
+        with patch.object(service, "_shared_store", self.first), \
+             patch.object(service, "_cache", cache), \
+             patch.object(service, "_load_stop_index", return_value=snapshot(journeys=6)):
+            delay = service._refresh_shared()
+            stale = service.is_stale()
+
+        self.assertEqual(self.second.read().departure_count(), 36)
+        self.assertGreater(delay, service.CACHE_TTL_SECONDS - 5)
+        self.assertFalse(stale)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+# tests/test_snapshot.py
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+from jattavagen_departures import service, snapshot
+from jattavagen_departures.parse_data import Departure, StopIndex, parse_stop_index
+from benchmarks.siri_fixture import generate_delivery
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "snapshot.bin")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        """Test that a saved snapshot loads back into an identical index"""
+        index = parse_stop_index(generate_delivery(journeys=20, calls_per_journey=6)).freeze()
+        index.fetched_at = 1700000000.5
+
+        snapshot.save_snapshot(index, self.path)
+        loaded = snapshot.load_snapshot(self.path)
+
+        self.assertEqual(loaded.by_stop, index.by_stop)
+        self.assertEqual(loaded.fetched_at, 1700000000.5)
+
+    def test_optional_fields_survive(self):
+        """Test that missing actual times and journey references are kept as None"""
+        index = StopIndex()
+        index.add(Departure("NSR:Quay:609", 1700000000, None, "southbound", "Egersund"))
+
+        loaded = snapshot.load_snapshot_bytes(snapshot.dump_snapshot(index.freeze()))
+
+        self.assertEqual(loaded.by_stop, index.by_stop)
+        self.assertIsNone(loaded.fetched_at)
+
+    def test_rejects_other_versions_and_truncation(self):
+        """Test that incompatible or damaged files are reported as ValueError"""
+        data = snapshot.dump_snapshot(parse_stop_index(generate_delivery(journeys=2)))
+        newer = data[:4] + (snapshot.FORMAT_VERSION + 1).to_bytes(2, "little") + data[6:]
+
+        for damaged in (newer, data[:-3], b"not a snapshot at all, just bytes"):
+            with self.subTest(damaged=damaged[:8]):
+                with self.assertRaises(ValueError):
+                    snapshot.load_snapshot_bytes(damaged)
+
+    def test_service_warm_starts_from_disk(self):
+        """Test that a persisted snapshot answers the first call without fetching"""
+        index = parse_stop_index(generate_delivery(journeys=10, calls_per_journey=6))
+        index.fetched_at = time.time()
+        snapshot.save_snapshot(index, self.path)
+
+        cache = service.DepartureCache(
+            lambda: self.fail("Fetched despite a fresh snapshot"), 60, seed_loader=service._load_disk_snapshot
+        )
+        with patch.object(service, "SNAPSHOT_PATH", self.path):
+            departures = cache.get().for_station()
+
+        self.assertEqual(len(departures["southbound"]), 10)
+
+if __name__ == '__main__':
+    unittest.main()
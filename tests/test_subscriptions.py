@@ -0,0 +1,82 @@
+# tests/test_subscriptions.py
+import time
+import unittest
+from unittest.mock import MagicMock
+from jattavagen_departures.parse_data import Departure
+from jattavagen_departures.subscriptions import (
+    SubscriptionHub,
+    board_uri,
+    diff_departures,
+    parse_board_uri,
+)
+
+class TestDiffDepartures(unittest.TestCase):
+    def setUp(self):
+        self.now = int(time.time()) // 60 * 60
+
+    def departure(self, journey, minutes, delay_seconds=None):
+        aimed = self.now + minutes * 60
+        actual = None if delay_seconds is None else aimed + delay_seconds
+        return Departure("NSR:Quay:609", aimed, actual, "southbound", "Egersund", journey)
+
+    def test_added_changed_and_removed(self):
+        old = [self.departure("J1", 5), self.departure("J2", 10), self.departure("J3", 15)]
+        new = [self.departure("J2", 10, 180), self.departure("J3", 15), self.departure("J4", 20)]
+
+        changes = diff_departures(old, new)
+
+        self.assertEqual([(c["change"], c["id"].split("@")[0]) for c in changes],
+                         [("removed", "J1"), ("changed", "J2"), ("added", "J4")])
+        self.assertEqual(changes[1]["status"], "delayed")
+        self.assertTrue(changes[1]["status_changed"])
+        self.assertEqual(changes[2]["destination"], "Egersund")
+
+    def test_changes_within_the_shown_minute_are_not_sent(self):
+        old = [self.departure("J1", 5, 10)]
+        new = [self.departure("J1", 5, 20)]
+        self.assertEqual(diff_departures(old, new), [])
+
+class TestSubscriptionHub(unittest.TestCase):
+    def setUp(self):
+        self.hub = SubscriptionHub()
+        self.departures = {("Jåttåvågen", "southbound"): []}
+        self.lookup = MagicMock(side_effect=lambda station, direction: self.departures[(station, direction)])
+        self.aimed = int(time.time()) + 600
+
+    def test_update_is_computed_once_for_all_subscribers(self):
+        """Test that a changed board yields one update listing every subscriber"""
+        first, second = object(), object()
+        uri = self.hub.subscribe(first, "Jåttåvågen", "southbound", self.lookup)
+        self.hub.subscribe(second, "Jåttåvågen", "southbound", self.lookup)
+        self.assertEqual(self.hub.update(self.lookup), [])
+
+        self.departures[("Jåttåvågen", "southbound")] = [
+            Departure("NSR:Quay:609", self.aimed, None, "southbound", "Egersund", "J1")
+        ]
+        self.lookup.reset_mock()
+        updates = self.hub.update(self.lookup)
+
+        self.lookup.assert_called_once_with("Jåttåvågen", "southbound")
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(updates[0].uri, uri)
+        self.assertEqual(updates[0].version, 1)
+        self.assertEqual(set(updates[0].subscribers), {first, second})
+        self.assertEqual(self.hub.board("Jåttåvågen", "southbound", self.lookup)["version"], 1)
+
+    def test_unsubscribe_drops_empty_boards(self):
+        subscriber = object()
+        self.hub.subscribe(subscriber, "Jåttåvågen", "southbound", self.lookup)
+        self.hub.unsubscribe(subscriber)
+        self.assertFalse(self.hub.has_subscribers())
+
+    def test_board_uris(self):
+        uri = board_uri("Jåttåvågen", "northbound")
+        self.assertEqual(uri, "togtider://departures/J%C3%A5tt%C3%A5v%C3%A5gen/northbound")
+        self.assertEqual(parse_board_uri(uri), ("Jåttåvågen", "northbound"))
+        with self.assertRaises(ValueError):
+            parse_board_uri("togtider://departures/Jåttåvågen/eastbound")
+        with self.assertRaises(ValueError):
+            self.hub.subscribe(object(), "Jåttåvågen", "eastbound", self.lookup)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# tests/test_xml_backend.py
+import unittest
+from unittest.mock import patch
+from jattavagen_departures import parse_data
+from jattavagen_departures.parse_data import (
+    parse_departures,
+    parse_departures_stream,
+    parse_stop_index,
+)
+from jattavagen_departures.xml_backend import LxmlBackend, StdlibBackend, select_backend
+from benchmarks.siri_fixture import generate_delivery
+from tests.test_parse_data import SAMPLE_XML, chunked
+
+try:
+    import lxml  # noqa: F401
+    HAVE_LXML = True
+except ImportError:
+    HAVE_LXML = False
+
+class TestSelectBackend(unittest.TestCase):
+    def test_stdlib_is_always_available(self):
+        self.assertIsInstance(select_backend("stdlib"), StdlibBackend)
+
+    def test_unknown_backend_is_rejected(self):
+        with self.assertRaises(ValueError):
+            select_backend("expat")
+
+    def test_falls_back_without_lxml(self):
+        """Test that a missing lxml falls back to the stdlib parser"""
+        with patch.dict("sys.modules", {"lxml": None}):
+            self.assertIsInstance(select_backend("auto"), StdlibBackend)
+            with self.assertLogs("togtider.xml", level="WARNING"):
+                self.assertIsInstance(select_backend("lxml"), StdlibBackend)
+
+@unittest.skipUnless(HAVE_LXML, "lxml is not installed")
+class TestBackendParity(unittest.TestCase):
+    def setUp(self):
+        self.fixture = generate_delivery(journeys=20, calls_per_journey=6)
+
+    def parse_with(self, backend):
+        with patch.object(parse_data, "_xml", backend):
+            return {
+                "departures": parse_departures(SAMPLE_XML),
+                "stream": parse_departures_stream(chunked(SAMPLE_XML.encode("utf-8"), 64)),
+                "fixture": parse_stop_index(self.fixture).by_stop,
+            }
+
+    def test_backends_agree(self):
+        """Test that every backend parses to the same departures"""
+        expected = self.parse_with(StdlibBackend())
+        for backend in (LxmlBackend(), LxmlBackend(stdlib_streams=True)):
+            with self.subTest(stdlib_streams=backend._stdlib_streams):
+                self.assertEqual(self.parse_with(backend), expected)
+
+    def test_auto_streams_with_stdlib(self):
+        self.assertIsInstance(select_backend("auto"), LxmlBackend)
+        self.assertEqual(type(select_backend("auto").pull_parser()).__module__, "xml.etree.ElementTree")
+
+    def test_malformed_xml_is_value_error(self):
+        for backend in (LxmlBackend(), LxmlBackend(stdlib_streams=True)):
+            with patch.object(parse_data, "_xml", backend):
+                with self.assertRaises(ValueError):
+                    parse_departures("<Siri><broken>")
+                with self.assertRaises(ValueError):
+                    parse_departures_stream([b"<Siri><broken>"])
+
+    def test_entities_are_not_expanded(self):
+        """Test that lxml does not resolve external entities"""
+        xml = (
+            '<?xml version="1.0"?><!DOCTYPE Siri [<!ENTITY x SYSTEM "file:///etc/passwd">]>'
+            '<Siri xmlns="http://www.siri.org.uk/siri"><DestinationName>&x;</DestinationName></Siri>'
+        )
+        root = LxmlBackend().fromstring(xml)
+        self.assertNotIn("root:", "".join(root.itertext()))
+
+    def test_libxml2_limits_are_kept(self):
+        """Test that lxml rejects documents past libxml2's default nesting limit"""
+        xml = "<Siri>" + "<a>" * 300 + "</a>" * 300 + "</Siri>"
+        with patch.object(parse_data, "_xml", LxmlBackend()):
+            with self.assertRaises(ValueError):
+                parse_departures(xml)
+            with self.assertRaises(ValueError):
+                parse_departures_stream([xml.encode("utf-8")])
+
+if __name__ == '__main__':
+    unittest.main()